@@ -35,19 +35,19 @@ class TrainAudio(Train):
             'train', tfrecord_dir,
             file_pattern=self.file_pattern, num_frames=self.num_frames)
         self.mfccs_train, self.labels_train = load_batch_mfcc(
-            self.dataset_train, batch_size=batch_size)
+            self.dataset_train, batch_size=batch_size,
+            num_epochs=self.num_epochs)
         self.dataset_test = get_split_mfcc(
             'validation', tfrecord_dir,
             file_pattern=self.file_pattern, num_frames=self.num_frames)
         self.mfccs_test, self.labels_test = load_batch_mfcc(
-            self.dataset_test, batch_size=batch_size)
+            self.dataset_test, batch_size=batch_size,
+            num_epochs=self.num_epochs)
         return self.dataset_train
 
     def decide_used_data(self):
-        self.mfccs = tf.cond(
-            self.training, lambda: self.mfccs_train, lambda: self.mfccs_test)
-        self.labels = tf.cond(
-            self.training, lambda: self.labels_train, lambda: self.labels_test)
+        self.mfccs = self.select_data(self.mfccs_train, self.mfccs_test)
+        self.labels = self.select_data(self.labels_train, self.labels_test)
 
 
 class EvaluateAudio(Evaluate):
@@ -65,7 +65,8 @@ class EvaluateAudio(Evaluate):
         if batch_size is None:
             batch_size = self.dataset.num_samples
         self.mfccs, self.labels = load_batch_mfcc(
-            self.dataset, batch_size=batch_size, shuffle=shuffle)
+            self.dataset, batch_size=batch_size, shuffle=shuffle,
+            num_epochs=self.num_epochs)
         return self.dataset
 
 
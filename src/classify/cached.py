@@ -0,0 +1,340 @@
+"""Train and evaluate the last layer of a classifier from cached features.
+
+Several classifiers only train a perceptron on top of a frozen network
+(`TrainClassifyImagesCAE`, `TrainClassifyCommonRepr`...). By default all
+the inputs are still decoded and fed to the frozen network at every step.
+When `feature_cache_dir` is given to the classes inheriting from the
+mixins defined here, the representations of the 'train' and 'validation'
+splits are instead computed once and stored in this directory (see
+`data/feature_cache.py`), and the last layer is trained and evaluated
+directly from them.
+
+The stored representations are computed again whenever the checkpoint of
+the frozen network or the arguments used to compute them change.
+
+A class using these mixins must implement `get_split_inputs`,
+`compute_representation` and `compute_logits_from_representation`
+(`compute_logits` should simply combine the last two). Note that the
+representations are computed with the same batch normalization mode as
+without the cache unless `feature_batch_stat` is given, and that only the
+variables given by `get_head_init_fn` are restored when the last layer is
+trained from the cache (none by default).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import abc
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec
+
+import tensorflow as tf
+
+from data.feature_cache import FeatureCache, checkpoint_signature
+from routines.train import Train
+from routines.evaluate import Evaluate
+from classify.train import TrainClassify
+from classify.evaluate import EvaluateClassify
+
+slim = tf.contrib.slim
+
+
+class CachedRepresentation(object):
+    """Compute and store the representations of the splits of a dataset.
+
+    `get_split_inputs` isn't declared here since it's usually given by
+    another base class of the subclasses (ex: `TrainImages`), which this
+    mixin must not hide.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    # The directory of the cache, `None` not to use it.
+    feature_cache_dir = None
+
+    # The directories containing the checkpoint of the frozen network,
+    # if `None` the `checkpoint_dirs` given to `train`/`evaluate` are used.
+    feature_checkpoint_dirs = None
+
+    # The dtype used to store the representations, 'float32' or 'float16'.
+    feature_cache_dtype = 'float32'
+
+    # Whether the frozen network uses batch statistics (`True`) or moving
+    # mean/variance (`False`) for batch normalization. `None` to do as
+    # without the cache: batch statistics for training, the `batch_stat`
+    # argument of `evaluate` for the evaluation.
+    feature_batch_stat = None
+
+    # The arguments of `compute` that are used by the last layer
+    # (`compute_logits_from_representation`) and not by the frozen network.
+    head_kwargs = ('dropout_keep_prob',)
+
+    @abc.abstractmethod
+    def compute_representation(self, inputs, **kwargs):
+        """Compute the representation by the frozen network."""
+        pass
+
+    @abc.abstractmethod
+    def compute_logits_from_representation(self, net, num_classes, **kwargs):
+        """Compute the logits from the representation."""
+        pass
+
+    def get_feature_checkpoint_path(self, checkpoint_dirs):
+        """The checkpoint used to compute the representations."""
+        assert len(checkpoint_dirs) == 1
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_dirs[0])
+        assert checkpoint_path is not None
+        return checkpoint_path
+
+    def split_kwargs(self, kwargs):
+        """Separate the arguments of `compute` in two dictionaries, the
+        ones used by the frozen network and the ones used by the head."""
+        representation_kwargs = {}
+        head_kwargs = {}
+        for key, value in kwargs.items():
+            if key in self.head_kwargs:
+                head_kwargs[key] = value
+            else:
+                representation_kwargs[key] = value
+        return representation_kwargs, head_kwargs
+
+    def representation_config(self, tfrecord_dir, representation_kwargs,
+                              batch_stat, batch_size):
+        """Describe how the representations are computed.
+
+        Besides the dataset, the arguments of the frozen network and the
+        batch normalization mode (with the batch size if batch statistics
+        are used), the input sizes, the endpoint and the architecture are
+        used when the instance has such attributes.
+        """
+        config = {'tfrecord_dir': os.path.abspath(tfrecord_dir),
+                  'kwargs': representation_kwargs,
+                  'batch_stat': batch_stat}
+        if batch_stat:
+            config['batch_size'] = batch_size
+        for name in ['image_size', 'channels', 'endpoint']:
+            if hasattr(self, name):
+                config[name] = getattr(self, name)
+        for name in ['architecture', 'CAE_architecture']:
+            if hasattr(self, name):
+                architecture = getattr(self, name)
+                config[name] = getattr(
+                    architecture, '__name__', str(architecture))
+        return config
+
+    def prepare_feature_cache(self, split_names, tfrecord_dir,
+                              checkpoint_dirs, batch_size,
+                              representation_kwargs, batch_stat,
+                              arg_scope_fn):
+        """Compute the representations of the splits that are not
+        already stored or are out of date.
+
+        Args:
+            split_names: The names of the splits that are used.
+            tfrecord_dir: The directory that contains the dataset tfrecords.
+            checkpoint_dirs: The directories containing the checkpoints,
+                only used if `self.feature_checkpoint_dirs` is `None`.
+            batch_size: The batch size used to compute the representations.
+            representation_kwargs: The arguments of
+                `self.compute_representation`.
+            batch_stat: Whether batch statistics are used for batch
+                normalization, it must be the mode set by `arg_scope_fn`.
+            arg_scope_fn: A function returning the argument scope used
+                to compute the representations, it's called in the graph
+                where they're computed.
+
+        Returns:
+            The `FeatureCache` instance.
+        """
+        if self.feature_checkpoint_dirs is not None:
+            checkpoint_dirs = self.feature_checkpoint_dirs
+        if not isinstance(checkpoint_dirs, (list, tuple)):
+            checkpoint_dirs = [checkpoint_dirs]
+        checkpoint_path = self.get_feature_checkpoint_path(checkpoint_dirs)
+
+        signature = checkpoint_signature(checkpoint_path)
+        config = self.representation_config(
+            tfrecord_dir, representation_kwargs, batch_stat, batch_size)
+        cache = FeatureCache(self.feature_cache_dir)
+
+        for split_name in split_names:
+            if cache.is_valid(split_name, signature, config):
+                tf.logging.info('Using the stored representations of %s',
+                                split_name)
+                continue
+            tf.logging.info('Computing the representations of %s',
+                            split_name)
+            with tf.Graph().as_default():
+                dataset, inputs, labels = self.get_split_inputs(
+                    split_name, tfrecord_dir, batch_size,
+                    shuffle=False, num_epochs=1)
+                with slim.arg_scope(arg_scope_fn()):
+                    representations = self.compute_representation(
+                        inputs, **representation_kwargs)
+                saver = tf.train.Saver(tf.model_variables())
+
+                with tf.Session() as sess:
+                    saver.restore(sess, checkpoint_path)
+
+                    def batches():
+                        while True:
+                            try:
+                                yield sess.run([representations, labels])
+                            except tf.errors.OutOfRangeError:
+                                return
+
+                    cache.write(split_name, batches(), dataset, signature,
+                                config, dtype=self.feature_cache_dtype)
+        return cache
+
+
+class TrainClassifyCached(CachedRepresentation):
+    """Mixin to train the last layer of a classifier from cached features.
+
+    It must come before the training class in the list of base classes.
+    """
+
+    def train(self, tfrecord_dir, checkpoint_dirs, log_dir, **kwargs):
+        if self.feature_cache_dir is None:
+            return super(TrainClassifyCached, self).train(
+                tfrecord_dir, checkpoint_dirs, log_dir, **kwargs)
+
+        train_args = getargspec(Train.train).args
+        compute_kwargs = {key: value for key, value in kwargs.items()
+                          if key not in train_args}
+        representation_kwargs, _ = self.split_kwargs(compute_kwargs)
+
+        # The frozen network sees training batches with batch statistics.
+        batch_stat = self.feature_batch_stat
+        if batch_stat is None:
+            batch_stat = True
+
+        def arg_scope_fn():
+            self.batch_stat = tf.constant(batch_stat)
+            return self.used_arg_scope(
+                kwargs.get('use_batch_norm', True),
+                kwargs.get('renorm', False),
+                kwargs.get('weight_decay', 0.0004))
+
+        self.prepare_feature_cache(
+            ['train', 'validation'], tfrecord_dir, checkpoint_dirs,
+            kwargs.get('batch_size', 24), representation_kwargs, batch_stat,
+            arg_scope_fn)
+
+        return super(TrainClassifyCached, self).train(
+            tfrecord_dir, checkpoint_dirs, log_dir, **kwargs)
+
+    def get_init_fn(self, checkpoint_dirs):
+        if self.feature_cache_dir is None:
+            return super(TrainClassifyCached, self).get_init_fn(
+                checkpoint_dirs)
+        return self.get_head_init_fn(checkpoint_dirs)
+
+    def get_head_init_fn(self, checkpoint_dirs):
+        """Warm-start the layers trained from the cache.
+
+        The frozen network isn't part of the graph anymore so by default
+        there's nothing to restore.
+        """
+        return None
+
+    def get_data(self, tfrecord_dir, batch_size):
+        if self.feature_cache_dir is None:
+            return super(TrainClassifyCached, self).get_data(
+                tfrecord_dir, batch_size)
+        cache = FeatureCache(self.feature_cache_dir)
+        self.dataset_train = cache.get_split('train')
+        self.images_train, self.labels_train = cache.load_batch(
+            'train', batch_size, num_epochs=self.num_epochs)
+        self.dataset_test = cache.get_split('validation')
+        self.images_test, self.labels_test = cache.load_batch(
+            'validation', batch_size, num_epochs=self.num_epochs)
+        return self.dataset_train
+
+    def compute(self, **kwargs):
+        if self.feature_cache_dir is None:
+            return super(TrainClassifyCached, self).compute(**kwargs)
+        _, head_kwargs = self.split_kwargs(kwargs)
+        self.logits = self.compute_logits_from_representation(
+            self.images, self.dataset_train.num_classes, **head_kwargs)
+
+    # The representations cannot be shown as images.
+    def get_summary_op(self):
+        if self.feature_cache_dir is None:
+            return super(TrainClassifyCached, self).get_summary_op()
+        return TrainClassify.get_summary_op(self)
+
+    def get_test_summary_op(self):
+        if self.feature_cache_dir is None:
+            return super(TrainClassifyCached, self).get_test_summary_op()
+        return TrainClassify.get_test_summary_op(self)
+
+
+class EvaluateClassifyCached(CachedRepresentation):
+    """Mixin to evaluate the last layer of a classifier from cached features.
+
+    It must come before the evaluation class in the list of base classes.
+    If the checkpoints of the evaluated model don't contain the frozen
+    network (because the last layer was trained from the cache),
+    `feature_checkpoint_dirs` must be given.
+    """
+
+    def prepare(self, tfrecord_dir, checkpoint_dirs, split_name,
+                batch_size, use_batch_norm=True, batch_stat=False, **kwargs):
+        if self.feature_cache_dir is None:
+            return super(EvaluateClassifyCached, self).prepare(
+                tfrecord_dir, checkpoint_dirs, split_name, batch_size,
+                use_batch_norm, batch_stat, **kwargs)
+
+        evaluate_args = (getargspec(Evaluate.evaluate).args +
+                         getargspec(Evaluate.evaluate_checkpoints).args)
+        compute_kwargs = {key: value for key, value in kwargs.items()
+                          if key not in evaluate_args}
+        representation_kwargs, _ = self.split_kwargs(compute_kwargs)
+
+        if self.feature_batch_stat is not None:
+            batch_stat = self.feature_batch_stat
+
+        def arg_scope_fn():
+            return self.used_arg_scope(batch_stat, use_batch_norm)
+
+        self.prepare_feature_cache(
+            [split_name], tfrecord_dir, checkpoint_dirs, batch_size or 24,
+            representation_kwargs, batch_stat, arg_scope_fn)
+
+    def get_data(self, split_name, tfrecord_dir, batch_size, shuffle):
+        if self.feature_cache_dir is None:
+            return super(EvaluateClassifyCached, self).get_data(
+                split_name, tfrecord_dir, batch_size, shuffle)
+        cache = FeatureCache(self.feature_cache_dir)
+        self.dataset = cache.get_split(split_name)
+        if batch_size is None:
+            batch_size = self.dataset.num_samples
+        self.images, self.labels = cache.load_batch(
+            split_name, batch_size, shuffle=shuffle,
+            num_epochs=self.num_epochs)
+        return self.dataset
+
+    def compute(self, **kwargs):
+        if self.feature_cache_dir is None:
+            return super(EvaluateClassifyCached, self).compute(**kwargs)
+        _, head_kwargs = self.split_kwargs(kwargs)
+        self.logits = self.compute_logits_from_representation(
+            self.images, self.dataset.num_classes, **head_kwargs)
+
+    # The representations cannot be shown as images.
+    def compute_log_data(self):
+        if self.feature_cache_dir is None:
+            return super(EvaluateClassifyCached, self).compute_log_data()
+        return EvaluateClassify.compute_log_data(self)
+
+    def last_step_log_info(self, sess, batch_size):
+        if self.feature_cache_dir is None:
+            return super(EvaluateClassifyCached, self).last_step_log_info(
+                sess, batch_size)
+        return self.step_log_info(sess)
@@ -1,12 +1,20 @@
-"""Implement a function to classify a single image using
-a trained model."""
+"""Classify images using a trained model.
+
+The model is loaded only once by a `Classifier` instance, which can then
+be used to classify batches of images (given by their paths or directly
+by their encoded data). The functions `serve_stdin` and `serve_http` use
+such an instance to serve classification requests locally.
+"""
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import os
+import sys
+import json
 
+import six
+from six.moves import BaseHTTPServer
 import tensorflow as tf
 from data import dataset_utils
 from nets_base import inception_v4, inception_preprocessing
@@ -14,48 +22,216 @@ from nets_base import inception_v4, inception_preprocessing
 slim = tf.contrib.slim
 
 
-def classify_image(image_path, train_dir, label_dir):
-
-    image_size = 299
-
-    with tf.Graph().as_default():
-
-        image_string = tf.gfile.FastGFile(image_path, 'r').read()
-        _, image_ext = os.path.splitext(image_path)
-
-        if image_ext in ['.jpg', '.jpeg']:
-            image = tf.image.decode_jpeg(image_string, channels=3)
-        elif image_ext == '.png':
-            image = tf.image.decode_png(image_string, channels=3)
-        else:
-            raise ValueError('image format not supported, must be jpg or png')
+def is_image_data(image):
+    """Check if we're given the data of a jpeg/png image or not."""
+    return (isinstance(image, six.binary_type) and
+            (image.startswith(b'\xff\xd8') or
+             image.startswith(b'\x89PNG\r\n\x1a\n')))
+
+
+class Classifier(object):
+    """Classify images with a trained InceptionV4 model.
+
+    The graph is built and the checkpoint restored once when the instance
+    is created. Images are then fed as encoded strings to a placeholder,
+    decoded and preprocessed in the graph, and the `top_k` most probable
+    classes are directly computed by `tf.nn.top_k`.
+    """
+
+    def __init__(self, train_dir, label_dir,
+                 image_size=299, top_k=5, batch_size=32):
+        """Build the graph and restore the model.
+
+        Args:
+            train_dir: The directory containing the checkpoints of the
+                model, the latest one is used.
+            label_dir: The directory containing the label file.
+            image_size: The size of the images fed to the model.
+            top_k: The number of classes returned for each image.
+            batch_size: The maximum number of images classified at the
+                same time.
+        """
+        self.batch_size = batch_size
+        self.labels_to_names = dataset_utils.read_label_file(label_dir)
+        num_classes = len(self.labels_to_names)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.image_strings = tf.placeholder(
+                tf.string, shape=[None], name='image_strings')
+
+            def decode_and_preprocess(image_string):
+                image = tf.image.decode_image(image_string, channels=3)
+                image.set_shape([None, None, 3])
+                return inception_preprocessing.preprocess_image(
+                    image, image_size, image_size, is_training=False)
+
+            processed_images = tf.map_fn(
+                decode_and_preprocess, self.image_strings,
+                dtype=tf.float32, back_prop=False)
+
+            # Create the model, use the default arg scope to
+            # configure the batch norm parameters.
+            with slim.arg_scope(inception_v4.inception_v4_arg_scope()):
+                _, endpoints = inception_v4.inception_v4(
+                    processed_images, num_classes=num_classes,
+                    is_training=False)
+            self.top_probabilities, self.top_indices = tf.nn.top_k(
+                endpoints['Predictions'], k=min(top_k, num_classes))
+
+            checkpoint_path = tf.train.latest_checkpoint(train_dir)
+            saver = tf.train.Saver(tf.model_variables())
+            self.graph.finalize()
+
+        self.sess = tf.Session(graph=self.graph)
+        saver.restore(self.sess, checkpoint_path)
+
+    def read(self, image):
+        """Returns the encoded data of an image given by path or data."""
+        if is_image_data(image):
+            return image
+        with tf.gfile.FastGFile(image, 'rb') as f:
+            image_data = f.read()
+        if not is_image_data(image_data):
+            raise ValueError(
+                'image format not supported, must be jpg or png: %s' % image)
+        return image_data
+
+    def classify(self, images):
+        """Classify some images.
+
+        Args:
+            images: A list of images, each of them is given either by its
+                path or by its encoded jpeg/png data. A single image can
+                also be given.
+
+        Returns:
+            For each image a list of pairs (class name, probability), from
+            the most probable class to the least probable one. If a single
+            image was given then only its list is returned.
+        """
+        if not isinstance(images, (list, tuple)):
+            return self.classify([images])[0]
+
+        results = []
+        for i in range(0, len(images), self.batch_size):
+            image_strings = [self.read(image)
+                             for image in images[i:i+self.batch_size]]
+            probabilities, indices = self.sess.run(
+                [self.top_probabilities, self.top_indices],
+                feed_dict={self.image_strings: image_strings})
+            for image_probabilities, image_indices in zip(
+                    probabilities, indices):
+                results.append([
+                    (self.labels_to_names[index], float(probability))
+                    for probability, index in zip(
+                        image_probabilities, image_indices)])
+        return results
+
+    def close(self):
+        self.sess.close()
+
+
+def format_result(result):
+    return ' '.join('%s:%.4f' % pair for pair in result)
+
+
+def serve_stdin(classifier, stdin=None, stdout=None):
+    """Classify the images whose paths are read from the standard input.
+
+    One path is expected per line and for each of them we write a line
+    'path<TAB>class:probability class:probability ...'. The paths are
+    classified by batches of `classifier.batch_size`, so results are
+    written once a batch is complete (or at the end of the input).
+
+    Args:
+        classifier: A `Classifier` instance.
+        stdin, stdout: The streams to use, `sys.stdin` and `sys.stdout`
+            by default.
+    """
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+
+    def flush(paths):
+        try:
+            results = classifier.classify(paths)
+        except (ValueError, tf.errors.OpError):
+            # Classify one by one to know which images are invalid.
+            results = []
+            for path in paths:
+                try:
+                    results.append(classifier.classify(path))
+                except (ValueError, tf.errors.OpError) as error:
+                    results.append(error)
+        for path, result in zip(paths, results):
+            if isinstance(result, Exception):
+                stdout.write('%s\tERROR %s\n' % (path, result))
+            else:
+                stdout.write('%s\t%s\n' % (path, format_result(result)))
+        stdout.flush()
+
+    paths = []
+    for line in stdin:
+        path = line.strip()
+        if path:
+            paths.append(path)
+        if len(paths) == classifier.batch_size:
+            flush(paths)
+            paths = []
+    if paths:
+        flush(paths)
+
+
+def serve_http(classifier, host='localhost', port=8000):
+    """Serve classification requests over HTTP.
+
+    A POST request either contains the data of an image in its body,
+    or a JSON object {"paths": [...]} (with the content type
+    'application/json') giving paths of images on this machine. The
+    response is a JSON list of lists of [class name, probability],
+    one for each image.
+
+    Args:
+        classifier: A `Classifier` instance.
+        host, port: The address to listen on.
+    """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            try:
+                if self.headers.get('Content-Type') == 'application/json':
+                    images = json.loads(body.decode('utf-8'))['paths']
+                else:
+                    images = [body]
+                response, status = classifier.classify(images), 200
+            except (ValueError, KeyError, tf.errors.OpError) as error:
+                response, status = {'error': str(error)}, 400
+            response = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+    tf.logging.info('Serving on http://%s:%d', host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
-        processed_image = inception_preprocessing.preprocess_image(
-            image, image_size, image_size, is_training=False)
-        processed_images = tf.expand_dims(processed_image, 0)
 
-        labels_to_names = dataset_utils.read_label_file(label_dir)
-
-        # Create the model, use the default arg scope to
-        # configure the batch norm parameters.
-        with slim.arg_scope(inception_v4.inception_v4_arg_scope()):
-            logits, endpoints = inception_v4.inception_v4(
-                processed_images, num_classes=len(labels_to_names),
-                is_training=False)
-        probabilities = endpoints['Predictions']
-
-        checkpoint_path = tf.train.latest_checkpoint(train_dir)
-        saver = tf.train.Saver(tf.model_variables())
-
-        with tf.Session() as sess:
-            saver.restore(sess, checkpoint_path)
-
-            probabilities = sess.run(probabilities)
-            probabilities = probabilities[0, 0:]
-            sorted_inds = [i[0] for i in sorted(
-                enumerate(-probabilities), key=lambda x:x[1])]
-
-        for i in range(5):
-            index = sorted_inds[i]
-            print('Probability %0.2f%% => [%s]' % (
-                  probabilities[index] * 100, labels_to_names[index]))
+def classify_image(image_path, train_dir, label_dir):
+    """Print the 5 most probable classes of a single image.
+
+    This loads the model for this image only, use a `Classifier` to
+    classify several images.
+    """
+    classifier = Classifier(train_dir, label_dir)
+    try:
+        for name, probability in classifier.classify(image_path):
+            print('Probability %0.2f%% => [%s]' % (probability * 100, name))
+    finally:
+        classifier.close()
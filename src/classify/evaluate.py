@@ -3,7 +3,9 @@
 The file contains two classes `EvaluateClassify` and `EvaluateClassifyCNN`.
 
 `EvaluateClassify` can be used for any network architecture and prediction
-accuracy is evaluated. `EvaluateClassifyCNN` is used for a CNN classifcation.
+accuracy is evaluated. With `single_pass=True` (see `Evaluate.evaluate`)
+the accuracy, the loss and the confusion matrix of the whole split are
+computed exactly. `EvaluateClassifyCNN` is used for a CNN classifcation.
 """
 
 from __future__ import absolute_import
@@ -12,6 +14,8 @@ from __future__ import print_function
 
 import time
 import abc
+
+import numpy as np
 import tensorflow as tf
 
 from routines.evaluate import Evaluate
@@ -79,6 +83,72 @@ class EvaluateClassify(Evaluate):
         if hasattr(self, 'fw'):
             self.fw.add_summary(ac_summary, global_step=global_step_count)
 
+    def get_pass_metric_op(self):
+        """Accumulate the accuracy, the mean cross entropy loss and the
+        confusion matrix (rows are true labels, columns predictions)."""
+        num_classes = self.dataset.num_classes
+        labels = tf.cast(self.labels, tf.int64)
+        with tf.variable_scope('single_pass'):
+            self.pass_accuracy, accuracy_update = tf.metrics.accuracy(
+                labels, self.predictions)
+            losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=labels, logits=self.logits)
+            self.pass_loss, loss_update = tf.metrics.mean(losses)
+            self.pass_confusion_matrix = tf.Variable(
+                tf.zeros([num_classes, num_classes], tf.int64),
+                trainable=False, name='confusion_matrix',
+                collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            confusion_update = tf.assign_add(
+                self.pass_confusion_matrix,
+                tf.confusion_matrix(labels, self.predictions,
+                                    num_classes=num_classes,
+                                    dtype=tf.int64))
+        self.pass_metric_op = tf.group(
+            accuracy_update, loss_update, confusion_update)
+        return self.pass_metric_op
+
+    def pass_step_log_info(self, sess):
+        start_time = time.time()
+        global_step_count, accuracy_rate, _ = sess.run(
+            [self.global_step_op, self.accuracy, self.pass_metric_op])
+        time_elapsed = time.time() - start_time
+        tf.logging.info(
+            'global step %s: accurarcy: %.4f (%.2f sec/step)',
+            global_step_count, accuracy_rate, time_elapsed)
+
+    def pass_log_info(self, sess):
+        """Log and return the metrics of the whole pass.
+
+        Returns:
+            A dictionary with the keys 'accuracy', 'loss', 'num_samples'
+            and 'confusion_matrix' (a numpy array).
+        """
+        accuracy, loss, confusion_matrix, global_step_count = sess.run([
+            self.pass_accuracy, self.pass_loss, self.pass_confusion_matrix,
+            tf.train.get_global_step()])
+        num_samples = int(np.sum(confusion_matrix))
+
+        tf.logging.info('Accuracy on %d samples: %.4f, loss: %.4f',
+                        num_samples, accuracy, loss)
+        names = self.dataset.labels_to_names
+        for label, row in enumerate(confusion_matrix):
+            name = names[label] if names is not None else label
+            tf.logging.info('%s: %s', name, ' '.join(map(str, row)))
+
+        if hasattr(self, 'fw'):
+            self.fw.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag='accuracy/single_pass',
+                                 simple_value=accuracy),
+                tf.Summary.Value(tag='losses/single_pass',
+                                 simple_value=loss)]),
+                global_step=global_step_count)
+            self.fw.flush()
+
+        return {'accuracy': float(accuracy),
+                'loss': float(loss),
+                'num_samples': num_samples,
+                'confusion_matrix': confusion_matrix}
+
 
 class EvaluateClassifyCNN(EvaluateClassify):
     """Class that is used to evaluate any CNN architectures
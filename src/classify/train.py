@@ -128,8 +128,7 @@ class TrainClassify(Train):
     def test_log_info(self, sess, test_use_batch):
         loss, accuracy_rate, summaries_test = sess.run(
             [self.total_loss, self.accuracy, self.test_summary_op],
-            feed_dict={self.training: False,
-                       self.batch_stat: test_use_batch})
+            feed_dict=self.test_feed_dict(sess, test_use_batch))
         tf.logging.info('Current Test Loss: %s', loss)
         tf.logging.info('Current Test Accuracy: %s', accuracy_rate)
         self.sv.summary_computed(sess, summaries_test)
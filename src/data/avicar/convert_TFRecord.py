@@ -11,9 +11,8 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import sys
-import math
 import random
+import functools
 
 import scipy.io.wavfile
 import scipy.signal
@@ -21,6 +20,7 @@ import librosa
 
 import tensorflow as tf
 from data import dataset_utils
+from data import parallel_conversion
 
 
 def read_wav(file_path, feature_len=26, num_frames=20):
@@ -41,13 +41,42 @@ def read_wav(file_path, feature_len=26, num_frames=20):
     return sr, audio_data, mfcc_res
 
 
-def to_tfexample(raw_data, mfcc_data, class_id):
-    return tf.train.Example(features=tf.train.Features(feature={
-        'audio/mfcc': dataset_utils.float_feature(mfcc_data),
-        'audio/wav/data': dataset_utils.float_feature(raw_data),
-        'audio/wav/length': dataset_utils.int64_feature(len(raw_data)),
-        'audio/label': dataset_utils.int64_feature(class_id)
-    }))
+def to_tfexample(raw_data, mfcc_data, class_id, dtype='float32'):
+    # The wav data is kept in its own dtype when possible (most often
+    # int16), which is lossless and smaller than float32.
+    wav_dtype = raw_data.dtype.name
+    if wav_dtype not in dataset_utils.TENSOR_DTYPES:
+        wav_dtype = 'float32'
+    feature = dataset_utils.tensor_features('audio/mfcc', mfcc_data, dtype)
+    feature.update(
+        dataset_utils.tensor_features('audio/wav', raw_data, wav_dtype))
+    feature['audio/label'] = dataset_utils.int64_feature(class_id)
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def file_to_tfexample(file_path, class_names_to_ids,
+                      feature_len=26, num_frames=24, dtype='float32'):
+    """Convert a .wav file to a `tf.train.Example`.
+
+    Args:
+        file_path: The path of the .wav file.
+        class_names_to_ids: A dictionary from class names (strings) to ids
+            (integers).
+        feature_len: The feature length for each time frame.
+        num_frames: The number of time frames of the stored mfcc features.
+        dtype: The dtype used to store the mfcc features, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
+
+    Returns:
+        The `tf.train.Example` to be written in TFRecords.
+    """
+    sr, audio_data, mfcc = read_wav(
+        file_path, feature_len=feature_len, num_frames=num_frames)
+
+    class_name = os.path.basename(file_path)[9]
+    class_id = class_names_to_ids[class_name]
+
+    return to_tfexample(audio_data, mfcc, class_id, dtype)
 
 
 def get_tfrecord_filename(split_name, tfrecord_dir, shard_id, num_shards):
@@ -62,49 +91,31 @@ def convert_dataset(split_name,
                     tfrecord_dir,
                     num_shards=5,
                     feature_len=26,
-                    num_frames=24):
+                    num_frames=24,
+                    num_workers=None,
+                    dtype='float32'):
 
     assert split_name in ['train', 'validation']
 
-    num_per_shard = int(math.ceil(len(file_paths)/float(num_shards)))
-
-    with tf.Graph().as_default():
-
-        for shard_id in range(num_shards):
-            output_filename = get_tfrecord_filename(
-                split_name, tfrecord_dir, shard_id, num_shards)
-
-            with tf.python_io.TFRecordWriter(output_filename)\
-                    as tfrecord_writer:
-                start_ndx = shard_id * num_per_shard
-                end_ndx = min((shard_id+1)*num_per_shard, len(file_paths))
-                for i in range(start_ndx, end_ndx):
-                    sys.stdout.write(
-                        '\r>> Converting file %d/%d shard %s %d' % (
-                            i+1, len(file_paths), split_name, shard_id))
-                    sys.stdout.flush()
-
-                    sr, audio_data, mfcc = read_wav(
-                        file_paths[i], feature_len=feature_len,
-                        num_frames=num_frames)
-                    audio_data = list(audio_data)
-                    mfcc_data = list(mfcc.reshape(-1))
-
-                    class_name = os.path.basename(file_paths[i])[9]
-                    class_id = class_names_to_ids[class_name]
-
-                    example = to_tfexample(audio_data, mfcc_data, class_id)
-                    tfrecord_writer.write(example.SerializeToString())
-
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    parallel_conversion.convert_dataset_parallel(
+        split_name, file_paths,
+        functools.partial(
+            file_to_tfexample, class_names_to_ids=class_names_to_ids,
+            feature_len=feature_len, num_frames=num_frames, dtype=dtype),
+        get_tfrecord_filename, tfrecord_dir,
+        num_shards=num_shards, num_workers=num_workers,
+        feature_shapes={
+            'audio/mfcc': [feature_len, num_frames],
+            'audio/wav': [None]})
 
 
 def convert_avicar(dataset_dir,
                    tfrecord_dir,
                    num_shards=5,
                    num_val_samples=2000,
-                   num_frames=20):
+                   num_frames=20,
+                   num_workers=None,
+                   dtype='float32'):
 
     if not tf.gfile.Exists(tfrecord_dir):
         tf.gfile.MakeDirs(tfrecord_dir)
@@ -122,10 +133,12 @@ def convert_avicar(dataset_dir,
 
     convert_dataset('train', training_filenames,
                     class_names_to_ids, tfrecord_dir,
-                    num_shards=num_shards, num_frames=num_frames)
+                    num_shards=num_shards, num_frames=num_frames,
+                    num_workers=num_workers, dtype=dtype)
     convert_dataset('validation', validation_filenames,
                     class_names_to_ids, tfrecord_dir,
-                    num_shards=num_shards, num_frames=num_frames)
+                    num_shards=num_shards, num_frames=num_frames,
+                    num_workers=num_workers, dtype=dtype)
 
     labels_to_class_names = dict(zip(range(26), alphabets))
     dataset_utils.write_label_file(labels_to_class_names, tfrecord_dir)
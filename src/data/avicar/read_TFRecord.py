@@ -14,10 +14,10 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import fnmatch
 import tensorflow as tf
 
 from data import dataset_utils
+from data import pipeline
 
 slim = tf.contrib.slim
 
@@ -40,14 +40,9 @@ def get_split_avicar(split_name,
     if not file_pattern:
         file_pattern = _FILE_PATTERN
 
-    num_samples = 0
-    tfrecords_to_count = [
-        os.path.join(tfrecord_dir, file)
-        for file in os.listdir(tfrecord_dir)
-        if fnmatch.fnmatch(file, file_pattern % split_name)]
-    for tfrecord_file in tfrecords_to_count:
-        for record in tf.python_io.tf_record_iterator(tfrecord_file):
-            num_samples += 1
+    # Compute the number of samples contained in the dataset.
+    num_samples = dataset_utils.get_num_samples(
+        tfrecord_dir, split_name, file_pattern)
 
     file_pattern = os.path.join(tfrecord_dir, file_pattern % split_name)
 
@@ -55,19 +50,23 @@ def get_split_avicar(split_name,
         reader = tf.TFRecordReader
 
     # Create the keys_to_features dictionary for the decoder
-    keys_to_features = {
-        'audio/wav/data': tf.VarLenFeature(tf.float32),
-        'audio/wav/length': tf.FixedLenFeature((), tf.int64),
-        'audio/mfcc': tf.FixedLenFeature((26, num_frames), tf.float32),
+    # (TFRecords in the old format with one float per element can
+    # still be read, see `dataset_utils.RawTensor`)
+    keys_to_features = dataset_utils.tensor_keys_to_features(
+        'audio/wav', legacy_key='audio/wav/data')
+    keys_to_features.update(dataset_utils.tensor_keys_to_features(
+        'audio/mfcc', legacy_key='audio/mfcc'))
+    keys_to_features.update({
         'audio/label': tf.FixedLenFeature(
           (), tf.int64, default_value=tf.zeros((), dtype=tf.int64)),
-    }
+    })
 
     items_to_handlers = {
-        'wav': slim.tfexample_decoder.Tensor(
-            'audio/wav/data', shape_keys='audio/wav/length'),
-        'mfcc': slim.tfexample_decoder.Tensor(
-            'audio/mfcc', shape=(26, num_frames, 1)),
+        'wav': dataset_utils.RawTensor(
+            'audio/wav', legacy_key='audio/wav/data'),
+        'mfcc': dataset_utils.RawTensor(
+            'audio/mfcc', shape=(26, num_frames, 1),
+            legacy_key='audio/mfcc'),
         'label': slim.tfexample_decoder.Tensor('audio/label'),
     }
 
@@ -93,20 +92,14 @@ def get_split_avicar(split_name,
 
 def load_batch_avicar(dataset,
                       batch_size=32,
-                      common_queue_capacity=800,
-                      common_queue_min=400,
-                      shuffle=True):
-
-    data_provider = slim.dataset_data_provider.DatasetDataProvider(
-        dataset, common_queue_capacity=common_queue_capacity,
-        common_queue_min=common_queue_min, shuffle=shuffle)
-    wav, mfcc, label = data_provider.get(['wav', 'mfcc', 'label'])
-
-    # Batch it up.
-    mfccs, labels = tf.train.batch(
-        [mfcc, label],
-        batch_size=batch_size,
-        num_threads=1,
-        capacity=2*batch_size)
+                      shuffle_buffer_size=800,
+                      shuffle=True,
+                      num_epochs=None):
+
+    # Only mfcc features are decoded, see the docstring of the module.
+    mfccs, labels = pipeline.load_batch(
+        dataset, ['mfcc', 'label'], batch_size,
+        shuffle=shuffle, num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size)
 
     return mfccs, labels
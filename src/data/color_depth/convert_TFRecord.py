@@ -15,25 +15,58 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import sys
-import math
 import random
+import functools
 
 import tensorflow as tf
 from data import dataset_utils
+from data import parallel_conversion
 
 
-def to_tfexample(color_data, depth_data,
-                 color_format, depth_format, class_id):
+def to_tfexample(color_data, depth_data, color_format, depth_format,
+                 color_dims, depth_dims, class_id):
     return tf.train.Example(features=tf.train.Features(feature={
         'image/color/encoded': dataset_utils.bytes_feature(color_data),
         'image/color/format': dataset_utils.bytes_feature(color_format),
+        'image/color/height': dataset_utils.int64_feature(color_dims[0]),
+        'image/color/width': dataset_utils.int64_feature(color_dims[1]),
         'image/depth/encoded': dataset_utils.bytes_feature(depth_data),
         'image/depth/format': dataset_utils.bytes_feature(depth_format),
+        'image/depth/height': dataset_utils.int64_feature(depth_dims[0]),
+        'image/depth/width': dataset_utils.int64_feature(depth_dims[1]),
         'image/class/label': dataset_utils.int64_feature(class_id),
     }))
 
 
+def file_pair_to_tfexample(filename_pair, class_names_to_ids,
+                           validate=False):
+    """Convert a pair of color and depth images to a `tf.train.Example`.
+
+    Args:
+        filename_pair: The paths of the color and the depth image.
+        class_names_to_ids: A dictionary from class names (strings) to ids
+            (integers).
+        validate: Whether to decode the images to check them, otherwise
+            their sizes are read from their headers.
+
+    Returns:
+        The `tf.train.Example` to be written in TFRecords.
+    """
+    color_data = tf.gfile.FastGFile(filename_pair[0], 'rb').read()
+    depth_data = tf.gfile.FastGFile(filename_pair[1], 'rb').read()
+    color_dims = dataset_utils.read_image_dims(color_data, validate)
+    depth_dims = dataset_utils.read_image_dims(depth_data, validate)
+
+    class_name = os.path.basename(os.path.dirname(filename_pair[0]))
+    class_id = class_names_to_ids[class_name]
+
+    _, color_format = os.path.splitext(filename_pair[0])
+    _, depth_format = os.path.splitext(filename_pair[1])
+
+    return to_tfexample(color_data, depth_data, color_format, depth_format,
+                        color_dims, depth_dims, class_id)
+
+
 def get_fpairs_and_classes(dataset_dir, subjects=True):
     """Returns a list of filename pairs and inferred class names.
 
@@ -127,7 +160,8 @@ def get_tfrecord_filename(split_name, tfrecord_dir, shard_id, num_shards):
 
 
 def convert_dataset(split_name, filename_pairs, class_names_to_ids,
-                    tfrecord_dir, num_shards=5):
+                    tfrecord_dir, num_shards=5, num_workers=None,
+                    validate=False):
     """Converts the given filenamei pairs to a TFRecord dataset.
 
     Args:
@@ -137,47 +171,20 @@ def convert_dataset(split_name, filename_pairs, class_names_to_ids,
             (integers).
         tfrecord_dir: The directory where the converted datasets are stored.
         num_shards: The number of shards per dataset split
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        validate: Whether to decode every image to check it (see
+            `file_pair_to_tfexample`).
     """
     assert split_name in ['train', 'validation']
 
-    num_per_shard = int(math.ceil(len(filename_pairs)/float(num_shards)))
-
-    with tf.Graph().as_default():
-
-        for shard_id in range(num_shards):
-            output_filename = get_tfrecord_filename(
-                split_name, tfrecord_dir, shard_id, num_shards)
-
-            with tf.python_io.TFRecordWriter(output_filename)\
-                    as tfrecord_writer:
-                start_ndx = shard_id * num_per_shard
-                end_ndx = min((shard_id+1)*num_per_shard, len(filename_pairs))
-                for i in range(start_ndx, end_ndx):
-                    sys.stdout.write(
-                        '\r>> Converting image %d/%d shard %s %d' % (
-                            i+1, len(filename_pairs), split_name, shard_id))
-                    sys.stdout.flush()
-
-                    # Read the filename:
-                    color_data = tf.gfile.FastGFile(
-                        filename_pairs[i][0], 'r').read()
-                    depth_data = tf.gfile.FastGFile(
-                        filename_pairs[i][1], 'r').read()
-
-                    class_name = os.path.basename(
-                        os.path.dirname(filename_pairs[i][0]))
-                    class_id = class_names_to_ids[class_name]
-
-                    _, color_format = os.path.splitext(filename_pairs[i][0])
-                    _, depth_format = os.path.splitext(filename_pairs[i][1])
-
-                    example = to_tfexample(
-                        color_data, depth_data, color_format,
-                        depth_format, class_id)
-                    tfrecord_writer.write(example.SerializeToString())
-
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    parallel_conversion.convert_dataset_parallel(
+        split_name, filename_pairs,
+        functools.partial(
+            file_pair_to_tfexample, class_names_to_ids=class_names_to_ids,
+            validate=validate),
+        get_tfrecord_filename, tfrecord_dir,
+        num_shards=num_shards, num_workers=num_workers)
 
 
 def convert_color_depth(dataset_dir,
@@ -185,7 +192,9 @@ def convert_color_depth(dataset_dir,
                         subjects=True,
                         sep='user',
                         num_val_clss=2,
-                        num_shards=5):
+                        num_shards=5,
+                        num_workers=None,
+                        validate=False):
     """Runs the conversion operation.
 
     Args:
@@ -204,6 +213,10 @@ def convert_color_depth(dataset_dir,
         num_val_clss: Used only when sep=='class', the number of classes
             in validation set.
         num_shards: The number of shards per dataset split.
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        validate: Whether to decode every image to check it, by default
+            only the headers are read to get the sizes of the images.
     """
     if not tf.gfile.Exists(tfrecord_dir):
         tf.gfile.MakeDirs(tfrecord_dir)
@@ -241,9 +254,13 @@ def convert_color_depth(dataset_dir,
 
     # convert datasets
     convert_dataset('train', training_filename_pairs,
-                    class_names_to_ids, tfrecord_dir, num_shards=num_shards)
+                    class_names_to_ids, tfrecord_dir,
+                    num_shards=num_shards, num_workers=num_workers,
+                    validate=validate)
     convert_dataset('validation', validation_filename_pairs,
-                    class_names_to_ids, tfrecord_dir, num_shards=num_shards)
+                    class_names_to_ids, tfrecord_dir,
+                    num_shards=num_shards, num_workers=num_workers,
+                    validate=validate)
 
     # write the label file
     labels_to_class_names = dict(zip(range(len(class_names)), class_names))
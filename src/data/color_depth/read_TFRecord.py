@@ -9,10 +9,10 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import fnmatch
 import tensorflow as tf
 
 from data import dataset_utils
+from data import pipeline
 from nets_base import inception_preprocessing
 
 slim = tf.contrib.slim
@@ -32,7 +32,8 @@ def get_split_color_depth(split_name,
                           file_pattern=None,
                           reader=None,
                           color_channels=3,
-                          depth_channels=3):
+                          depth_channels=3,
+                          image_size=None):
     """Gets a dataset tuple for reading color-depth image pairs.
 
     Args:
@@ -46,6 +47,10 @@ def get_split_color_depth(split_name,
             images of the output dataset.
         depth_channels: The number of channels contained in the depth
             images of the output dataset.
+        image_size: The size to which the images are resized afterwards
+            (see `load_batch_color_depth`). If given, JPEG images are
+            decoded at the smallest resolution that is large enough
+            (see `dataset_utils.ScaledImage`).
 
     Returns:
         A `Dataset` namedtuple.
@@ -61,14 +66,9 @@ def get_split_color_depth(split_name,
     if not file_pattern:
         file_pattern = _FILE_PATTERN
 
-    num_samples = 0
-    tfrecords_to_count = [
-        os.path.join(tfrecord_dir, file)
-        for file in os.listdir(tfrecord_dir)
-        if fnmatch.fnmatch(file, file_pattern % split_name)]
-    for tfrecord_file in tfrecords_to_count:
-        for record in tf.python_io.tf_record_iterator(tfrecord_file):
-            num_samples += 1
+    # Compute the number of samples contained in the dataset.
+    num_samples = dataset_utils.get_num_samples(
+        tfrecord_dir, split_name, file_pattern)
 
     file_pattern = os.path.join(tfrecord_dir, file_pattern % split_name)
 
@@ -85,14 +85,16 @@ def get_split_color_depth(split_name,
     }
 
     items_to_handlers = {
-        'image/color': slim.tfexample_decoder.Image(
+        'image/color': dataset_utils.ScaledImage(
             image_key='image/color/encoded',
             format_key='image/color/format',
-            channels=color_channels),
-        'image/depth': slim.tfexample_decoder.Image(
+            channels=color_channels,
+            output_size=image_size),
+        'image/depth': dataset_utils.ScaledImage(
             image_key='image/depth/encoded',
             format_key='image/depth/format',
-            channels=depth_channels),
+            channels=depth_channels,
+            output_size=image_size),
         'label': slim.tfexample_decoder.Tensor('image/class/label'),
     }
 
@@ -120,9 +122,10 @@ def load_batch_color_depth(dataset,
                            batch_size=32,
                            height=299,
                            width=299,
-                           common_queue_capacity=800,
-                           common_queue_min=400,
-                           shuffle=True):
+                           shuffle_buffer_size=800,
+                           shuffle=True,
+                           num_epochs=None,
+                           cache=None):
     """Loads a single batch of data.
 
     Args:
@@ -130,8 +133,14 @@ def load_batch_color_depth(dataset,
         batch_size: The number of image pairs in the batch.
         height: The size of each image after preprocessing.
         width: The size of each image after preprocessing.
-        common_queue_capacity, common_queue_min: Decide the shuffle degree.
+        shuffle_buffer_size: Decide the shuffle degree.
         shuffle: Whether to shuffle or not.
+        num_epochs: The number of passes through the dataset, `None`
+            to repeat it indefinitely.
+        cache: If given ('uint8', 'float16' or 'float32'), the cropped
+            images are kept in memory with this dtype after the first
+            epoch (see `pipeline.load_batch`), only the standardization
+            is done again.
 
     Returns:
         images_color: A `Tensor` of size [batch_size, height, width, channels],
@@ -141,25 +150,23 @@ def load_batch_color_depth(dataset,
         labels: A `Tensor` of size [batch_size], whose values range between
             0 and `dataset.num_classes`.
     """
-    data_provider = slim.dataset_data_provider.DatasetDataProvider(
-        dataset, common_queue_capacity=common_queue_capacity,
-        common_queue_min=common_queue_min)
-    image_color, image_depth, label = data_provider.get(
-        ['image/color', 'image/depth', 'label'])
-
-    image_color = inception_preprocessing.preprocess_image(
-        image_color, height, width, is_training=False)
-    image_color = tf.image.per_image_standardization(image_color)
-
-    image_depth = inception_preprocessing.preprocess_image(
-        image_depth, height, width, is_training=False)
-    # image_depth = tf.image.adjust_contrast(image_depth, 10)
-    image_depth = tf.image.per_image_standardization(image_depth)
-
-    images_color, images_depth, labels = tf.train.batch(
-        [image_color, image_depth, label],
-        batch_size=batch_size,
-        num_threads=1,
-        capacity=2*batch_size)
+    def preprocess(image_color, image_depth, label):
+        image_color = inception_preprocessing.preprocess_image(
+            image_color, height, width, is_training=False)
+        image_depth = inception_preprocessing.preprocess_image(
+            image_depth, height, width, is_training=False)
+        # image_depth = tf.image.adjust_contrast(image_depth, 10)
+        return image_color, image_depth, label
+
+    def standardize(image_color, image_depth, label):
+        image_color = tf.image.per_image_standardization(image_color)
+        image_depth = tf.image.per_image_standardization(image_depth)
+        return image_color, image_depth, label
+
+    images_color, images_depth, labels = pipeline.load_batch(
+        dataset, ['image/color', 'image/depth', 'label'], batch_size,
+        preprocess_fn=preprocess, shuffle=shuffle, num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size,
+        postprocess_fn=standardize, cache=cache)
 
     return images_color, images_depth, labels
@@ -19,12 +19,28 @@ from __future__ import print_function
 
 import os
 import sys
+import json
+import struct
+import fnmatch
+import hashlib
 import tarfile
 
+import numpy as np
 from six.moves import urllib
 import tensorflow as tf
 
+slim = tf.contrib.slim
+
 LABELS_FILENAME = 'labels.txt'
+MANIFEST_FILENAME = 'manifest_%s.json'
+
+# The dtypes that can be used to store tensors with `tensor_features`.
+TENSOR_DTYPES = {
+    'uint8': tf.uint8,
+    'int16': tf.int16,
+    'float16': tf.float16,
+    'float32': tf.float32,
+}
 
 
 def int64_feature(values):
@@ -67,6 +83,134 @@ def bytes_feature(values):
   return tf.train.Feature(bytes_list=tf.train.BytesList(value=[values]))
 
 
+# The JPEG markers of the frames headers (SOF0-SOF15 except DHT, JPG, DAC).
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def image_dims(image_data):
+  """Read the height and width of an encoded JPEG or PNG image.
+
+  Only the header is parsed (the IHDR chunk of a PNG, the SOF segment
+  of a JPEG), the image is not decoded and may still be corrupted.
+
+  Args:
+    image_data: The content of the image file.
+
+  Returns:
+    The height and width of the image.
+
+  Raises:
+    ValueError: If the format is not recognized or the header is invalid.
+  """
+  data = bytearray(image_data)
+  if data[:8] == bytearray(PNG_SIGNATURE):
+    if len(data) < 24 or data[12:16] != bytearray(b'IHDR'):
+      raise ValueError('Invalid PNG header')
+    width, height = struct.unpack('>II', bytes(data[16:24]))
+    return height, width
+
+  if data[:2] != bytearray(b'\xff\xd8'):
+    raise ValueError('Unknown image format')
+  i = 2
+  while i + 4 <= len(data):
+    if data[i] != 0xFF:
+      raise ValueError('Invalid JPEG marker')
+    marker = data[i+1]
+    # Fill bytes, standalone markers (TEM, RST0-RST7) have no length
+    if marker == 0xFF:
+      i += 1
+      continue
+    if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+      i += 2
+      continue
+    if marker in JPEG_SOF_MARKERS:
+      if i + 9 > len(data):
+        break
+      height, width = struct.unpack('>HH', bytes(data[i+5:i+9]))
+      return height, width
+    if marker == 0xDA:
+      # The frame header must come before the scans
+      break
+    length, = struct.unpack('>H', bytes(data[i+2:i+4]))
+    i += 2 + length
+  raise ValueError('No frame header found in the JPEG data')
+
+
+class ImageReader(object):
+  """Decode images with TensorFlow, to check that they're valid.
+
+  The reader has its own graph and session so that each worker process
+  of a conversion can create its own reader. With `image_size`, it can
+  also crop and resize the images like the evaluation preprocessing of
+  `inception_preprocessing` (see `resize`).
+  """
+
+  def __init__(self, channels=3, image_size=None):
+    self.channels = channels
+    self.image_size = image_size
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self._decode_data = tf.placeholder(dtype=tf.string)
+      self._decode = tf.image.decode_image(
+          self._decode_data, channels=channels)
+      if image_size is not None:
+        image = tf.image.convert_image_dtype(self._decode, tf.float32)
+        image.set_shape([None, None, channels])
+        image = tf.image.central_crop(image, central_fraction=0.875)
+        image = tf.image.resize_bilinear(
+            tf.expand_dims(image, 0), [image_size, image_size],
+            align_corners=False)
+        self._resize = tf.image.convert_image_dtype(
+            tf.squeeze(image, [0]), tf.uint8, saturate=True)
+    self.sess = tf.Session(graph=self.graph)
+
+  def read_image_dims(self, image_data):
+    image = self.decode(image_data)
+    return image.shape[0], image.shape[1]
+
+  def decode(self, image_data):
+    image = self.sess.run(self._decode,
+                          feed_dict={self._decode_data: image_data})
+    assert len(image.shape) == 3
+    assert image.shape[2] == self.channels
+    return image
+
+  def resize(self, image_data):
+    """Returns the central crop of an image resized to `image_size`, as
+    a uint8 array [image_size, image_size, channels]."""
+    return self.sess.run(self._resize,
+                         feed_dict={self._decode_data: image_data})
+
+
+# The reader used in the current process, created when it's first needed.
+image_reader = None
+
+
+def read_image_dims(image_data, validate=False):
+  """Get the height and width of an encoded image.
+
+  Args:
+    image_data: The content of the image file.
+    validate: Whether to decode the whole image to check that it's
+      valid, otherwise only the header is read (see `image_dims`).
+      Images whose header cannot be parsed are also decoded.
+
+  Returns:
+    The height and width of the image.
+  """
+  global image_reader
+  if not validate:
+    try:
+      return image_dims(image_data)
+    except ValueError:
+      pass
+  if image_reader is None:
+    image_reader = ImageReader()
+  return image_reader.read_image_dims(image_data)
+
+
 def image_to_tfexample(image_data, image_format, height, width, class_id):
   return tf.train.Example(features=tf.train.Features(feature={
       'image/encoded': bytes_feature(image_data),
@@ -77,6 +221,165 @@ def image_to_tfexample(image_data, image_format, height, width, class_id):
   }))
 
 
+def tensor_features(key, array, dtype='float32'):
+  """Returns TF-Features storing a numpy array as raw bytes.
+
+  This is much more compact and faster to serialize and parse than a
+  `float_feature` with one value per element. The array is stored as
+  little-endian bytes in `key/encoded`, together with its dtype in
+  `key/dtype` and its shape in `key/shape`.
+
+  Args:
+    key: The prefix of the feature keys.
+    array: A numpy array (or anything convertible to one).
+    dtype: The name of the dtype used to store the array, one of
+      `TENSOR_DTYPES`. 'float16' halves the size of float data.
+
+  Returns:
+    A dictionary of TF-Features to be added to a `tf.train.Features`.
+  """
+  assert dtype in TENSOR_DTYPES, 'Unknown dtype %s' % dtype
+  array = np.asarray(array).astype(np.dtype(dtype).newbyteorder('<'))
+  return {
+      key + '/encoded': bytes_feature(array.tobytes()),
+      key + '/dtype': bytes_feature(dtype.encode('ascii')),
+      key + '/shape': int64_feature(list(array.shape)),
+  }
+
+
+def tensor_keys_to_features(key, legacy_key=None):
+  """Returns the `keys_to_features` entries needed by `RawTensor`.
+
+  Args:
+    key: The prefix used in `tensor_features`.
+    legacy_key: The key of the same data stored in the old format (one
+      float per element), or `None` if there's no such data.
+  """
+  keys_to_features = {
+      key + '/encoded': tf.FixedLenFeature((), tf.string, default_value=''),
+      key + '/dtype': tf.FixedLenFeature((), tf.string, default_value=''),
+      key + '/shape': tf.VarLenFeature(tf.int64),
+  }
+  if legacy_key is not None:
+    keys_to_features[legacy_key] = tf.VarLenFeature(tf.float32)
+  return keys_to_features
+
+
+class RawTensor(slim.tfexample_decoder.ItemHandler):
+  """An ItemHandler that decodes tensors written by `tensor_features`.
+
+  The decoded tensor is always cast to float32. Records written in the old
+  format, in which the data is a FloatList under `legacy_key`, are still
+  readable: they're detected by the absence of the dtype feature.
+  """
+
+  def __init__(self, key, shape=None, legacy_key=None):
+    """Initializes the RawTensor handler.
+
+    Args:
+      key: The prefix used in `tensor_features`.
+      shape: The static shape of the tensor. If `None` the shape stored in
+        `key/shape` is used (and the tensor is flattened if there's none).
+      legacy_key: See `tensor_keys_to_features`.
+    """
+    self._key = key
+    self._shape = shape
+    self._legacy_key = legacy_key
+    keys = [key + '/encoded', key + '/dtype', key + '/shape']
+    if legacy_key is not None:
+      keys.append(legacy_key)
+    super(RawTensor, self).__init__(keys)
+
+  def tensors_to_item(self, keys_to_tensors):
+    encoded = keys_to_tensors[self._key + '/encoded']
+    dtype = keys_to_tensors[self._key + '/dtype']
+
+    def _decode_fn(out_type):
+      return lambda: tf.to_float(
+          tf.decode_raw(encoded, out_type, little_endian=True))
+
+    pred_fn_pairs = [(tf.equal(dtype, name), _decode_fn(out_type))
+                     for name, out_type in sorted(TENSOR_DTYPES.items())]
+    if self._legacy_key is not None:
+      legacy_values = keys_to_tensors[self._legacy_key]
+      default = lambda: tf.sparse_tensor_to_dense(legacy_values)
+    else:
+      default = _decode_fn(tf.float32)
+    values = tf.case(pred_fn_pairs, default=default, exclusive=True)
+
+    if self._shape is not None:
+      return tf.reshape(values, self._shape)
+    shape = tf.to_int32(tf.sparse_tensor_to_dense(
+        keys_to_tensors[self._key + '/shape']))
+    shape = tf.cond(tf.size(shape) > 0, lambda: shape, lambda: [-1])
+    return tf.reshape(values, shape)
+
+
+class ScaledImage(slim.tfexample_decoder.ItemHandler):
+  """An ItemHandler that decodes JPEG images at a reduced resolution.
+
+  JPEG images can be decoded directly at 1/2, 1/4 or 1/8 of their size,
+  which is much faster than decoding them fully when they're resized to
+  a small size afterwards anyway. The largest of these factors for which
+  the central crop of the decoded image is still at least `output_size`
+  is chosen for each image. Other formats are fully decoded.
+  """
+
+  # The scale factors supported by the JPEG decoder, the largest first.
+  RATIOS = (8, 4, 2)
+
+  def __init__(self, image_key='image/encoded', format_key='image/format',
+               channels=3, output_size=None, central_fraction=0.875):
+    """Initializes the ScaledImage handler.
+
+    Args:
+      image_key: The name of the TF-Example feature of the encoded image.
+      format_key: The name of the TF-Example feature of the image format.
+      channels: The number of channels of the decoded image.
+      output_size: The size to which the image is resized afterwards, if
+        `None` the images are always decoded at full resolution.
+      central_fraction: The fraction of the image kept by the central crop
+        done before resizing (0.875 in the evaluation preprocessing of
+        `inception_preprocessing`).
+    """
+    self._image_key = image_key
+    self._format_key = format_key
+    self._channels = channels
+    self._output_size = output_size
+    self._central_fraction = central_fraction
+    super(ScaledImage, self).__init__([image_key, format_key])
+
+  def tensors_to_item(self, keys_to_tensors):
+    image_buffer = keys_to_tensors[self._image_key]
+
+    def _decode_jpeg_fn(ratio):
+      return lambda: tf.image.decode_jpeg(
+          image_buffer, channels=self._channels, ratio=ratio)
+
+    def decode_jpeg():
+      if self._output_size is None:
+        return _decode_jpeg_fn(1)()
+      shape = tf.image.extract_jpeg_shape(image_buffer)
+      min_side = tf.minimum(shape[0], shape[1])
+      pred_fn_pairs = []
+      for ratio in self.RATIOS:
+        # The decoder rounds the sizes up.
+        scaled_side = tf.to_float((min_side + ratio - 1) // ratio)
+        pred_fn_pairs.append((
+            scaled_side * self._central_fraction >= self._output_size,
+            _decode_jpeg_fn(ratio)))
+      # The first true predicate gives the largest possible factor.
+      return tf.case(pred_fn_pairs, default=_decode_jpeg_fn(1),
+                     exclusive=False)
+
+    def decode_image():
+      return tf.image.decode_image(image_buffer, channels=self._channels)
+
+    image = tf.cond(tf.image.is_jpeg(image_buffer), decode_jpeg, decode_image)
+    image.set_shape([None, None, self._channels])
+    return image
+
+
 def download_and_uncompress_tarball(tarball_url, dataset_dir):
   """Downloads the `tarball_url` and uncompresses it locally.
 
@@ -148,3 +451,192 @@ def read_label_file(dataset_dir, filename=LABELS_FILENAME):
     index = line.index(':')
     labels_to_class_names[int(line[:index])] = line[index+1:]
   return labels_to_class_names
+
+
+class TFRecordShardWriter(object):
+  """A `TFRecordWriter` that keeps track of what is written to the shard.
+
+  Use it exactly like `tf.python_io.TFRecordWriter`. Once the shard is
+  closed, `stats` gives the information needed by `write_manifest`.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.num_samples = 0
+    self._sha1 = hashlib.sha1()
+    self._writer = tf.python_io.TFRecordWriter(path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
+
+  def write(self, record):
+    """Writes a serialized example to the shard."""
+    self._writer.write(record)
+    self._sha1.update(record)
+    self.num_samples += 1
+
+  def close(self):
+    self._writer.close()
+
+  def stats(self):
+    """Returns a dictionary describing the (closed) shard."""
+    return {
+        'filename': os.path.basename(self.path),
+        'num_samples': self.num_samples,
+        'num_bytes': tf.gfile.Stat(self.path).length,
+        'sha1': self._sha1.hexdigest(),
+    }
+
+
+def write_manifest(dataset_dir, split_name, shards, feature_shapes=None,
+                   filename=MANIFEST_FILENAME):
+  """Writes the manifest of a split next to the labels file.
+
+  Args:
+    dataset_dir: The directory containing the TFRecords of the split.
+    split_name: The name of the split.
+    shards: A list of shard descriptions as given by
+      `TFRecordShardWriter.stats`.
+    feature_shapes: A map from feature keys to the shapes of the stored
+      tensors (`None` for dimensions of varying size).
+    filename: The filename pattern of the manifest, it must contain a
+      '%s' string so that the split name can be inserted.
+  """
+  shards = sorted(shards, key=lambda shard: shard['filename'])
+  checksum = hashlib.sha1()
+  for shard in shards:
+    checksum.update(shard['sha1'].encode())
+  manifest = {
+      'split_name': split_name,
+      'num_samples': sum(shard['num_samples'] for shard in shards),
+      'num_bytes': sum(shard['num_bytes'] for shard in shards),
+      'shards': shards,
+      'feature_shapes': feature_shapes or {},
+      'sha1': checksum.hexdigest(),
+  }
+  manifest_filename = os.path.join(dataset_dir, filename % split_name)
+  with tf.gfile.Open(manifest_filename, 'w') as f:
+    f.write(json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def read_manifest(dataset_dir, split_name, filename=MANIFEST_FILENAME):
+  """Reads the manifest of a split.
+
+  Args:
+    dataset_dir: The directory in which the manifest is found.
+    split_name: The name of the split.
+    filename: The filename pattern of the manifest.
+
+  Returns:
+    The manifest as a dictionary, or `None` if there is no manifest.
+  """
+  manifest_filename = os.path.join(dataset_dir, filename % split_name)
+  if not tf.gfile.Exists(manifest_filename):
+    return None
+  with tf.gfile.Open(manifest_filename, 'r') as f:
+    return json.loads(f.read())
+
+
+def get_num_samples(dataset_dir, split_name, file_pattern):
+  """Returns the number of samples contained in a split.
+
+  The manifest is used when the shards it describes are exactly the ones
+  found in `dataset_dir` (same names and byte sizes). Otherwise we fall
+  back to counting the records, which requires a full read of the split.
+
+  Args:
+    dataset_dir: The directory containing the TFRecords.
+    split_name: The name of the split.
+    file_pattern: The file pattern of the shards, it must contain a '%s'
+      string so that the split name can be inserted.
+
+  Returns:
+    The number of samples of the split.
+  """
+  shard_filenames = sorted(
+      filename for filename in tf.gfile.ListDirectory(dataset_dir)
+      if fnmatch.fnmatch(filename, file_pattern % split_name))
+
+  manifest = read_manifest(dataset_dir, split_name)
+  if manifest is not None:
+    shards = manifest['shards']
+    if ([shard['filename'] for shard in shards] == shard_filenames and
+        all(tf.gfile.Stat(os.path.join(dataset_dir, shard['filename'])).length
+            == shard['num_bytes'] for shard in shards)):
+      return manifest['num_samples']
+    tf.logging.warning(
+        'The manifest of %s does not match the TFRecords found in %s, '
+        'counting the samples instead.', split_name, dataset_dir)
+
+  num_samples = 0
+  for shard_filename in shard_filenames:
+    for _ in tf.python_io.tf_record_iterator(
+        os.path.join(dataset_dir, shard_filename)):
+      num_samples += 1
+  return num_samples
+
+
+def get_tensor_shape(dataset_dir, split_name, file_pattern, key):
+  """Returns the shape of a tensor stored with `tensor_features`.
+
+  The shape is taken from the manifest if there's one. Otherwise we look
+  at the first record of the split, so that TFRecords written without a
+  manifest are still read with the right format.
+
+  Args:
+    dataset_dir: The directory containing the TFRecords.
+    split_name: The name of the split.
+    file_pattern: The file pattern of the shards, it must contain a '%s'
+      string so that the split name can be inserted.
+    key: The prefix used in `tensor_features`.
+
+  Returns:
+    The shape as a list, or `None` if the records don't store `key`.
+  """
+  manifest = read_manifest(dataset_dir, split_name)
+  if manifest is not None:
+    return manifest['feature_shapes'].get(key)
+
+  shard_filenames = sorted(
+      filename for filename in tf.gfile.ListDirectory(dataset_dir)
+      if fnmatch.fnmatch(filename, file_pattern % split_name))
+  for shard_filename in shard_filenames:
+    for record in tf.python_io.tf_record_iterator(
+        os.path.join(dataset_dir, shard_filename)):
+      feature = tf.train.Example.FromString(record).features.feature
+      if key + '/encoded' not in feature:
+        return None
+      return list(feature[key + '/shape'].int64_list.value)
+  return None
+
+
+def verify_manifest(dataset_dir, split_name):
+  """Checks the content of the shards against their checksums.
+
+  Unlike `get_num_samples` this reads the whole split.
+
+  Args:
+    dataset_dir: The directory containing the TFRecords and the manifest.
+    split_name: The name of the split.
+
+  Returns:
+    `True` if every shard of the manifest has the recorded checksum and
+    number of samples, `False` otherwise.
+  """
+  manifest = read_manifest(dataset_dir, split_name)
+  if manifest is None:
+    return False
+  for shard in manifest['shards']:
+    sha1 = hashlib.sha1()
+    num_samples = 0
+    for record in tf.python_io.tf_record_iterator(
+        os.path.join(dataset_dir, shard['filename'])):
+      sha1.update(record)
+      num_samples += 1
+    if (sha1.hexdigest() != shard['sha1'] or
+        num_samples != shard['num_samples']):
+      return False
+  return True
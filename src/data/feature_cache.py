@@ -0,0 +1,215 @@
+"""Store on disk the representations computed by a frozen network.
+
+When only the last layer of a classifier is trained on top of a frozen
+network (a CAE, a fusion auto-encoder...), the representations of the
+inputs never change. They can then be computed once, stored here, and
+the last layer can be trained directly from them.
+
+Each split is stored as two .npy files (representations and labels) that
+are memory-mapped when they're read, and `meta.json` records for each
+split the checkpoint and the configuration used to compute it. A split
+is computed again as soon as one of them changes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import tensorflow as tf
+
+from data.pipeline import load_batch_arrays
+
+slim = tf.contrib.slim
+
+META_FILENAME = 'meta.json'
+
+
+def checkpoint_signature(checkpoint_path):
+    """Returns a string that changes when the checkpoint changes.
+
+    The names and sizes of all the files of the checkpoint are used,
+    as well as the content of the index file (which is small).
+    """
+    sha1 = hashlib.sha1()
+    for filename in sorted(tf.gfile.Glob(checkpoint_path + '*')):
+        sha1.update(os.path.basename(filename).encode('utf-8'))
+        sha1.update(str(tf.gfile.Stat(filename).length).encode('utf-8'))
+        if filename.endswith('.index'):
+            with tf.gfile.Open(filename, 'rb') as f:
+                sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+class FeatureCache(object):
+    """The representations of the splits of a dataset stored in a directory.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.meta_path = os.path.join(cache_dir, META_FILENAME)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'splits': {}}
+
+    def features_path(self, split_name):
+        return os.path.join(self.cache_dir, '%s_features.npy' % split_name)
+
+    def labels_path(self, split_name):
+        return os.path.join(self.cache_dir, '%s_labels.npy' % split_name)
+
+    def is_valid(self, split_name, signature, config):
+        """Whether a split is stored and was computed in the same way.
+
+        Args:
+            split_name: The name of the split.
+            signature: The signature of the checkpoint used to compute
+                the representations (see `checkpoint_signature`).
+            config: A dictionary that can be serialized to JSON describing
+                how the representations are computed.
+        """
+        split = self.meta['splits'].get(split_name)
+        return (split is not None and
+                split['signature'] == signature and
+                split['config'] == json.loads(json.dumps(config)) and
+                os.path.exists(self.features_path(split_name)) and
+                os.path.exists(self.labels_path(split_name)))
+
+    def write(self, split_name, batches, dataset,
+              signature, config, dtype='float32'):
+        """Store the representations of a split.
+
+        Args:
+            split_name: The name of the split.
+            batches: An iterable of pairs (representations, labels) of
+                numpy arrays that contains the whole split exactly once.
+            dataset: The `slim.dataset.Dataset` of the split, its number
+                of samples and label names are used.
+            signature, config: See `is_valid`.
+            dtype: The dtype used to store the representations, 'float16'
+                can be used to halve the size.
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        num_samples = dataset.num_samples
+        features_tmp = self.features_path(split_name) + '.tmp.npy'
+        labels_tmp = self.labels_path(split_name) + '.tmp.npy'
+
+        features_file = labels_file = None
+        count = 0
+        for features, labels in batches:
+            if features_file is None:
+                features_file = np.lib.format.open_memmap(
+                    features_tmp, mode='w+', dtype=dtype,
+                    shape=(num_samples,) + features.shape[1:])
+                labels_file = np.lib.format.open_memmap(
+                    labels_tmp, mode='w+', dtype=np.int64,
+                    shape=(num_samples,))
+            if count + features.shape[0] > num_samples:
+                raise ValueError(
+                    'The split %s contains more than %d samples' %
+                    (split_name, num_samples))
+            features_file[count:count+features.shape[0]] = features
+            labels_file[count:count+features.shape[0]] = labels
+            count += features.shape[0]
+        if count != num_samples:
+            raise ValueError('The split %s contains %d samples, not %d' %
+                             (split_name, count, num_samples))
+
+        features_shape = list(features_file.shape[1:])
+        features_file.flush()
+        labels_file.flush()
+        del features_file, labels_file
+        os.rename(features_tmp, self.features_path(split_name))
+        os.rename(labels_tmp, self.labels_path(split_name))
+
+        labels_to_names = None
+        if dataset.labels_to_names is not None:
+            labels_to_names = {str(label): name for label, name
+                               in dataset.labels_to_names.items()}
+        self.meta['splits'][split_name] = {
+            'signature': signature,
+            'config': config,
+            'num_samples': num_samples,
+            'features_shape': features_shape,
+            'dtype': dtype,
+            'num_classes': dataset.num_classes,
+            'labels_to_names': labels_to_names,
+        }
+        meta_tmp = self.meta_path + '.tmp'
+        with open(meta_tmp, 'w') as f:
+            json.dump(self.meta, f, indent=2, sort_keys=True)
+        os.rename(meta_tmp, self.meta_path)
+
+    def get_split(self, split_name):
+        """Returns a `slim.dataset.Dataset` describing a stored split.
+
+        Only `num_samples`, `num_classes` and `labels_to_names` are
+        meaningful, the data is read with `self.load_batch`.
+        """
+        split = self.meta['splits'][split_name]
+        labels_to_names = None
+        if split['labels_to_names'] is not None:
+            labels_to_names = {int(label): name for label, name
+                               in split['labels_to_names'].items()}
+        return slim.dataset.Dataset(
+            data_sources=self.features_path(split_name),
+            reader=None,
+            decoder=None,
+            num_samples=split['num_samples'],
+            items_to_descriptions={
+                'features': 'Pre-computed representations.',
+                'label': 'A single integer representing the label',
+            },
+            num_classes=split['num_classes'],
+            labels_to_names=labels_to_names)
+
+    def load_batch(self, split_name, batch_size,
+                   shuffle=True, num_epochs=None):
+        """Load batches of representations of a stored split.
+
+        See `load_batch_features`.
+        """
+        features = np.load(self.features_path(split_name), mmap_mode='r')
+        labels = np.load(self.labels_path(split_name), mmap_mode='r')
+        return load_batch_features(
+            features, labels, batch_size,
+            shuffle=shuffle, num_epochs=num_epochs)
+
+
+def load_batch_features(features,
+                        labels,
+                        batch_size,
+                        shuffle=True,
+                        num_epochs=None,
+                        prefetch_batches=2):
+    """Load batches of representations stored in (memory-mapped) arrays.
+
+    Whole batches are read from the arrays at once (see
+    `data.pipeline.load_batch_arrays`), so it's much faster than going
+    through the examples one by one.
+
+    Args:
+        features: An array [num_samples, ...] of representations.
+        labels: An array [num_samples] of labels.
+        batch_size: The number of elements contained in each batch.
+        shuffle: Whether to shuffle the samples at each epoch or not.
+        num_epochs: The number of times we go through the dataset. If
+            `None` the dataset is repeated indefinitely and all the
+            batches are complete, otherwise the last one may be smaller.
+        prefetch_batches: The number of batches prepared in advance.
+
+    Returns:
+        features: A `Tensor` of float32 [batch_size, ...].
+        labels: A `Tensor` of int64 [batch_size].
+    """
+    return load_batch_arrays(
+        [features, labels], batch_size, dtypes=[tf.float32, tf.int64],
+        shuffle=shuffle, num_epochs=num_epochs,
+        prefetch_batches=prefetch_batches)
@@ -8,6 +8,11 @@ Finally all of these subject directories are contained in either the
 
 Put keywords=['depth'] for generating TFRecords of depth images and
 keywords=['color'] to generate TFRecords of color images.
+
+With `image_size`, the images are stored already cropped and resized as
+raw uint8 arrays (the central crop of the evaluation preprocessing), so that
+reading them doesn't require any decoding or resizing. The size and the
+number of channels are recorded in the manifest and in each record.
 """
 
 from __future__ import absolute_import
@@ -15,32 +20,76 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import sys
-import math
 import random
+import functools
 
 import tensorflow as tf
 
 from data import dataset_utils
+from data import parallel_conversion
+
+
+# The reader used to resize images in the current process.
+image_resizer = None
 
 
-class ImageReader(object):
-    """"Used by `convert_dataset` for reading some image information."""
+def resize_image(image_data, image_size, channels):
+    """Decode, crop and resize an image (see `dataset_utils.ImageReader`).
 
-    def __init__(self):
-        self._decode_data = tf.placeholder(dtype=tf.string)
-        self._decode = tf.image.decode_image(self._decode_data, channels=3)
+    Returns:
+        A uint8 array [image_size, image_size, channels].
+    """
+    global image_resizer
+    if (image_resizer is None or image_resizer.image_size != image_size
+            or image_resizer.channels != channels):
+        image_resizer = dataset_utils.ImageReader(
+            channels=channels, image_size=image_size)
+    return image_resizer.resize(image_data)
+
+
+def resized_image_to_tfexample(image, class_id):
+    height, width, _ = image.shape
+    feature = dataset_utils.tensor_features('image/raw', image, 'uint8')
+    feature.update({
+        'image/format': dataset_utils.bytes_feature(b'raw'),
+        'image/class/label': dataset_utils.int64_feature(class_id),
+        'image/height': dataset_utils.int64_feature(height),
+        'image/width': dataset_utils.int64_feature(width),
+    })
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def file_to_tfexample(filename, class_names_to_ids, validate=False,
+                      image_size=None, channels=3):
+    """Convert an image file to a `tf.train.Example`.
 
-    def read_image_dims(self, sess, image_data):
-        image = self.decode(sess, image_data)
-        return image.shape[0], image.shape[1]
+    Args:
+        filename: The path of a png or jpg image.
+        class_names_to_ids: A dictionary from class names (strings) to ids
+            (integers).
+        validate: Whether to decode the image to check it, otherwise
+            its size is read from its header.
+        image_size: If given, the image is stored cropped and resized to
+            this size as a raw uint8 array instead of the encoded file.
+        channels: The number of channels of the resized image.
+
+    Returns:
+        The `tf.train.Example` to be written in TFRecords.
+    """
+    image_data = tf.gfile.FastGFile(filename, 'rb').read()
 
-    def decode(self, sess, image_data):
-        image = sess.run(self._decode,
-                         feed_dict={self._decode_data: image_data})
-        assert len(image.shape) == 3
-        assert image.shape[2] == 3
-        return image
+    class_name = os.path.basename(os.path.dirname(filename))
+    class_id = class_names_to_ids[class_name]
+
+    if image_size is not None:
+        return resized_image_to_tfexample(
+            resize_image(image_data, image_size, channels), class_id)
+
+    height, width = dataset_utils.read_image_dims(image_data, validate)
+    _, ext = os.path.splitext(filename)
+
+    return dataset_utils.image_to_tfexample(
+        image_data, ext, height, width, class_id)
 
 
 def get_filenames_and_classes(dataset_dir, keywords=None, subjects=True):
@@ -128,7 +177,8 @@ def get_tfrecord_filename(split_name, tfrecord_dir, shard_id, num_shards):
 
 
 def convert_dataset(split_name, filenames, class_names_to_ids,
-                    tfrecord_dir, num_shards=5):
+                    tfrecord_dir, num_shards=5, num_workers=None,
+                    validate=False, image_size=None, channels=3):
     """Converts the given filenames to a TFRecord dataset.
 
     Args:
@@ -138,47 +188,26 @@ def convert_dataset(split_name, filenames, class_names_to_ids,
             (integers).
         tfrecord_dir: The directory where the converted datasets are stored.
         num_shards: The number of shards per dataset split
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        validate: Whether to decode every image to check it (see
+            `file_to_tfexample`).
+        image_size, channels: See `file_to_tfexample`.
     """
     assert split_name in ['train', 'validation']
 
-    num_per_shard = int(math.ceil(len(filenames) / float(num_shards)))
-
-    with tf.Graph().as_default():
-        image_reader = ImageReader()
-
-        with tf.Session() as sess:
-
-            for shard_id in range(num_shards):
-                output_filename = get_tfrecord_filename(
-                    split_name, tfrecord_dir, shard_id, num_shards)
-
-                with tf.python_io.TFRecordWriter(output_filename)\
-                        as tfrecord_writer:
-                    start_ndx = shard_id * num_per_shard
-                    end_ndx = min((shard_id+1) * num_per_shard, len(filenames))
-                    for i in range(start_ndx, end_ndx):
-                        sys.stdout.write(
-                            '\r>> Converting image %d/%d shard %s %d' % (
-                                i+1, len(filenames), split_name, shard_id))
-                        sys.stdout.flush()
-
-                        # Read the filename:
-                        image_data = tf.gfile.FastGFile(
-                            filenames[i], 'r').read()
-                        height, width = image_reader.read_image_dims(
-                            sess, image_data)
-
-                        class_name = os.path.basename(
-                            os.path.dirname(filenames[i]))
-                        class_id = class_names_to_ids[class_name]
-                        _, ext = os.path.splitext(filenames[i])
-
-                        example = dataset_utils.image_to_tfexample(
-                            image_data, ext, height, width, class_id)
-                        tfrecord_writer.write(example.SerializeToString())
+    feature_shapes = None
+    if image_size is not None:
+        feature_shapes = {'image/raw': [image_size, image_size, channels]}
 
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    parallel_conversion.convert_dataset_parallel(
+        split_name, filenames,
+        functools.partial(
+            file_to_tfexample, class_names_to_ids=class_names_to_ids,
+            validate=validate, image_size=image_size, channels=channels),
+        get_tfrecord_filename, tfrecord_dir,
+        num_shards=num_shards, num_workers=num_workers,
+        feature_shapes=feature_shapes)
 
 
 def convert_images(dataset_dir,
@@ -187,7 +216,11 @@ def convert_images(dataset_dir,
                    subjects=True,
                    sep='user',
                    num_val_clss=2,
-                   num_shards=5):
+                   num_shards=5,
+                   num_workers=None,
+                   validate=False,
+                   image_size=None,
+                   channels=3):
     """Runs the conversion operation.
 
     Args:
@@ -206,6 +239,15 @@ def convert_images(dataset_dir,
         num_val_clss: Used only when sep=='class', the number of classes
             in validation set.
         num_shards: The number of shards per dataset split.
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        validate: Whether to decode every image to check it, by default
+            only the headers are read to get the sizes of the images.
+        image_size: If given, the images are stored cropped and resized
+            to `image_size` x `image_size` as raw uint8 arrays, it must
+            then be the `image_size` used for training.
+        channels: The number of channels of the stored images when
+            `image_size` is given (ex: 1 for depth images).
     """
     if not tf.gfile.Exists(tfrecord_dir):
         tf.gfile.MakeDirs(tfrecord_dir)
@@ -244,9 +286,15 @@ def convert_images(dataset_dir,
 
     # convert datasets
     convert_dataset('train', training_filenames,
-                    class_names_to_ids, tfrecord_dir, num_shards=num_shards)
+                    class_names_to_ids, tfrecord_dir,
+                    num_shards=num_shards, num_workers=num_workers,
+                    validate=validate, image_size=image_size,
+                    channels=channels)
     convert_dataset('validation', validation_filenames,
-                    class_names_to_ids, tfrecord_dir, num_shards=num_shards)
+                    class_names_to_ids, tfrecord_dir,
+                    num_shards=num_shards, num_workers=num_workers,
+                    validate=validate, image_size=image_size,
+                    channels=channels)
 
     # write the label file
     labels_to_class_names = dict(zip(range(len(class_names)), class_names))
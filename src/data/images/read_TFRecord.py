@@ -2,6 +2,11 @@
 
 The TFRecords can be generated by using `conver_TFRecord.py`.
 We get the `dataset` instance and then load data in batches.
+
+TFRecords converted with `image_size` contain images already cropped and
+resized, they're read without any decoding or resizing (the manifest, or
+the first record if there's no manifest, tells which kind of TFRecords we
+have).
 """
 
 from __future__ import absolute_import
@@ -9,10 +14,10 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import fnmatch
 import tensorflow as tf
 
 from data import dataset_utils
+from data import pipeline
 from nets_base import inception_preprocessing
 
 slim = tf.contrib.slim
@@ -27,7 +32,8 @@ _ITEMS_TO_DESCRIPTIONS = {
 
 
 def get_split_images(split_name, dataset_dir,
-                     file_pattern=None, reader=None, channels=3):
+                     file_pattern=None, reader=None, channels=3,
+                     image_size=None):
     """Gets a `dataset` tuple for reading images.
 
     Args:
@@ -39,6 +45,10 @@ def get_split_images(split_name, dataset_dir,
         reader: The TensorFlow reader type.
         channels: The number of channels contained in the images
             of the output dataset.
+        image_size: The size to which the images are resized afterwards
+            (see `load_batch_images`). If given, JPEG images are decoded
+            at the smallest resolution that is large enough
+            (see `dataset_utils.ScaledImage`).
 
     Returns:
         A `Dataset` namedtuple.
@@ -55,30 +65,43 @@ def get_split_images(split_name, dataset_dir,
         file_pattern = _FILE_PATTERN
 
     # Compute the number of samples contained in the dataset.
-    num_samples = 0
-    tfrecords_to_count = [
-        os.path.join(dataset_dir, file)
-        for file in os.listdir(dataset_dir)
-        if fnmatch.fnmatch(file, file_pattern % split_name)]
-    for tfrecord_file in tfrecords_to_count:
-        for record in tf.python_io.tf_record_iterator(tfrecord_file):
-            num_samples += 1
+    num_samples = dataset_utils.get_num_samples(
+        dataset_dir, split_name, file_pattern)
+
+    # The shape of the images if they were stored already resized.
+    image_shape = dataset_utils.get_tensor_shape(
+        dataset_dir, split_name, file_pattern, 'image/raw')
 
     file_pattern = os.path.join(dataset_dir, file_pattern % split_name)
 
     if reader is None:
         reader = tf.TFRecordReader
 
+    if image_shape is not None and image_shape[2] != channels:
+        raise ValueError(
+            'The images of %s were stored with %d channels, not %d'
+            % (dataset_dir, image_shape[2], channels))
+
     # Create the keys_to_features dictionary for the decoder
     keys_to_features = {
-        'image/encoded': tf.FixedLenFeature((), tf.string),
-        'image/format': tf.FixedLenFeature((), tf.string),
         'image/class/label': tf.FixedLenFeature(
           (), tf.int64, default_value=tf.zeros((), dtype=tf.int64)),
     }
+    if image_shape is None:
+        keys_to_features['image/encoded'] = tf.FixedLenFeature(
+            (), tf.string)
+        keys_to_features['image/format'] = tf.FixedLenFeature(
+            (), tf.string)
+        image_handler = dataset_utils.ScaledImage(
+            channels=channels, output_size=image_size)
+    else:
+        keys_to_features.update(
+            dataset_utils.tensor_keys_to_features('image/raw'))
+        image_handler = dataset_utils.RawTensor(
+            'image/raw', shape=image_shape)
 
     items_to_handlers = {
-        'image': slim.tfexample_decoder.Image(channels=channels),
+        'image': image_handler,
         'label': slim.tfexample_decoder.Tensor('image/class/label'),
     }
 
@@ -96,16 +119,18 @@ def get_split_images(split_name, dataset_dir,
         num_samples=num_samples,
         items_to_descriptions=_ITEMS_TO_DESCRIPTIONS,
         num_classes=len(labels_to_names),
-        labels_to_names=labels_to_names)
+        labels_to_names=labels_to_names,
+        image_shape=image_shape)
 
 
 def load_batch_images(dataset,
                       batch_size=32,
                       height=299,
                       width=299,
-                      common_queue_capacity=800,
-                      common_queue_min=400,
-                      shuffle=True):
+                      shuffle_buffer_size=800,
+                      shuffle=True,
+                      num_epochs=None,
+                      cache=None):
     """Loads a single batch of data.
 
     Args:
@@ -113,34 +138,58 @@ def load_batch_images(dataset,
         batch_size: The number of images in the batch.
         height: The size of each image after preprocessing.
         width: The size of each image after preprocessing.
-        common_queue_capacity, common_queue_min: Decide the shuffle degree.
+        shuffle_buffer_size: Decide the shuffle degree.
         shuffle: Whether to shuffle or not.
+        num_epochs: The number of passes through the dataset, `None`
+            to repeat it indefinitely.
+        cache: If given ('uint8', 'float16' or 'float32'), the cropped
+            images are kept in memory with this dtype after the first
+            epoch (see `pipeline.load_batch`), only the standardization
+            is done again.
 
     Returns:
         images: A `Tensor` of size [batch_size, height, width, channels],
             image samples that have been preprocessed.
         labels: A `Tensor` of size [batch_size], whose values range
             between 0 and `dataset.num_classes`.
+
+    Raises:
+        ValueError: If the images were stored already resized to
+            another size.
     """
-    data_provider = slim.dataset_data_provider.DatasetDataProvider(
-        dataset, common_queue_capacity=common_queue_capacity,
-        common_queue_min=common_queue_min, shuffle=shuffle)
-    image_raw, label = data_provider.get(['image', 'label'])
-
-    # Just for image cropping.
-    image = inception_preprocessing.preprocess_image(
-        image_raw, height, width, is_training=False)
-
-    # image = tf.image.adjust_contrast(image, 10)
-
-    # Z-normalization
-    image = tf.image.per_image_standardization(image)
-
-    # Batch it up.
-    images, labels = tf.train.batch(
-        [image, label],
-        batch_size=batch_size,
-        num_threads=1,
-        capacity=2*batch_size)
+    image_shape = getattr(dataset, 'image_shape', None)
+    if image_shape is not None and image_shape[:2] != [height, width]:
+        raise ValueError(
+            'The images were stored with size %dx%d, not %dx%d'
+            % (image_shape[0], image_shape[1], height, width))
+
+    def preprocess_resized(image, label):
+        # Already cropped and resized, only scale to [-1, 1].
+        image = image * (2. / 255) - 1.
+        return image, label
+
+    def preprocess(image_raw, label):
+        # Just for image cropping.
+        image = inception_preprocessing.preprocess_image(
+            image_raw, height, width, is_training=False)
+
+        # image = tf.image.adjust_contrast(image, 10)
+        return image, label
+
+    def standardize(image, label):
+        # Z-normalization
+        image = tf.image.per_image_standardization(image)
+        return image, label
+
+    if image_shape is None:
+        preprocess_fn = preprocess
+    else:
+        preprocess_fn = preprocess_resized
+
+    images, labels = pipeline.load_batch(
+        dataset, ['image', 'label'], batch_size,
+        preprocess_fn=preprocess_fn, shuffle=shuffle, num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size,
+        postprocess_fn=standardize, cache=cache)
 
     return images, labels
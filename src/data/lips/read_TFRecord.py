@@ -9,10 +9,11 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import fnmatch
 import tensorflow as tf
 
 from data import dataset_utils
+from data import pipeline
+from data import video_preprocessing
 
 slim = tf.contrib.slim
 
@@ -57,14 +58,8 @@ def get_split_lips(split_name,
         file_pattern = _FILE_PATTERN
 
     # Compute the number of samples contained in the dataset.
-    num_samples = 0
-    tfrecords_to_count = [
-        os.path.join(tfrecord_dir, file)
-        for file in os.listdir(tfrecord_dir)
-        if fnmatch.fnmatch(file, file_pattern % split_name)]
-    for tfrecord_file in tfrecords_to_count:
-        for record in tf.python_io.tf_record_iterator(tfrecord_file):
-            num_samples += 1
+    num_samples = dataset_utils.get_num_samples(
+        tfrecord_dir, split_name, file_pattern)
 
     file_pattern = os.path.join(tfrecord_dir, file_pattern % split_name)
 
@@ -72,15 +67,19 @@ def get_split_lips(split_name,
         reader = tf.TFRecordReader
 
     # Create the keys_to_features dictionary for the decoder
-    keys_to_features = {
-        'video/data': tf.FixedLenFeature((60, 80, num_frames), tf.float32),
+    # (TFRecords in the old format with one float per element can
+    # still be read, see `dataset_utils.RawTensor`)
+    keys_to_features = dataset_utils.tensor_keys_to_features(
+        'video/data', legacy_key='video/data')
+    keys_to_features.update({
         'video/label': tf.FixedLenFeature(
           (), tf.int64, default_value=tf.zeros((), dtype=tf.int64)),
-    }
+    })
 
     items_to_handlers = {
-        'video': slim.tfexample_decoder.Tensor(
-            'video/data', shape=(60, 80, num_frames, 1)),
+        'video': dataset_utils.RawTensor(
+            'video/data', shape=(60, 80, num_frames, 1),
+            legacy_key='video/data'),
         'label': slim.tfexample_decoder.Tensor('video/label'),
     }
 
@@ -106,55 +105,36 @@ def get_split_lips(split_name,
 
 def load_batch_lips(dataset,
                     batch_size=32,
-                    common_queue_capacity=800,
-                    common_queue_min=400,
+                    shuffle_buffer_size=800,
                     shuffle=True,
-                    is_training=True):
+                    is_training=True,
+                    num_epochs=None):
     """Loads a single batch of data.
 
     Args:
         dataset: The dataset to load.
         batch_size: The number of videos in the batch.
-        common_queue_capacity, common_queue_min: Decide the shuffle degree.
+        shuffle_buffer_size: Decide the shuffle degree.
         shuffle: Whether to shuffle or not.
         is_training: If `is_training` is `True` apply data augmentation.
+        num_epochs: The number of passes through the dataset, `None`
+            to repeat it indefinitely.
 
     Returns:
         videos: A `Tensor` of size [batch_size, height, width, time_frames, 1].
         labels: A `Tensor` of size [batch_size], whose values range between
             0 and `dataset.num_classes`.
     """
-    data_provider = slim.dataset_data_provider.DatasetDataProvider(
-        dataset, common_queue_capacity=common_queue_capacity,
-        common_queue_min=common_queue_min, shuffle=shuffle)
-    video, label = data_provider.get(['video', 'label'])
-
-    if is_training:
-
-        transformed_images = []
-
-        # Random brightness, random contrast and random cropping but of
-        # the same operations are applied to all the frames of a video
-        delta = tf.random_uniform((), -1, 1)
-        contrast_factor = tf.random_uniform((), 0.2, 1.8)
-        bbox_begin, bbox_end, _ = tf.image.sample_distorted_bounding_box(
-            [60, 80, 1], [[[0, 0, 1, 1]]], area_range=[0.8, 1])
-
-        for i in range(video.get_shape()[2]):
-            image = video[:, :, i, :]
-            image = tf.image.adjust_brightness(image, delta)
-            image = tf.image.adjust_contrast(image, contrast_factor)
-            image = tf.slice(image, bbox_begin, bbox_end)
-            image.set_shape([None, None, 1])
-            image = tf.image.resize_images(image, [60, 80])
-            transformed_images.append(tf.expand_dims(image, 2))
-        video = tf.concat(transformed_images, 2)
-
-    # Batch it up.
-    videos, labels = tf.train.batch(
-        [video, label],
-        batch_size=batch_size,
-        num_threads=1,
-        capacity=2*batch_size)
+    def preprocess(video, label):
+        if is_training:
+            # Random brightness, random contrast and random cropping but of
+            # the same operations are applied to all the frames of a video
+            video = video_preprocessing.distort_video(video)
+        return video, label
+
+    videos, labels = pipeline.load_batch(
+        dataset, ['video', 'label'], batch_size,
+        preprocess_fn=preprocess, shuffle=shuffle, num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size)
 
     return videos, labels
@@ -21,15 +21,15 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import sys
-import math
 import random
+import functools
 
 import numpy as np
 import scipy.signal
 
 import tensorflow as tf
 from data import dataset_utils
+from data import parallel_conversion
 
 
 def parse_mfcc(file_path, feature_len=26, num_frames=24):
@@ -55,11 +55,35 @@ def parse_mfcc(file_path, feature_len=26, num_frames=24):
     return scipy.signal.resample(mfcc, num_frames, axis=1)
 
 
-def to_tfexample(mfcc_data, class_id):
-    return tf.train.Example(features=tf.train.Features(feature={
-        'audio/mfcc': dataset_utils.float_feature(mfcc_data),
-        'audio/label': dataset_utils.int64_feature(class_id)
-    }))
+def to_tfexample(mfcc_data, class_id, dtype='float32'):
+    feature = dataset_utils.tensor_features('audio/mfcc', mfcc_data, dtype)
+    feature['audio/label'] = dataset_utils.int64_feature(class_id)
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def file_to_tfexample(file_path, class_names_to_ids,
+                      feature_len=26, num_frames=24, dtype='float32'):
+    """Convert a htk mfcc ascii file to a `tf.train.Example`.
+
+    Args:
+        file_path: The path of the ascii file.
+        class_names_to_ids: A dictionary from class names (strings) to ids
+            (integers).
+        feature_len: The feature length of each time frame.
+        num_frames: The number of frames of the stored audio.
+        dtype: The dtype used to store the mfcc features, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
+
+    Returns:
+        The `tf.train.Example` to be written in TFRecords.
+    """
+    mfcc_data = parse_mfcc(file_path, feature_len=feature_len,
+                           num_frames=num_frames)
+
+    class_name = os.path.basename(file_path)[0]
+    class_id = class_names_to_ids[class_name]
+
+    return to_tfexample(mfcc_data, class_id, dtype)
 
 
 def get_tfrecord_filename(split_name, tfrecord_dir, shard_id, num_shards):
@@ -74,7 +98,9 @@ def convert_dataset(split_name,
                     tfrecord_dir,
                     num_shards=5,
                     feature_len=26,
-                    num_frames=24):
+                    num_frames=24,
+                    num_workers=None,
+                    dtype='float32'):
     """Converts the given filenames to a TFRecord dataset.
 
     Args:
@@ -88,39 +114,21 @@ def convert_dataset(split_name,
             fixed by the dataset and shouldn't be changed when using
             with AVLetters).
         num_frames: The number of frames of the stored audios.
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        dtype: The dtype used to store the mfcc features, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
     """
     assert split_name in ['train', 'validation']
 
-    num_per_shard = int(math.ceil(len(file_paths)/float(num_shards)))
-
-    with tf.Graph().as_default():
-
-        for shard_id in range(num_shards):
-            output_filename = get_tfrecord_filename(
-                split_name, tfrecord_dir, shard_id, num_shards)
-
-            with tf.python_io.TFRecordWriter(output_filename)\
-                    as tfrecord_writer:
-                start_ndx = shard_id * num_per_shard
-                end_ndx = min((shard_id+1)*num_per_shard, len(file_paths))
-                for i in range(start_ndx, end_ndx):
-                    sys.stdout.write(
-                        '\r>> Converting file %d/%d shard %s %d' % (
-                            i+1, len(file_paths), split_name, shard_id))
-                    sys.stdout.flush()
-
-                    mfccs = parse_mfcc(file_paths[i], feature_len=feature_len,
-                                       num_frames=num_frames)
-                    mfcc_data = list(mfccs.reshape(-1))
-
-                    class_name = os.path.basename(file_paths[i])[0]
-                    class_id = class_names_to_ids[class_name]
-
-                    example = to_tfexample(mfcc_data, class_id)
-                    tfrecord_writer.write(example.SerializeToString())
-
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    parallel_conversion.convert_dataset_parallel(
+        split_name, file_paths,
+        functools.partial(
+            file_to_tfexample, class_names_to_ids=class_names_to_ids,
+            feature_len=feature_len, num_frames=num_frames, dtype=dtype),
+        get_tfrecord_filename, tfrecord_dir,
+        num_shards=num_shards, num_workers=num_workers,
+        feature_shapes={'audio/mfcc': [feature_len, num_frames]})
 
 
 def convert_mfcc(dataset_dir,
@@ -128,7 +136,9 @@ def convert_mfcc(dataset_dir,
                  sep='user',
                  num_shards=5,
                  num_val_samples=None,
-                 num_frames=24):
+                 num_frames=24,
+                 num_workers=None,
+                 dtype='float32'):
     """Runs the conversion operation.
 
     Args:
@@ -143,6 +153,10 @@ def convert_mfcc(dataset_dir,
         num_val_samples: Used only when sep=='mixed', the number of
             samples in validation set.
         num_frames: The number of frames of the stored audios.
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        dtype: The dtype used to store the mfcc features, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
     """
     if not tf.gfile.Exists(tfrecord_dir):
         tf.gfile.MakeDirs(tfrecord_dir)
@@ -174,10 +188,12 @@ def convert_mfcc(dataset_dir,
 
     convert_dataset('train', training_filenames,
                     class_names_to_ids, tfrecord_dir,
-                    num_shards=num_shards, num_frames=num_frames)
+                    num_shards=num_shards, num_frames=num_frames,
+                    num_workers=num_workers, dtype=dtype)
     convert_dataset('validation', validation_filenames,
                     class_names_to_ids, tfrecord_dir,
-                    num_shards=num_shards, num_frames=num_frames)
+                    num_shards=num_shards, num_frames=num_frames,
+                    num_workers=num_workers, dtype=dtype)
 
     labels_to_class_names = dict(zip(range(26), alphabets))
     dataset_utils.write_label_file(labels_to_class_names, tfrecord_dir)
@@ -9,10 +9,10 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import fnmatch
 import tensorflow as tf
 
 from data import dataset_utils
+from data import pipeline
 
 slim = tf.contrib.slim
 
@@ -56,29 +56,28 @@ def get_split_mfcc(split_name,
     if not file_pattern:
         file_pattern = _FILE_PATTERN
 
-    num_samples = 0
-    tfrecords_to_count = [
-        os.path.join(tfrecord_dir, file)
-        for file in os.listdir(tfrecord_dir)
-        if fnmatch.fnmatch(file, file_pattern % split_name)]
-    for tfrecord_file in tfrecords_to_count:
-        for record in tf.python_io.tf_record_iterator(tfrecord_file):
-            num_samples += 1
+    # Compute the number of samples contained in the dataset.
+    num_samples = dataset_utils.get_num_samples(
+        tfrecord_dir, split_name, file_pattern)
 
     file_pattern = os.path.join(tfrecord_dir, file_pattern % split_name)
 
     if reader is None:
         reader = tf.TFRecordReader
 
-    keys_to_features = {
-        'audio/mfcc': tf.FixedLenFeature((26, num_frames), tf.float32),
+    # (TFRecords in the old format with one float per element can
+    # still be read, see `dataset_utils.RawTensor`)
+    keys_to_features = dataset_utils.tensor_keys_to_features(
+        'audio/mfcc', legacy_key='audio/mfcc')
+    keys_to_features.update({
         'audio/label': tf.FixedLenFeature(
           (), tf.int64, default_value=tf.zeros((), dtype=tf.int64)),
-    }
+    })
 
     items_to_handlers = {
-        'mfcc': slim.tfexample_decoder.Tensor(
-            'audio/mfcc', shape=(26, num_frames, 1)),
+        'mfcc': dataset_utils.RawTensor(
+            'audio/mfcc', shape=(26, num_frames, 1),
+            legacy_key='audio/mfcc'),
         'label': slim.tfexample_decoder.Tensor('audio/label'),
     }
 
@@ -104,31 +103,27 @@ def get_split_mfcc(split_name,
 
 def load_batch_mfcc(dataset,
                     batch_size=32,
-                    common_queue_capacity=800,
-                    common_queue_min=400,
-                    shuffle=True):
+                    shuffle_buffer_size=800,
+                    shuffle=True,
+                    num_epochs=None):
     """Loads a single batch of data.
 
     Args:
         dataset: The dataset to load.
         batch_size: The number of audios in the batch.
-        common_queue_capacity, common_queue_min: Decide the shuffle degree.
+        shuffle_buffer_size: Decide the shuffle degree.
         shuffle: Whether to shuffle or not.
+        num_epochs: The number of passes through the dataset, `None`
+            to repeat it indefinitely.
 
     Returns:
         mfccs: A `Tensor` of size [batch_size, feature_len, time_frames, 1].
         labels: A `Tensor` of size [batch_size], whose values range between
             0 and `dataset.num_classes`.
     """
-    data_provider = slim.dataset_data_provider.DatasetDataProvider(
-        dataset, common_queue_capacity=common_queue_capacity,
-        common_queue_min=common_queue_min, shuffle=shuffle)
-    mfcc, label = data_provider.get(['mfcc', 'label'])
-
-    mfccs, labels = tf.train.batch(
-        [mfcc, label],
-        batch_size=batch_size,
-        num_threads=1,
-        capacity=2*batch_size)
+    mfccs, labels = pipeline.load_batch(
+        dataset, ['mfcc', 'label'], batch_size,
+        shuffle=shuffle, num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size)
 
     return mfccs, labels
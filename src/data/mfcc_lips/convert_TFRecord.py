@@ -15,22 +15,58 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import sys
-import math
 import random
+import functools
 
 import tensorflow as tf
 from data import dataset_utils
+from data import parallel_conversion
 from data.mfcc import parse_mfcc
 from data.lips import read_mat
 
 
-def to_tfexample(mfcc_data, video_data, class_id):
-    return tf.train.Example(features=tf.train.Features(feature={
-        'audio/mfcc': dataset_utils.float_feature(mfcc_data),
-        'video/data': dataset_utils.float_feature(video_data),
-        'label': dataset_utils.int64_feature(class_id)
-    }))
+def to_tfexample(mfcc_data, video_data, class_id, dtype='float32'):
+    feature = dataset_utils.tensor_features('audio/mfcc', mfcc_data, dtype)
+    feature.update(
+        dataset_utils.tensor_features('video/data', video_data, dtype))
+    feature['label'] = dataset_utils.int64_feature(class_id)
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def file_pair_to_tfexample(filepath_pair,
+                           class_names_to_ids,
+                           feature_len_audio=26,
+                           num_frames_audio=24,
+                           num_frames_video=12,
+                           dtype='float32'):
+    """Convert a pair of mfcc and .mat video files to a `tf.train.Example`.
+
+    Args:
+        filepath_pair: The paths of the mfcc ascii file and of the
+            .mat video file.
+        class_names_to_ids: A dictionary from class names (strings) to ids
+            (integers).
+        feature_len_audio: The feature length of each time frame.
+        num_frames_audio: The number of frames of the stored audio.
+        num_frames_video: The number of frames of the stored video.
+        dtype: The dtype used to store the data, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
+
+    Returns:
+        The `tf.train.Example` to be written in TFRecords.
+    """
+    audio_path, video_path = filepath_pair
+
+    mfcc_data = parse_mfcc(
+        audio_path,
+        feature_len=feature_len_audio,
+        num_frames=num_frames_audio)
+    video_data = read_mat(video_path, num_frames=num_frames_video)
+
+    class_name = os.path.basename(audio_path)[0]
+    class_id = class_names_to_ids[class_name]
+
+    return to_tfexample(mfcc_data, video_data, class_id, dtype)
 
 
 def get_tfrecord_filename(split_name, tfrecord_dir, shard_id, num_shards):
@@ -46,7 +82,9 @@ def convert_dataset(split_name,
                     num_shards=5,
                     feature_len_audio=26,
                     num_frames_audio=24,
-                    num_frames_video=12):
+                    num_frames_video=12,
+                    num_workers=None,
+                    dtype='float32'):
     """Converts the given filenames to a TFRecord dataset.
 
     Args:
@@ -60,44 +98,23 @@ def convert_dataset(split_name,
             is fixed by the dataset and shouldn't be changed here).
         num_frames_audio: The number of frames of the stored audios.
         num_frames_video: The number of frames of the stored videos.
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        dtype: The dtype used to store the data, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
     """
-    num_per_shard = int(math.ceil(len(filepath_pairs)/float(num_shards)))
-
-    with tf.Graph().as_default():
-
-        for shard_id in range(num_shards):
-            output_filename = get_tfrecord_filename(
-                split_name, tfrecord_dir, shard_id, num_shards)
-
-            with tf.python_io.TFRecordWriter(output_filename)\
-                    as tfrecord_writer:
-                start_ndx = shard_id * num_per_shard
-                end_ndx = min((shard_id+1)*num_per_shard, len(filepath_pairs))
-                for i in range(start_ndx, end_ndx):
-                    sys.stdout.write(
-                        '\r>> Converting file %d/%d shard %s %d' % (
-                            i+1, len(filepath_pairs), split_name, shard_id))
-                    sys.stdout.flush()
-
-                    audio_path = filepath_pairs[i][0]
-                    video_path = filepath_pairs[i][1]
-
-                    mfcc = parse_mfcc(
-                        audio_path,
-                        feature_len=feature_len_audio,
-                        num_frames=num_frames_audio)
-                    mfcc_data = list(mfcc.reshape(-1))
-                    video_data = list(read_mat(
-                        video_path, num_frames=num_frames_video).reshape(-1))
-
-                    class_name = os.path.basename(audio_path)[0]
-                    class_id = class_names_to_ids[class_name]
-
-                    example = to_tfexample(mfcc_data, video_data, class_id)
-                    tfrecord_writer.write(example.SerializeToString())
-
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    parallel_conversion.convert_dataset_parallel(
+        split_name, filepath_pairs,
+        functools.partial(
+            file_pair_to_tfexample, class_names_to_ids=class_names_to_ids,
+            feature_len_audio=feature_len_audio,
+            num_frames_audio=num_frames_audio,
+            num_frames_video=num_frames_video, dtype=dtype),
+        get_tfrecord_filename, tfrecord_dir,
+        num_shards=num_shards, num_workers=num_workers,
+        feature_shapes={
+            'audio/mfcc': [feature_len_audio, num_frames_audio],
+            'video/data': [60, 80, num_frames_video]})
 
 
 def convert_mfcc_lips(dataset_dir_audio,
@@ -106,7 +123,9 @@ def convert_mfcc_lips(dataset_dir_audio,
                       num_shards=5,
                       num_val_samples=100,
                       num_frames_audio=24,
-                      num_frames_video=12):
+                      num_frames_video=12,
+                      num_workers=None,
+                      dtype='float32'):
     """Runs the conversion operation.
 
     Args:
@@ -117,6 +136,10 @@ def convert_mfcc_lips(dataset_dir_audio,
         num_val_samples: The number of samples in 'validation' part.
         num_frames_audio: The number of frames of the stored audios.
         num_frames_video: The number of frames of the stored videos.
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        dtype: The dtype used to store the data, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
     """
     if not tf.gfile.Exists(tfrecord_dir):
         tf.gfile.MakeDirs(tfrecord_dir)
@@ -173,7 +196,8 @@ def convert_mfcc_lips(dataset_dir_audio,
                         tfrecord_dir,
                         num_shards=num_shards,
                         num_frames_audio=num_frames_audio,
-                        num_frames_video=num_frames_video)
+                        num_frames_video=num_frames_video,
+                        num_workers=num_workers, dtype=dtype)
 
     labels_to_class_names = dict(zip(range(26), alphabets))
     dataset_utils.write_label_file(labels_to_class_names, tfrecord_dir)
@@ -9,10 +9,11 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import fnmatch
 import tensorflow as tf
 
 from data import dataset_utils
+from data import pipeline
+from data import video_preprocessing
 
 slim = tf.contrib.slim
 
@@ -54,33 +55,33 @@ def get_split_mfcc_lips(split_name,
     if not file_pattern:
         file_pattern = _FILE_PATTERN
 
-    num_samples = 0
-    tfrecords_to_count = [
-        os.path.join(tfrecord_dir, file)
-        for file in os.listdir(tfrecord_dir)
-        if fnmatch.fnmatch(file, file_pattern % split_name)]
-    for tfrecord_file in tfrecords_to_count:
-        for record in tf.python_io.tf_record_iterator(tfrecord_file):
-            num_samples += 1
+    # Compute the number of samples contained in the dataset.
+    num_samples = dataset_utils.get_num_samples(
+        tfrecord_dir, split_name, file_pattern)
 
     file_pattern = os.path.join(tfrecord_dir, file_pattern % split_name)
 
     if reader is None:
         reader = tf.TFRecordReader
 
-    keys_to_features = {
-        'audio/mfcc': tf.FixedLenFeature((26, num_frames_audio), tf.float32),
-        'video/data': tf.FixedLenFeature(
-            (60, 80, num_frames_video), tf.float32),
+    # (TFRecords in the old format with one float per element can
+    # still be read, see `dataset_utils.RawTensor`)
+    keys_to_features = dataset_utils.tensor_keys_to_features(
+        'audio/mfcc', legacy_key='audio/mfcc')
+    keys_to_features.update(dataset_utils.tensor_keys_to_features(
+        'video/data', legacy_key='video/data'))
+    keys_to_features.update({
         'label': tf.FixedLenFeature(
           (), tf.int64, default_value=tf.zeros((), dtype=tf.int64)),
-    }
+    })
 
     items_to_handlers = {
-        'mfcc': slim.tfexample_decoder.Tensor(
-            'audio/mfcc', shape=(26, num_frames_audio, 1)),
-        'video': slim.tfexample_decoder.Tensor(
-            'video/data', shape=(60, 80, num_frames_video, 1)),
+        'mfcc': dataset_utils.RawTensor(
+            'audio/mfcc', shape=(26, num_frames_audio, 1),
+            legacy_key='audio/mfcc'),
+        'video': dataset_utils.RawTensor(
+            'video/data', shape=(60, 80, num_frames_video, 1),
+            legacy_key='video/data'),
         'label': slim.tfexample_decoder.Tensor('label'),
     }
 
@@ -106,17 +107,20 @@ def get_split_mfcc_lips(split_name,
 
 def load_batch_mfcc_lips(dataset,
                          batch_size=32,
-                         common_queue_capacity=800,
-                         common_queue_min=400,
+                         shuffle_buffer_size=800,
                          shuffle=True,
-                         is_training=True):
+                         is_training=True,
+                         num_epochs=None):
     """Loads a single batch of data.
 
     Args:
         dataset: The dataset to load.
         batch_size: The number of images in the batch.
-        common_queue_capacity, common_queue_min: Decide the shuffle degree.
+        shuffle_buffer_size: Decide the shuffle degree.
         shuffle: Whether to shuffle or not.
+        is_training: If `is_training` is `True` apply data augmentation.
+        num_epochs: The number of passes through the dataset, `None`
+            to repeat it indefinitely.
 
     Returns:
         mfccs: A `Tensor` of size [batch_size, feature_len, time_frames, 1].
@@ -125,34 +129,14 @@ def load_batch_mfcc_lips(dataset,
         labels: A `Tensor` of size [batch_size], whose values range between
             0 and `dataset.num_classes`.
     """
-    data_provider = slim.dataset_data_provider.DatasetDataProvider(
-        dataset, common_queue_capacity=common_queue_capacity,
-        common_queue_min=common_queue_min, shuffle=shuffle)
-    mfcc, video, label = data_provider.get(['mfcc', 'video', 'label'])
-
-    if is_training:
-
-        transformed_images = []
-
-        delta = tf.random_uniform((), -1, 1)
-        contrast_factor = tf.random_uniform((), 0.2, 1.8)
-        bbox_begin, bbox_end, _ = tf.image.sample_distorted_bounding_box(
-            [60, 80, 1], [[[0, 0, 1, 1]]], area_range=[0.8, 1])
-
-        for i in range(video.get_shape()[2]):
-            image = video[:, :, i, :]
-            image = tf.image.adjust_brightness(image, delta)
-            image = tf.image.adjust_contrast(image, contrast_factor)
-            image = tf.slice(image, bbox_begin, bbox_end)
-            image.set_shape([None, None, 1])
-            image = tf.image.resize_images(image, [60, 80])
-            transformed_images.append(tf.expand_dims(image, 2))
-        video = tf.concat(transformed_images, 2)
-
-    mfccs, videos, labels = tf.train.batch(
-        [mfcc, video, label],
-        batch_size=batch_size,
-        num_threads=1,
-        capacity=2*batch_size)
+    def preprocess(mfcc, video, label):
+        if is_training:
+            video = video_preprocessing.distort_video(video)
+        return mfcc, video, label
+
+    mfccs, videos, labels = pipeline.load_batch(
+        dataset, ['mfcc', 'video', 'label'], batch_size,
+        preprocess_fn=preprocess, shuffle=shuffle, num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size)
 
     return mfccs, videos, labels
@@ -12,6 +12,14 @@ However, the dataset is too large (~40G) for this script to work.
 On one hand it's very slow (it takes several hours) and on the other hand
 python will run out of memory. Therefore to do the conversion we may
 need to do it in several times separately.
+
+The sessions are now processed in parallel by several processes (see
+`data/parallel_conversion.py`), each of them only keeping the session it
+is processing in memory. By default the streaming conversion is used:
+the segments are written through a bounded shuffle buffer so that the
+memory usage doesn't grow with the size of the dataset, and if the
+conversion crashes it can be resumed from the last saved session by
+simply running it again.
 """
 
 from __future__ import absolute_import
@@ -19,19 +27,18 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import sys
-import math
-import random
+import functools
 
 import scipy.io
 import imageio
 
 import numpy as np
-import scipy.misc
+import scipy.ndimage
 import scipy.signal
 
 import tensorflow as tf
 from data import dataset_utils
+from data import parallel_conversion
 
 
 def process_session(basename, num_frames=40,
@@ -39,7 +46,8 @@ def process_session(basename, num_frames=40,
     """Preprocess the datafiles of one session.
 
     This includes the segmentation and resampling of intensity
-    and depth videos.
+    and depth videos. Each video is decoded only once, sequentially,
+    and the segments are then sliced from the decoded frames.
 
     Args:
         basename: The basename of the session.
@@ -64,54 +72,121 @@ def process_session(basename, num_frames=40,
     if label_data.shape[1] == 0:
         return None
 
-    color_video = imageio.get_reader(basename + '_color.mp4', 'ffmpeg')
-    depth_video = imageio.get_reader(basename + '_depth.mp4', 'ffmpeg')
+    # Frame numbers are 1-based in the annotations.
+    segments = [(label[0], start_frame[0, 0]-1, end_frame[0, 0]-1)
+                for label, start_frame, end_frame in label_data[0]]
+
+    color_frames, color_positions = read_frames(
+        basename + '_color.mp4', segments, width, height, grayscale)
+    depth_frames, depth_positions = read_frames(
+        basename + '_depth.mp4', segments, width, height, grayscale)
     segmented_data = []
 
-    for i, seg_info in enumerate(label_data[0]):
-        label, start_frame, end_frame = seg_info
+    for label, start_frame, end_frame in segments:
         extracted_color_video = extract_video(
-            color_video, start_frame[0, 0]-1, end_frame[0, 0]-1,
-            width, height, grayscale)
+            color_frames, color_positions, start_frame, end_frame)
         extracted_depth_video = extract_video(
-            depth_video, start_frame[0, 0]-1, end_frame[0, 0]-1,
-            width, height, grayscale)
+            depth_frames, depth_positions, start_frame, end_frame)
+        if extracted_color_video is None or extracted_depth_video is None:
+            continue
         segmented_data.append([
             scipy.signal.resample(extracted_color_video, num_frames, axis=2),
             scipy.signal.resample(extracted_depth_video, num_frames, axis=2),
-            label[0],
+            label,
         ])
     return segmented_data
 
 
-def extract_video(video_data, start_frame, end_frame,
-                  width=100, height=100, grayscale=True):
+def resize_frames(frames, width=100, height=100, grayscale=True):
+    """Resize a batch of frames at once.
+
+    Args:
+        frames: A list of frames of the same size [Height, Width, Channels].
+        width: The width of output frames.
+        height: The height of output frames.
+        grayscale: To convert the frames to grayscale or not.
+
+    Returns:
+        A numpy array of dimension 4 [Frames, Height, Width, Channels].
+    """
+    frames = np.asarray(frames, dtype=np.float32)
+    frames = scipy.ndimage.zoom(
+        frames, (1, height/frames.shape[1], width/frames.shape[2], 1),
+        order=1)
+    if grayscale and frames.shape[3] == 3:
+        # The channel dimension is kept.
+        frames = np.dot(frames, [[0.299], [0.587], [0.114]])
+    return frames
+
+
+def read_frames(filename, segments, width=100, height=100,
+                grayscale=True, chunk_size=64):
+    """Decode the frames used by some segments in one sequential pass.
+
+    Seeking in a video (`get_data` of the imageio reader) is very slow so
+    we rather go through the video once and only keep the frames that
+    belong to at least one segment. They're resized by chunks so that the
+    full-size frames never need to be all kept in memory.
+
+    Args:
+        filename: The path of the video.
+        segments: A list of triples (label, start frame, end frame)
+            where frames are 0-based and the end frame is included.
+        width, height, grayscale: See `resize_frames`.
+        chunk_size: The number of frames that are resized together.
+
+    Returns:
+        frames: A numpy array of dimension 4 [Frames, Height, Width,
+            Channels] containing the used frames in order.
+        positions: A dictionary mapping a frame number to its index
+            in `frames`.
+    """
+    used_frames = set()
+    for _, start_frame, end_frame in segments:
+        used_frames.update(range(start_frame, end_frame+1))
+    last_frame = max(used_frames) if used_frames else -1
+
+    video_reader = imageio.get_reader(filename, 'ffmpeg')
+    chunks, chunk, positions = [], [], {}
+    try:
+        for i, frame in enumerate(video_reader):
+            if i > last_frame:
+                break
+            if i in used_frames:
+                positions[i] = len(positions)
+                chunk.append(frame)
+                if len(chunk) == chunk_size:
+                    chunks.append(
+                        resize_frames(chunk, width, height, grayscale))
+                    chunk = []
+    finally:
+        video_reader.close()
+    if chunk:
+        chunks.append(resize_frames(chunk, width, height, grayscale))
+
+    if not chunks:
+        return None, positions
+    return np.concatenate(chunks), positions
+
+
+def extract_video(frames, positions, start_frame, end_frame):
     """Extract video data from a given frame range.
 
     Args:
-        video_data: An imageio ffmpeg reader instance that contains
-            the video data.
+        frames, positions: The decoded frames as returned by `read_frames`.
         start_frame: The starting frame of the extracted video.
         end_frame: The final frame of the extracted video.
-        width: The width of output video.
-        height: The height of output video.
-        grayscale: To return grayscale video or not.
 
     Returns:
-        A numpy array of dimension 4 [Height, Width, Time frames, Channels]
+        A numpy array of dimension 4 [Height, Width, Time frames, Channels],
+        or `None` if the video doesn't contain the frames (this happens
+        when the annotations go beyond the end of the video).
     """
-    channels = video_data.get_data(0).shape[2]
-    extracted_video = np.empty(
-        (width, height, end_frame-start_frame+1, channels))
-    for i in range(start_frame, end_frame+1):
-        extracted_video[:, :, i-start_frame, :] = \
-            scipy.misc.imresize(video_data.get_data(i), (100, 100))
-    if grayscale and channels == 3:
-        extracted_video = (
-            0.299 * extracted_video[:, :, :, 0]
-            + 0.587 * extracted_video[:, :, :, 1]
-            + 0.114 * extracted_video[:, :, :, 2])
-    return extracted_video
+    if start_frame not in positions or end_frame not in positions:
+        return None
+    # All the frames of the range are kept so they're contiguous.
+    extracted_video = frames[positions[start_frame]:positions[end_frame]+1]
+    return np.transpose(extracted_video, (1, 2, 0, 3))
 
 
 class_names = [
@@ -125,53 +200,109 @@ class_names_to_ids = dict(zip(class_names, range(1, 21)))
 labels_to_class_names = dict(zip(range(1, 21), class_names))
 
 
-def to_tfexample(color_video, depth_video, class_id):
-    return tf.train.Example(features=tf.train.Features(feature={
-        'video/color/data': dataset_utils.float_feature(list(color_video)),
-        'video/color/shape': dataset_utils.float_feature(color_video.shape),
-        'video/depth/data': dataset_utils.float_feature(list(depth_video)),
-        'video/depth/shape': dataset_utils.float_feature(depth_video.shape),
-        'video/label': dataset_utils.int64_feature(class_id),
-    }))
+def to_tfexample(color_video, depth_video, class_id, dtype='float32'):
+    feature = dataset_utils.tensor_features(
+        'video/color', color_video, dtype)
+    feature.update(dataset_utils.tensor_features(
+        'video/depth', depth_video, dtype))
+    feature['video/label'] = dataset_utils.int64_feature(class_id)
+    return tf.train.Example(features=tf.train.Features(feature=feature))
 
 
-def get_tfrecord_filename(split_name, tfrecord_dir, shard_id, num_shards):
-    output_filename = 'montalbano_%s_%d-of-%d.tfrecord' % (
-        split_name, shard_id, num_shards)
-    return os.path.join(tfrecord_dir, output_filename)
+def session_to_tfexamples(basename, num_frames=40, width=100,
+                          height=100, grayscale=True, dtype='float32'):
+    """Convert all the gestures of a session to `tf.train.Example`.
 
+    Args:
+        basename: The basename of the session.
+        num_frames, width, height, grayscale: See `process_session`.
+        dtype: The dtype used to store the videos, 'float32' or
+            'float16' (see `dataset_utils.tensor_features`).
 
-def convert_dataset(split_name,
-                    data_triples,
-                    tfrecord_dir,
-                    num_shards=10):
+    Returns:
+        A list of `tf.train.Example`, or `None` if the session cannot
+        be used.
+    """
+    processed_data = process_session(
+        basename, num_frames, width, height, grayscale)
+    if processed_data is None:
+        return None
+    return [to_tfexample(color_video, depth_video,
+                         class_names_to_ids[class_name], dtype)
+            for color_video, depth_video, class_name in processed_data]
 
-    num_per_shard = int(math.ceil(len(data_triples)/float(num_shards)))
 
-    with tf.Graph().as_default():
+def session_cost(basename):
+    """Estimate the conversion cost of a session by the video sizes."""
+    return parallel_conversion.estimate_cost(
+        [basename + '_color.mp4', basename + '_depth.mp4'])
 
-        for shard_id in range(num_shards):
-            output_filename = get_tfrecord_filename(
-                split_name, tfrecord_dir, shard_id, num_shards)
 
-            with tf.python_io.TFRecordWriter(output_filename)\
-                    as tfrecord_writer:
-                start_ndx = shard_id * num_per_shard
-                end_ndx = min((shard_id+1)*num_per_shard, len(data_triples))
-                for i in range(start_ndx, end_ndx):
-                    sys.stdout.write(
-                        '\r>> Converting data instance %d/%d shard %s %d' % (
-                            i+1, len(data_triples), split_name, shard_id))
-                    sys.stdout.flush()
+def get_session_basenames(dataset_dir, first_session, last_session):
+    """Returns the basenames of sessions `first_session`...`last_session`."""
+    return [os.path.join(dataset_dir,
+                         'Sample' + '{:5d}'.format(i).replace(' ', '0'))
+            for i in range(first_session, last_session+1)]
 
-                    color_video, depth_video, class_name = data_triples[i]
-                    class_id = class_names_to_ids[class_name]
 
-                    example = to_tfexample(color_video, depth_video, class_id)
-                    tfrecord_writer.write(example.SerializeToString())
+def get_tfrecord_filename(split_name, tfrecord_dir, shard_id, num_shards):
+    output_filename = 'montalbano_%s_%d-of-%d.tfrecord' % (
+        split_name, shard_id, num_shards)
+    return os.path.join(tfrecord_dir, output_filename)
 
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+
+def convert_dataset(split_name,
+                    basenames,
+                    tfrecord_dir,
+                    num_shards=10,
+                    width=100,
+                    height=100,
+                    num_frames=40,
+                    grayscale=True,
+                    num_workers=None,
+                    streaming=True,
+                    buffer_size=256,
+                    sessions_per_part=20,
+                    dtype='float32'):
+    """Converts the given sessions to a TFRecord dataset.
+
+    Args:
+        split_name: The name of the dataset, either 'train' or 'validation'.
+        basenames: A list of session basenames.
+        tfrecord_dir: The directory where the converted datasets are stored.
+        num_shards: The number of shards per dataset split.
+        width, height, num_frames, grayscale: See `process_session`.
+        num_workers: The number of processes used for the conversion,
+            `None` to use all the cores.
+        streaming: Whether to use the streaming conversion (see
+            `parallel_conversion.convert_dataset_streaming`) or to let
+            each process write its own shard.
+        buffer_size: The number of segments kept in the shuffle buffer
+            for the streaming conversion.
+        sessions_per_part: The number of sessions between two saves of
+            the progress for the streaming conversion.
+        dtype: See `session_to_tfexamples`. Storing the videos in
+            float16 halves the size of the dataset.
+    """
+    session_fn = functools.partial(
+        session_to_tfexamples, num_frames=num_frames,
+        width=width, height=height, grayscale=grayscale, dtype=dtype)
+    video_shape = [height, width, num_frames, 1 if grayscale else 3]
+    feature_shapes = {'video/color': video_shape, 'video/depth': video_shape}
+
+    if streaming:
+        parallel_conversion.convert_dataset_streaming(
+            split_name, basenames, session_fn,
+            get_tfrecord_filename, tfrecord_dir,
+            num_shards=num_shards, num_workers=num_workers,
+            buffer_size=buffer_size, items_per_part=sessions_per_part,
+            feature_shapes=feature_shapes)
+    else:
+        parallel_conversion.convert_dataset_parallel(
+            split_name, basenames, session_fn,
+            get_tfrecord_filename, tfrecord_dir,
+            num_shards=num_shards, num_workers=num_workers,
+            cost_fn=session_cost, feature_shapes=feature_shapes)
 
 
 def convert_montalbano(dataset_dir_train,
@@ -180,44 +311,31 @@ def convert_montalbano(dataset_dir_train,
                        num_shards=10,
                        width=100,
                        height=100,
-                       num_frames=40, grayscale=True):
+                       num_frames=40,
+                       grayscale=True,
+                       num_workers=None,
+                       streaming=True,
+                       buffer_size=256,
+                       dtype='float32'):
 
     if not tf.gfile.Exists(tfrecord_dir):
         tf.gfile.MakeDirs(tfrecord_dir)
 
-    training_data = []
-
-    for i in range(1, 404):
-        basename = os.path.join(
-            dataset_dir_train,
-            'Sample' + '{:5d}'.format(i).replace(' ', '0'))
-        sys.stdout.write('\r >> Processing training session %d/403' % i)
-        sys.stdout.flush()
-        processed_data = process_session(
-            basename, num_frames, width, height, grayscale)
-        if processed_data is not None:
-            training_data.extend(processed_data)
-    sys.stdout.write('\n>> Shuffling training session data\n')
-    sys.stdout.flush()
-    random.shuffle(training_data)
-    convert_dataset('train', training_data, tfrecord_dir, num_shards)
-
-    validation_data = []
-
-    for i in range(410, 711):
-        basename = os.path.join(
-            dataset_dir_validation,
-            'Sample' + '{:5d}'.format(i).replace(' ', '0'))
-        sys.stdout.write('\r >> Processing validation session %d/301' % i-410)
-        sys.stdout.flush()
-        processed_data = process_session(
-            basename, num_frames, width, height)
-        if processed_data is not None:
-            validation_data.extend(processed_data)
-    sys.stdout.write('\n>> Shuffling validation_data session data\n')
-    sys.stdout.flush()
-    random.shuffle(validation_data)
-    convert_dataset('validation', validation_data, tfrecord_dir, num_shards)
+    convert_dataset('train',
+                    get_session_basenames(dataset_dir_train, 1, 403),
+                    tfrecord_dir, num_shards=num_shards,
+                    width=width, height=height, num_frames=num_frames,
+                    grayscale=grayscale, num_workers=num_workers,
+                    streaming=streaming, buffer_size=buffer_size,
+                    dtype=dtype)
+
+    convert_dataset('validation',
+                    get_session_basenames(dataset_dir_validation, 410, 710),
+                    tfrecord_dir, num_shards=num_shards,
+                    width=width, height=height, num_frames=num_frames,
+                    grayscale=grayscale, num_workers=num_workers,
+                    streaming=streaming, buffer_size=buffer_size,
+                    dtype=dtype)
 
     dataset_utils.write_label_file(labels_to_class_names, tfrecord_dir)
     print('\nFinished converting dataset!')
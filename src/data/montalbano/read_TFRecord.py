@@ -9,10 +9,11 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import fnmatch
 import tensorflow as tf
 
 from data import dataset_utils
+from data import pipeline
+from data import video_preprocessing
 
 slim = tf.contrib.slim
 
@@ -34,34 +35,31 @@ def get_split_montalbano(split_name,
     if not file_pattern:
         file_pattern = _FILE_PATTERN
 
-    num_samples = 0
-    tfrecords_to_count = [
-        os.path.join(tfrecord_dir, file)
-        for file in os.listdir(tfrecord_dir)
-        if fnmatch.fnmatch(file, file_pattern % split_name)]
-    for tfrecord_file in tfrecords_to_count:
-        for record in tf.python_io.tf_record_iterator(tfrecord_file):
-            num_samples += 1
+    # Compute the number of samples contained in the dataset.
+    num_samples = dataset_utils.get_num_samples(
+        tfrecord_dir, split_name, file_pattern)
 
     file_pattern = os.path.join(tfrecord_dir, file_pattern % split_name)
 
     if reader is None:
         reader = tf.TFRecordReader
 
-    keys_to_features = {
-        'video/color/data': tf.VarLenFeature(tf.float32),
-        'video/color/shape': tf.FixedLenFeature([4], tf.int64),
-        'video/depth/data': tf.VarLenFeature(tf.float32),
-        'video/depth/shape': tf.FixedLenFeature([4], tf.int64),
+    # The old format (one float per element in 'video/*/data') shares
+    # the shape key with the new one so both can be read.
+    keys_to_features = dataset_utils.tensor_keys_to_features(
+        'video/color', legacy_key='video/color/data')
+    keys_to_features.update(dataset_utils.tensor_keys_to_features(
+        'video/depth', legacy_key='video/depth/data'))
+    keys_to_features.update({
         'video/label': tf.FixedLenFeature(
           (), tf.int64, default_value=tf.zeros((), dtype=tf.int64)),
-    }
+    })
 
     items_to_handlers = {
-        'color': slim.tfexample_decoder.Tensor(
-            'video/color/data', shape_key='video/color/shape'),
-        'depth': slim.tfexample_decoder.Tensor(
-            'video/depth/data', shape_key='video/depth/shape'),
+        'color': dataset_utils.RawTensor(
+            'video/color', legacy_key='video/color/data'),
+        'depth': dataset_utils.RawTensor(
+            'video/depth', legacy_key='video/depth/data'),
         'label': slim.tfexample_decoder.Tensor('video/label'),
     }
 
@@ -87,37 +85,18 @@ def get_split_montalbano(split_name,
 
 def load_batch_montalbano(dataset,
                           batch_size=32,
-                          common_queue_capacity=800,
-                          common_queue_min=400,
-                          shuffle=True):
-
-    data_provider = slim.dataset_data_provider.DatasetDataProvider(
-        dataset, common_queue_capacity=common_queue_capacity,
-        common_queue_min=common_queue_min, shuffle=shuffle)
-    color_video, depth_video, label = \
-        data_provider.get(['color', 'depth', 'label'])
-
-    transformed_color_images = []
-
-    for i in range(color_video.get_shape()[2]):
-        color_image = color_video[:, :, i, :]
-        color_image = tf.image.per_image_standardization(color_image)
-        transformed_color_images.append(tf.expand_dims(color_image, 2))
-    color_video = tf.concat(transformed_color_images, 2)
-
-    transformed_depth_images = []
-
-    for i in range(depth_video.get_shape()[2]):
-        depth_image = depth_video[:, :, i, :]
-        depth_image = tf.image.per_image_standardization(depth_image)
-        transformed_depth_images.append(tf.expand_dims(depth_image, 2))
-    depth_video = tf.concat(transformed_depth_images, 2)
-
-    # Batch it up.
-    color_videos, depth_videos, labels = tf.train.batch(
-        [color_video, depth_video, label],
-        batch_size=batch_size,
-        num_threads=1,
-        capacity=2*batch_size)
+                          shuffle_buffer_size=800,
+                          shuffle=True,
+                          num_epochs=None):
+
+    def preprocess(color_video, depth_video, label):
+        color_video = video_preprocessing.standardize_frames(color_video)
+        depth_video = video_preprocessing.standardize_frames(depth_video)
+        return color_video, depth_video, label
+
+    color_videos, depth_videos, labels = pipeline.load_batch(
+        dataset, ['color', 'depth', 'label'], batch_size,
+        preprocess_fn=preprocess, shuffle=shuffle, num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size)
 
     return color_videos, depth_videos, labels
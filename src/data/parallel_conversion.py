@@ -0,0 +1,470 @@
+"""A parallel driver for the conversion of datasets to TFRecords.
+
+The conversion scripts of the different datasets only need to give a
+function that turns one item of the dataset (a file path, a pair of file
+paths, a session...) into `tf.train.Example` instances. Each shard is then
+written by a worker process and the progress of all the workers is shown
+in the main process. When there are more workers than shards, each shard
+is written in several parts (one file per part) so that all the cores are
+used whatever the number of shards.
+
+Items are distributed over the shards according to their estimated cost
+(by default the size of the files they refer to) so that all the workers
+finish at approximately the same time. If a worker process dies (killed,
+out of memory...) the conversion is stopped with an error.
+
+The conversion function must be picklable, which means that it should be
+defined at the top level of a module (`functools.partial` can be used to
+fix some of its arguments). It's called in the worker processes so it
+shouldn't rely on any `tf.Session` created in the main process.
+
+For very large datasets `convert_dataset_streaming` can be used instead.
+The items are then converted in parallel but written by the main process
+through a bounded shuffle buffer, and the conversion can be resumed after
+a crash.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import heapq
+import random
+import collections
+import multiprocessing
+
+import six
+from six.moves import queue
+import tensorflow as tf
+
+from data import dataset_utils
+
+
+def estimate_cost(item):
+    """Estimate the conversion cost of an item by the size of its files.
+
+    Args:
+        item: A file path or a list/tuple of file paths.
+
+    Returns:
+        The total size in bytes of the files that are found.
+    """
+    paths = item if isinstance(item, (list, tuple)) else [item]
+    return sum(os.path.getsize(path) for path in paths
+               if isinstance(path, six.string_types)
+               and os.path.isfile(path))
+
+
+def balance_items(items, num_shards, cost_fn=None):
+    """Distribute items over shards so that the shards have similar costs.
+
+    The most expensive items are distributed first, each of them being
+    put in the shard with the smallest total cost at that time. The order
+    of the items within each shard is then randomized.
+
+    Args:
+        items: The list of items to convert.
+        num_shards: The number of shards.
+        cost_fn: A function giving the estimated cost of an item. If
+            `None` use `estimate_cost`.
+
+    Returns:
+        A list of `num_shards` lists of items.
+    """
+    if cost_fn is None:
+        cost_fn = estimate_cost
+    costs = [cost_fn(item) for item in items]
+    order = sorted(range(len(items)), key=lambda i: costs[i], reverse=True)
+
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0, shard_id) for shard_id in range(num_shards)]
+    for i in order:
+        load, shard_id = heapq.heappop(loads)
+        shards[shard_id].append(items[i])
+        heapq.heappush(loads, (load+costs[i], shard_id))
+
+    for shard in shards:
+        random.shuffle(shard)
+    return shards
+
+
+def examples_of(to_example_fn, item):
+    """Call the conversion function and always return a list of examples.
+
+    The conversion function may return a single `tf.train.Example`,
+    a list of them or `None` if the item should be skipped.
+    """
+    examples = to_example_fn(item)
+    if examples is None:
+        return []
+    if isinstance(examples, tf.train.Example):
+        return [examples]
+    return examples
+
+
+def part_filename(get_tfrecord_filename, split_name, tfrecord_dir,
+                  shard_id, num_shards, part_id):
+    """The path of a part of a shard ('<shard>-part00000.tfrecord')."""
+    shard_filename = get_tfrecord_filename(
+        split_name, tfrecord_dir, shard_id, num_shards)
+    base, ext = os.path.splitext(shard_filename)
+    return '%s-part%05d%s' % (base, part_id, ext)
+
+
+def start_pool(num_workers):
+    """Start a pool of processes.
+
+    Returns:
+        The pool and the set of the pids of its workers.
+    """
+    children = set(child.pid for child in multiprocessing.active_children())
+    pool = multiprocessing.Pool(num_workers)
+    worker_pids = set(
+        child.pid for child in multiprocessing.active_children()) - children
+    return pool, worker_pids
+
+
+def check_workers(worker_pids):
+    """Raise an error if a worker of the pool has died.
+
+    The task of a worker that is killed is lost and its result would be
+    waited for indefinitely.
+    """
+    alive = set(child.pid for child in multiprocessing.active_children())
+    if not worker_pids <= alive:
+        raise RuntimeError(
+            'A conversion worker died unexpectedly (killed or out of memory)')
+
+
+def wait_for_result(result, worker_pids, timeout=1):
+    """Get the result of a task, checking regularly that the workers
+    are still alive."""
+    while not result.ready():
+        result.wait(timeout)
+        if not result.ready():
+            check_workers(worker_pids)
+    return result.get()
+
+
+def convert_shard(to_example_fn, items, output_filename, progress_queue):
+    """Convert a list of items and write them to a shard.
+
+    This is run by the worker processes.
+
+    Args:
+        to_example_fn: The conversion function of the dataset.
+        items: The items to be written to this shard.
+        output_filename: The path of the shard.
+        progress_queue: A queue used to tell the main process that
+            an item has been converted.
+
+    Returns:
+        The shard description given by `TFRecordShardWriter.stats`.
+    """
+    with dataset_utils.TFRecordShardWriter(
+            output_filename) as tfrecord_writer:
+        for item in items:
+            for example in examples_of(to_example_fn, item):
+                tfrecord_writer.write(example.SerializeToString())
+            progress_queue.put(1)
+    return tfrecord_writer.stats()
+
+
+def convert_dataset_parallel(split_name,
+                             items,
+                             to_example_fn,
+                             get_tfrecord_filename,
+                             tfrecord_dir,
+                             num_shards=5,
+                             num_workers=None,
+                             cost_fn=None,
+                             feature_shapes=None):
+    """Convert a split of a dataset to TFRecords with several processes.
+
+    The manifest of the split is written at the end
+    (see `dataset_utils.write_manifest`).
+
+    Args:
+        split_name: The name of the split.
+        items: A list of items to convert.
+        to_example_fn: A function that takes an item and returns a
+            `tf.train.Example`, a list of them or `None`.
+        get_tfrecord_filename: The function giving the path of a shard
+            from `split_name`, `tfrecord_dir`, the shard id and `num_shards`.
+        tfrecord_dir: The directory where the TFRecords are stored.
+        num_shards: The number of shards. If it's smaller than
+            `num_workers`, each shard is written in several parts.
+        num_workers: The number of worker processes, if `None` we use
+            as many processes as cores.
+        cost_fn: A function giving the estimated cost of an item
+            (see `balance_items`).
+        feature_shapes: Passed to `dataset_utils.write_manifest`.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    # The work is not bounded by the number of shards: each shard is cut
+    # in as many parts as necessary to give at least one part per worker.
+    num_parts = -(-num_workers // num_shards)
+    if num_parts == 1:
+        filenames = [
+            get_tfrecord_filename(
+                split_name, tfrecord_dir, shard_id, num_shards)
+            for shard_id in range(num_shards)]
+    else:
+        filenames = [
+            part_filename(get_tfrecord_filename, split_name, tfrecord_dir,
+                          shard_id, num_shards, part_id)
+            for shard_id in range(num_shards)
+            for part_id in range(num_parts)]
+    shards = balance_items(items, len(filenames), cost_fn)
+
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+    pool, worker_pids = start_pool(num_workers)
+
+    try:
+        results = [
+            pool.apply_async(convert_shard, (
+                to_example_fn, shard_items, filename, progress_queue))
+            for filename, shard_items in zip(filenames, shards)]
+        pool.close()
+
+        num_converted = 0
+        while num_converted < len(items):
+            try:
+                num_converted += progress_queue.get(timeout=1)
+            except queue.Empty:
+                # Re-raise the exception if some worker failed.
+                for result in results:
+                    if result.ready() and not result.successful():
+                        result.get()
+                check_workers(worker_pids)
+                continue
+            sys.stdout.write('\r>> Converting item %d/%d split %s' % (
+                num_converted, len(items), split_name))
+            sys.stdout.flush()
+
+        shard_stats = [wait_for_result(result, worker_pids)
+                       for result in results]
+        pool.join()
+
+    finally:
+        pool.terminate()
+        manager.shutdown()
+
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+    dataset_utils.write_manifest(
+        tfrecord_dir, split_name, shard_stats, feature_shapes=feature_shapes)
+
+
+def serialize_examples(to_example_fn, item):
+    """Convert an item and serialize the examples in a worker process."""
+    return [example.SerializeToString()
+            for example in examples_of(to_example_fn, item)]
+
+
+class StreamingShardWriter(object):
+    """Write serialized examples to shards through a bounded shuffle buffer.
+
+    Each example leaving the buffer is written to a randomly chosen shard.
+    The buffer is a reservoir: once it's full, every new example replaces
+    a randomly chosen one which is then written. The examples can thus be
+    mixed with examples coming from up to `buffer_size` examples before
+    without ever keeping more than that in memory.
+
+    Shards are written in successive parts (one file per shard and per
+    part) so that a part, once closed, is never modified again.
+    """
+
+    def __init__(self, split_name, get_tfrecord_filename,
+                 tfrecord_dir, num_shards, buffer_size):
+        self.split_name = split_name
+        self.get_tfrecord_filename = get_tfrecord_filename
+        self.tfrecord_dir = tfrecord_dir
+        self.num_shards = num_shards
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.writers = None
+
+    def part_filename(self, shard_id, part_id):
+        return part_filename(
+            self.get_tfrecord_filename, self.split_name, self.tfrecord_dir,
+            shard_id, self.num_shards, part_id)
+
+    def open_part(self, part_id):
+        self.writers = [
+            dataset_utils.TFRecordShardWriter(
+                self.part_filename(shard_id, part_id))
+            for shard_id in range(self.num_shards)]
+
+    def remove_part(self, part_id):
+        """Remove a part that may have been left incomplete by a crash."""
+        for shard_id in range(self.num_shards):
+            filename = self.part_filename(shard_id, part_id)
+            if tf.gfile.Exists(filename):
+                tf.gfile.Remove(filename)
+
+    def remove_all_parts(self):
+        """Remove the parts left by a previous conversion of the split."""
+        for shard_id in range(self.num_shards):
+            shard_filename = self.get_tfrecord_filename(
+                self.split_name, self.tfrecord_dir, shard_id,
+                self.num_shards)
+            base, ext = os.path.splitext(shard_filename)
+            for filename in tf.gfile.Glob('%s-part*%s' % (base, ext)):
+                tf.gfile.Remove(filename)
+
+    def write_to_random_shard(self, record):
+        random.choice(self.writers).write(record)
+
+    def write(self, record):
+        if len(self.buffer) < self.buffer_size:
+            self.buffer.append(record)
+        else:
+            i = random.randrange(len(self.buffer))
+            self.write_to_random_shard(self.buffer[i])
+            self.buffer[i] = record
+
+    def close_part(self):
+        """Flush the buffer and close the current part.
+
+        Returns:
+            The descriptions of the files of the part.
+        """
+        random.shuffle(self.buffer)
+        for record in self.buffer:
+            self.write_to_random_shard(record)
+        self.buffer = []
+        for writer in self.writers:
+            writer.close()
+        stats = [writer.stats() for writer in self.writers]
+        self.writers = None
+        return stats
+
+
+def convert_dataset_streaming(split_name,
+                              items,
+                              to_example_fn,
+                              get_tfrecord_filename,
+                              tfrecord_dir,
+                              num_shards=10,
+                              num_workers=None,
+                              buffer_size=256,
+                              items_per_part=20,
+                              feature_shapes=None):
+    """Convert a split of a large dataset with a bounded memory usage.
+
+    The order of the items is first randomized. Items are converted by
+    `num_workers` processes, with at most two items per process being
+    converted or waiting to be written at any time, and the examples are
+    written through a `StreamingShardWriter`. The peak memory usage
+    therefore depends on `buffer_size` and the size of an item but not
+    on the size of the dataset.
+
+    Every `items_per_part` items the buffer is flushed, the current part of
+    the shards is closed and the progress is saved in a state file. If the
+    conversion is interrupted, calling this function again with the same
+    arguments resumes it from the last saved state (the state file is
+    removed once the manifest is written).
+
+    Args:
+        split_name, items, to_example_fn, get_tfrecord_filename,
+            tfrecord_dir, num_shards, feature_shapes:
+            See `convert_dataset_parallel`.
+        num_workers: The number of worker processes, if `None` we use
+            as many processes as cores.
+        buffer_size: The number of examples kept in the shuffle buffer.
+        items_per_part: The number of items converted between two saves
+            of the progress.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    state_filename = os.path.join(
+        tfrecord_dir, 'conversion_state_%s.json' % split_name)
+    writer = StreamingShardWriter(
+        split_name, get_tfrecord_filename, tfrecord_dir,
+        num_shards, buffer_size)
+    if tf.gfile.Exists(state_filename):
+        with tf.gfile.Open(state_filename, 'r') as f:
+            state = json.loads(f.read())
+        tf.logging.info('Resuming the conversion of %s after %d/%d items',
+                        split_name, state['num_converted'], len(items))
+    else:
+        # The parts of an earlier conversion would be read with the new
+        # ones though they're not in the manifest.
+        writer.remove_all_parts()
+        order = list(range(len(items)))
+        random.shuffle(order)
+        state = {'order': order, 'num_converted': 0,
+                 'part_id': 0, 'shards': []}
+
+    writer.remove_part(state['part_id'])
+    writer.open_part(state['part_id'])
+
+    def save_state():
+        tmp_filename = state_filename + '.tmp'
+        with tf.gfile.Open(tmp_filename, 'w') as f:
+            f.write(json.dumps(state))
+        tf.gfile.Rename(tmp_filename, state_filename, overwrite=True)
+
+    remaining = [items[i] for i in state['order'][state['num_converted']:]]
+    pool, worker_pids = start_pool(num_workers)
+
+    try:
+        pending = collections.deque()
+        remaining = iter(remaining)
+        for item in remaining:
+            pending.append(pool.apply_async(
+                serialize_examples, (to_example_fn, item)))
+            if len(pending) >= 2*num_workers:
+                break
+
+        while pending:
+            records = wait_for_result(pending.popleft(), worker_pids)
+            for item in remaining:
+                pending.append(pool.apply_async(
+                    serialize_examples, (to_example_fn, item)))
+                break
+
+            for record in records:
+                writer.write(record)
+            state['num_converted'] += 1
+
+            if (state['num_converted'] % items_per_part == 0
+                    or not pending):
+                state['shards'].extend(writer.close_part())
+                state['part_id'] += 1
+                save_state()
+                if pending:
+                    writer.remove_part(state['part_id'])
+                    writer.open_part(state['part_id'])
+
+            sys.stdout.write('\r>> Converting item %d/%d split %s' % (
+                state['num_converted'], len(items), split_name))
+            sys.stdout.flush()
+
+        pool.close()
+        pool.join()
+
+    finally:
+        pool.terminate()
+
+    if writer.writers is not None:
+        # Nothing was left to convert, close the empty part.
+        state['shards'].extend(writer.close_part())
+
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+    dataset_utils.write_manifest(
+        tfrecord_dir, split_name, state['shards'],
+        feature_shapes=feature_shapes)
+    if tf.gfile.Exists(state_filename):
+        tf.gfile.Remove(state_filename)
@@ -0,0 +1,217 @@
+"""A common input pipeline based on `tf.data` for all the datasets.
+
+The `load_batch_*` functions of the different datasets only need to tell
+which items should be decoded and how they're preprocessed. The records
+are then read in parallel from the shards, decoded and preprocessed by
+several threads, batched and prefetched so that the model never needs
+to wait for the data.
+
+Unlike the old queue-based `DatasetDataProvider`, no queue runners are
+required here: the returned tensors can be used directly in any session.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+
+def load_batch(dataset,
+               items,
+               batch_size,
+               preprocess_fn=None,
+               shuffle=True,
+               num_epochs=None,
+               shuffle_buffer_size=800,
+               num_readers=4,
+               num_parallel_calls=4,
+               prefetch_batches=2,
+               postprocess_fn=None,
+               cache=None,
+               cache_value_range=(-1., 1.)):
+    """Read, decode, preprocess and batch items of a dataset.
+
+    With `cache`, the examples given by `preprocess_fn` are kept in memory
+    after the first pass through the dataset: the next epochs don't read
+    and decode the records anymore but are shuffled in memory (the first
+    batch is then only given once the whole dataset is decoded). Only
+    `postprocess_fn` is run at every epoch.
+
+    Args:
+        dataset: A `slim.dataset.Dataset` instance as returned by one of
+            the `get_split_*` functions. Its `data_sources` must be a file
+            pattern of TFRecords and its `decoder` a `TFExampleDecoder`.
+        items: The list of item names to decode.
+        batch_size: The number of elements contained in each batch.
+        preprocess_fn: A function that takes the decoded items (one
+            argument per item, in the order of `items`) of a single
+            example and returns a tuple of preprocessed `Tensors`.
+            If `None` the decoded items are batched directly.
+        shuffle: Whether to shuffle the shards and the examples or not.
+        num_epochs: The number of times we go through the dataset. If
+            `None` the dataset is repeated indefinitely. Notice that
+            when `num_epochs` is given, the last batch may be smaller
+            and the batch dimension is then not statically known.
+        shuffle_buffer_size: Decide the shuffle degree.
+        num_readers: The number of shards that are read at the same time.
+        num_parallel_calls: The number of examples that are decoded and
+            preprocessed in parallel.
+        prefetch_batches: The number of batches prepared in advance.
+        postprocess_fn: A function applied to the tuple returned by
+            `preprocess_fn` (ex: standardization), after the cache.
+        cache: `None` not to cache the examples, otherwise the dtype
+            used to store the float `Tensors` in memory: 'float32',
+            'float16' or 'uint8'. Other `Tensors` are stored as they are.
+        cache_value_range: The range of the float values, used to
+            quantize them when `cache` is 'uint8'.
+
+    Returns:
+        A list of `Tensors`, one for each element returned by
+        `preprocess_fn` (or one for each item), with an extra
+        batch dimension.
+    """
+    files = tf.data.Dataset.list_files(dataset.data_sources, shuffle=shuffle)
+    records = files.apply(tf.contrib.data.parallel_interleave(
+        tf.data.TFRecordDataset, cycle_length=num_readers, sloppy=shuffle))
+
+    def parse_fn(serialized_example):
+        tensors = dataset.decoder.decode(serialized_example, items)
+        if preprocess_fn is not None:
+            tensors = preprocess_fn(*tensors)
+        return tuple(tensors)
+
+    def postprocess(*tensors):
+        if postprocess_fn is not None:
+            tensors = postprocess_fn(*tensors)
+        return tuple(tensors)
+
+    if cache is None:
+        if shuffle:
+            records = records.shuffle(shuffle_buffer_size)
+        records = records.repeat(num_epochs)
+
+        def map_fn(serialized_example):
+            return postprocess(*parse_fn(serialized_example))
+    else:
+        # Which `Tensors` of an example are converted in the cache, it's
+        # known once `cache_fn` is traced by `map`.
+        compressed = []
+
+        def cache_fn(serialized_example):
+            tensors = parse_fn(serialized_example)
+            compressed[:] = [tensor.dtype.is_floating for tensor in tensors]
+            return compress(tensors, cache, cache_value_range)
+
+        examples = records.map(
+            cache_fn, num_parallel_calls=num_parallel_calls).cache()
+        if shuffle:
+            examples = examples.shuffle(dataset.num_samples)
+        records = examples.repeat(num_epochs)
+
+        def map_fn(*tensors):
+            return postprocess(*decompress(
+                tensors, compressed, cache, cache_value_range))
+
+    # Map and batch are fused so that decoded examples are directly
+    # written into the batch. Incomplete batches are only kept when we
+    # make a finite number of passes through the data.
+    batches = records.apply(tf.contrib.data.map_and_batch(
+        map_fn, batch_size,
+        num_parallel_calls=num_parallel_calls,
+        drop_remainder=num_epochs is None))
+    batches = batches.prefetch(prefetch_batches)
+
+    iterator = batches.make_one_shot_iterator()
+    return list(iterator.get_next())
+
+
+def compress(tensors, cache, value_range):
+    """Convert the float `Tensors` of an example to the cache dtype."""
+    compressed = []
+    for tensor in tensors:
+        if tensor.dtype.is_floating:
+            if cache == 'uint8':
+                low, high = value_range
+                tensor = tf.saturate_cast(
+                    tf.round((tensor-low) * 255 / (high-low)), tf.uint8)
+            else:
+                tensor = tf.cast(tensor, tf.as_dtype(cache))
+        compressed.append(tensor)
+    return tuple(compressed)
+
+
+def decompress(tensors, compressed, cache, value_range):
+    """Convert back to float32 the `Tensors` converted by `compress`
+    (those for which `compressed` is `True`)."""
+    decompressed = []
+    for tensor, is_compressed in zip(tensors, compressed):
+        if is_compressed:
+            tensor = tf.cast(tensor, tf.float32)
+            if cache == 'uint8':
+                low, high = value_range
+                tensor = tensor * (high-low) / 255 + low
+        decompressed.append(tensor)
+    return tuple(decompressed)
+
+
+def load_batch_arrays(arrays,
+                      batch_size,
+                      dtypes=None,
+                      shuffle=True,
+                      num_epochs=None,
+                      prefetch_batches=2):
+    """Load batches from numpy arrays that have the same first dimension.
+
+    The arrays can be memory-mapped (ex: stored in /dev/shm and shared by
+    several processes): they're never copied into the graph and whole
+    batches are read from them at once.
+
+    Args:
+        arrays: A list of arrays [num_samples, ...].
+        batch_size: The number of elements contained in each batch.
+        dtypes: The dtypes of the returned `Tensors`, the ones of the
+            arrays by default.
+        shuffle: Whether to shuffle the samples at each epoch or not.
+        num_epochs: The number of times we go through the data. If
+            `None` the data is repeated indefinitely and all the
+            batches are complete, otherwise the last one may be smaller.
+        prefetch_batches: The number of batches prepared in advance.
+
+    Returns:
+        A list of `Tensors`, one for each array, with a batch dimension.
+    """
+    num_samples = arrays[0].shape[0]
+    if dtypes is None:
+        dtypes = [tf.as_dtype(array.dtype) for array in arrays]
+
+    def get_batch(batch_indices):
+        # Sorted indices give sequential reads of the files.
+        batch_indices = np.sort(batch_indices)
+        return tuple(array[batch_indices].astype(dtype.as_numpy_dtype)
+                     for array, dtype in zip(arrays, dtypes))
+
+    def generate():
+        indices = np.zeros(0, dtype=np.int64)
+        epoch = 0
+        while num_epochs is None or epoch < num_epochs:
+            if shuffle:
+                order = np.random.permutation(num_samples)
+            else:
+                order = np.arange(num_samples)
+            indices = np.concatenate([indices, order])
+            epoch += 1
+            while indices.shape[0] >= batch_size:
+                yield get_batch(indices[:batch_size])
+                indices = indices[batch_size:]
+        if indices.shape[0] > 0:
+            yield get_batch(indices)
+
+    batch_dim = batch_size if num_epochs is None else None
+    batches = tf.data.Dataset.from_generator(
+        generate, tuple(dtypes),
+        tuple(tf.TensorShape([batch_dim] + list(array.shape[1:]))
+              for array in arrays))
+    batches = batches.prefetch(prefetch_batches)
+    return list(batches.make_one_shot_iterator().get_next())
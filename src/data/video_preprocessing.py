@@ -0,0 +1,69 @@
+"""Preprocessing of videos given as `Tensors` [height, width, frames, C].
+
+The frames of a video are transformed all at once (as a batch of images)
+and not one by one, so the size of the graph and the cost of building it
+don't depend on the number of frames.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+def distort_video(video,
+                  brightness_range=(-1., 1.),
+                  contrast_range=(0.2, 1.8),
+                  area_range=(0.8, 1.)):
+    """Random brightness, contrast and cropping of a video.
+
+    The same random transformation is applied to all the frames and the
+    cropped video is resized to its original size.
+
+    Args:
+        video: A `Tensor` [height, width, frames, channels] whose
+            shape is statically known.
+        brightness_range: The range of the brightness delta.
+        contrast_range: The range of the contrast factor.
+        area_range: The range of the area of the cropped region, as
+            a fraction of the area of the frames.
+
+    Returns:
+        The distorted video, a float `Tensor` of the same shape.
+    """
+    height, width, num_frames, channels = video.get_shape().as_list()
+    delta = tf.random_uniform((), *brightness_range)
+    contrast_factor = tf.random_uniform((), *contrast_range)
+    bbox_begin, bbox_size, _ = tf.image.sample_distorted_bounding_box(
+        [height, width, channels], [[[0, 0, 1, 1]]], area_range=area_range)
+
+    # The frames are a batch of images [frames, height, width, channels].
+    frames = tf.transpose(video, [2, 0, 1, 3])
+    frames = tf.image.adjust_brightness(frames, delta)
+    frames = tf.image.adjust_contrast(frames, contrast_factor)
+    frames = tf.slice(frames,
+                      tf.concat([[0], bbox_begin], 0),
+                      tf.concat([[-1], bbox_size], 0))
+    frames.set_shape([num_frames, None, None, channels])
+    frames = tf.image.resize_images(frames, [height, width])
+    return tf.transpose(frames, [1, 2, 0, 3])
+
+
+def standardize_frames(video):
+    """Apply `tf.image.per_image_standardization` to each frame of a video.
+
+    Args:
+        video: A `Tensor` [height, width, frames, channels].
+
+    Returns:
+        A float32 `Tensor` of the same shape where each frame has zero
+        mean and unit variance.
+    """
+    video = tf.cast(video, tf.float32)
+    shape = tf.shape(video)
+    num_pixels = tf.cast(shape[0] * shape[1] * shape[3], tf.float32)
+    mean, variance = tf.nn.moments(video, axes=[0, 1, 3], keep_dims=True)
+    # Like `per_image_standardization`, don't divide by 0 for uniform frames.
+    adjusted_stddev = tf.maximum(tf.sqrt(variance), tf.rsqrt(num_pixels))
+    return (video - mean) / adjusted_stddev
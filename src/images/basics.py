@@ -26,6 +26,11 @@ slim = tf.contrib.slim
 class TrainImages(Train):
     """Subclass of `Train` that reads image data."""
 
+    # The dtype used to keep the decoded images in memory after the
+    # first epoch ('uint8', 'float16' or 'float32'), `None` to decode
+    # them at every epoch (see `load_batch_images`).
+    data_cache = None
+
     def __init__(self, image_size=299, channels=3, **kwargs):
         """One should define some parameters for input images.
 
@@ -41,31 +46,43 @@ class TrainImages(Train):
         self.image_size = image_size
         self.channels = channels
 
+    def get_split_inputs(self, split_name, tfrecord_dir, batch_size,
+                         shuffle=True, num_epochs=None):
+        """Load the images of a split in batches.
+
+        Returns:
+            The dataset of the split, a batch of images and
+            the corresponding labels.
+        """
+        dataset = get_split_images(
+            split_name, tfrecord_dir, channels=self.channels,
+            image_size=self.image_size)
+        images, labels = load_batch_images(
+            dataset, height=self.image_size, width=self.image_size,
+            batch_size=batch_size, shuffle=shuffle, num_epochs=num_epochs,
+            cache=self.data_cache)
+        return dataset, images, labels
+
     def get_data(self, tfrecord_dir, batch_size):
-        self.dataset_train = get_split_images(
-            'train', tfrecord_dir, channels=self.channels)
-        self.images_train, self.labels_train = load_batch_images(
-            self.dataset_train, height=self.image_size,
-            width=self.image_size, batch_size=batch_size)
-        self.dataset_test = get_split_images(
-            'validation', tfrecord_dir, channels=self.channels)
-        self.images_test, self.labels_test = load_batch_images(
-            self.dataset_test, height=self.image_size,
-            width=self.image_size, batch_size=batch_size)
+        self.dataset_train, self.images_train, self.labels_train = \
+            self.get_split_inputs('train', tfrecord_dir, batch_size,
+                                  num_epochs=self.num_epochs)
+        self.dataset_test, self.images_test, self.labels_test = \
+            self.get_split_inputs('validation', tfrecord_dir, batch_size,
+                                  num_epochs=self.num_epochs)
         return self.dataset_train
 
     def decide_used_data(self):
-        self.images = tf.cond(
-            self.training, lambda: self.images_train,
-            lambda: self.images_test)
-        self.labels = tf.cond(
-            self.training, lambda: self.labels_train,
-            lambda: self.labels_test)
+        self.images = self.select_data(self.images_train, self.images_test)
+        self.labels = self.select_data(self.labels_train, self.labels_test)
 
 
 class EvaluateImages(Evaluate):
     """Subclass of `Evaluate` that reads image data."""
 
+    # See `TrainImages`.
+    data_cache = None
+
     def __init__(self, image_size=299, channels=3):
         """One should define some parameters for input images.
 
@@ -79,14 +96,26 @@ class EvaluateImages(Evaluate):
         self.image_size = image_size
         self.channels = channels
 
+    def get_split_inputs(self, split_name, tfrecord_dir, batch_size,
+                         shuffle=True, num_epochs=None):
+        """See `TrainImages.get_split_inputs`."""
+        dataset = get_split_images(
+            split_name, tfrecord_dir, channels=self.channels,
+            image_size=self.image_size)
+        images, labels = load_batch_images(
+            dataset, height=self.image_size, width=self.image_size,
+            batch_size=batch_size, shuffle=shuffle, num_epochs=num_epochs,
+            cache=self.data_cache)
+        return dataset, images, labels
+
     def get_data(self, split_name, tfrecord_dir, batch_size, shuffle):
-        self.dataset = get_split_images(
-            split_name, tfrecord_dir, channels=self.channels)
         if batch_size is None:
-            batch_size = self.dataset.num_samples
-        self.images, self.labels = load_batch_images(
-            self.dataset, height=self.image_size,
-            width=self.image_size, batch_size=batch_size, shuffle=shuffle)
+            batch_size = get_split_images(
+                split_name, tfrecord_dir,
+                channels=self.channels).num_samples
+        self.dataset, self.images, self.labels = self.get_split_inputs(
+            split_name, tfrecord_dir, batch_size,
+            shuffle=shuffle, num_epochs=self.num_epochs)
         return self.dataset
 
 
@@ -116,7 +145,8 @@ class VisualizeImages(Visualize):
 
     def get_data(self, split_name, tfrecord_dir, batch_size, shuffle):
         self.dataset = get_split_images(
-            split_name, tfrecord_dir, channels=self.channels)
+            split_name, tfrecord_dir, channels=self.channels,
+            image_size=self.image_size)
         if batch_size is None:
             batch_size = self.dataset.num_samples
         self.images, self.labels = load_batch_images(
@@ -13,6 +13,7 @@ from nets_base import inception_v4
 from images.basics import TrainImages, EvaluateImages
 from classify.train import TrainClassify, TrainClassifyCNN
 from classify.evaluate import EvaluateClassify, EvaluateClassifyCNN
+from classify.cached import TrainClassifyCached, EvaluateClassifyCached
 
 slim = tf.contrib.slim
 
@@ -47,6 +48,36 @@ class EvaluateClassifyImages(EvaluateImages, EvaluateClassify):
         self.logits = self.compute_logits(
             self.images, self.dataset.num_classes, **kwargs)
 
+    # The maximal number of images of the last batch shown on Tensorboard.
+    max_last_images = 20
+
+    def compute_log_data(self):
+        """Also prepare the summaries of the last batch.
+
+        They're built here once, before the session is started, so the
+        graph doesn't change during the evaluation. The images are
+        shown by a single image summary and their ground truth labels and
+        predictions by a text summary (line `i` describes image `i`).
+        """
+        super(EvaluateClassifyImages, self).compute_log_data()
+        dataset = self.dataset
+        names = tf.constant([dataset.labels_to_names[i]
+                             for i in range(dataset.num_classes)])
+        with tf.name_scope('last_images'):
+            images = self.images[:self.max_last_images]
+            self.last_true_names = tf.gather(
+                names, self.labels[:self.max_last_images])
+            self.last_predicted_names = tf.gather(
+                names, self.predictions[:self.max_last_images])
+            descriptions = tf.string_join([
+                tf.as_string(tf.range(tf.shape(images)[0])),
+                ': true ', self.last_true_names,
+                ', predicted ', self.last_predicted_names])
+            self.last_images_summary = tf.summary.merge([
+                tf.summary.image(
+                    'images', images, max_outputs=self.max_last_images),
+                tf.summary.text('predictions', descriptions)])
+
     def last_step_log_info(self, sess, batch_size):
         """Give particular information for the last batch.
 
@@ -57,46 +88,84 @@ class EvaluateClassifyImages(EvaluateImages, EvaluateClassify):
         provided (if `batch_size` > 20 we take the first 20 images).
         """
         start_time = time.time()
-        global_step_count, accuracy_rate, ac_summary, labels, \
-            predictions, images = sess.run([
+        global_step_count, accuracy_rate, ac_summary, true_names, \
+            predicted_names, images_summary = sess.run([
                 self.global_step_op, self.accuracy,
-                self.accuracy_summary,
-                self.labels, self.predictions, self.images])
+                self.accuracy_summary, self.last_true_names,
+                self.last_predicted_names, self.last_images_summary])
         time_elapsed = time.time() - start_time
 
         tf.logging.info(
             'global step %s: accurarcy: %.4f (%.2f sec/step)',
             global_step_count, accuracy_rate, time_elapsed)
 
-        dataset = self.dataset
-        true_names = [dataset.labels_to_names[i] for i in labels]
-        predicted_names = [dataset.labels_to_names[i] for i in predictions]
-
-        if batch_size > 20:
-            batch_size = 20
-        image_size = self.image_size
+        true_names = [name.decode('utf-8') for name in true_names]
+        predicted_names = [name.decode('utf-8') for name in predicted_names]
 
         tf.logging.info('Information for the last batch')
-        tf.logging.info('Ground Truth: [%s]', true_names[:batch_size])
-        tf.logging.info('Prediciotn: [%s]', predicted_names[:batch_size])
+        tf.logging.info('Ground Truth: [%s]', true_names)
+        tf.logging.info('Prediciotn: [%s]', predicted_names)
 
         if hasattr(self, 'fw'):
-            with tf.name_scope('last_images'):
-                for i in range(batch_size):
-                    image_pl = tf.placeholder(
-                        dtype=tf.float32,
-                        shape=(1, image_size, image_size, self.channels))
-                    image_summary = tf.summary.image(
-                        'image_true_{}_predicted_{}'.format(
-                            true_names[i], predicted_names[i]), image_pl)
-                    self.fw.add_summary(
-                        sess.run(image_summary,
-                                 feed_dict={image_pl: [images[i]]}),
-                        global_step=self.global_step_count)
+            self.fw.add_summary(images_summary, global_step=global_step_count)
             self.fw.add_summary(ac_summary, global_step=global_step_count)
 
 
-class TrainClassifyInception(TrainClassifyImages):
+# The last block of InceptionV4 that stays frozen when fine-tuning,
+# its activations are what is stored when `feature_cache_dir` is given.
+INCEPTION_FROZEN_ENDPOINT = 'Mixed_7c'
+
+
+def inception_v4_prefix(inputs, is_training, reuse=None,
+                        scope='InceptionV4'):
+    """Compute InceptionV4 up to `INCEPTION_FROZEN_ENDPOINT`.
+
+    `reuse` and `scope` are used as in `inception_v4.inception_v4`.
+    """
+    with tf.variable_scope(scope, 'InceptionV4', [inputs],
+                           reuse=reuse) as scope:
+        with slim.arg_scope([slim.batch_norm, slim.dropout],
+                            is_training=is_training):
+            net, _ = inception_v4.inception_v4_base(
+                inputs, final_endpoint=INCEPTION_FROZEN_ENDPOINT,
+                scope=scope)
+    return net
+
+
+def inception_v4_suffix(net, num_classes, is_training, dropout_keep_prob=0.8):
+    """Compute the logits of InceptionV4 from the activations of
+    `INCEPTION_FROZEN_ENDPOINT`, the auxiliary logits are not computed.
+
+    The variables have the same names as in `inception_v4.inception_v4`.
+    """
+    with tf.variable_scope('InceptionV4', values=[net]):
+        with slim.arg_scope([slim.batch_norm, slim.dropout],
+                            is_training=is_training):
+            # 8 x 8 x 1536
+            net = inception_v4.block_inception_c(net, 'Mixed_7d')
+            with tf.variable_scope('Logits'):
+                net = slim.avg_pool2d(
+                    net, net.get_shape()[1:3], padding='VALID',
+                    scope='AvgPool_1a')
+                # 1 x 1 x 1536
+                net = slim.dropout(net, dropout_keep_prob, scope='Dropout_1b')
+                net = slim.flatten(net, scope='PreLogitsFlatten')
+                logits = slim.fully_connected(
+                    net, num_classes, activation_fn=None, scope='Logits')
+    return logits
+
+
+def inception_checkpoint_path(checkpoint_dirs):
+    """Use the latest checkpoint or the pre-trained model."""
+    assert len(checkpoint_dirs) == 1
+    checkpoint_path = tf.train.latest_checkpoint(checkpoint_dirs[0])
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(
+            checkpoint_dirs[0], 'inception_v4.ckpt')
+    return checkpoint_path
+
+
+class TrainClassifyInception(TrainClassifyCached, TrainClassifyImages):
     """Train the InceptionV4 model.
 
     Since the InceptionV4 network is quite huge and it takes very
@@ -113,8 +182,18 @@ class TrainClassifyInception(TrainClassifyImages):
     You can also find the checkpoint of the model (download it and
     put its directory as the `checkpoint_dir` argument) and more
     details about the inception architecture on this page.
+
+    With the default trainable scopes everything up to `Mixed_7c` is
+    frozen. By giving `feature_cache_dir` the activations of `Mixed_7c`
+    are computed once and stored (see `classify/cached.py`), and only
+    `Mixed_7d` and the logits are then computed at each step. These
+    activations are 8 x 8 x 1536 so one may want to store them with
+    `feature_cache_dtype` = 'float16'.
     """
 
+    # The auxiliary logits are not computed from the cache.
+    head_kwargs = ('dropout_keep_prob', 'create_aux_logits')
+
     @property
     def default_trainable_scopes(self):
         return ['InceptionV4/Mixed_7d', 'InceptionV4/Logits']
@@ -127,22 +206,38 @@ class TrainClassifyInception(TrainClassifyImages):
             is_training=self.batch_stat, **kwargs)
         return logits
 
+    def compute_representation(self, inputs, **kwargs):
+        return inception_v4_prefix(inputs, self.batch_stat, **kwargs)
+
+    def compute_logits_from_representation(self, net, num_classes,
+                                           dropout_keep_prob=0.8,
+                                           create_aux_logits=True):
+        return inception_v4_suffix(
+            net, num_classes, self.batch_stat, dropout_keep_prob)
+
+    def get_feature_checkpoint_path(self, checkpoint_dirs):
+        return inception_checkpoint_path(checkpoint_dirs)
+
     def get_init_fn(self, checkpoint_dirs):
         """Restore the pre-trained model from the checkpoint."""
+        if self.feature_cache_dir is not None:
+            return super(TrainClassifyInception, self).get_init_fn(
+                checkpoint_dirs)
 
         checkpoint_exclude_scopes = [
             'InceptionV4/Logits', 'InceptionV4/AuxLogits']
         variables_to_restore = self.get_variables_to_restore(
             scopes=None, exclude=checkpoint_exclude_scopes)
 
-        assert len(checkpoint_dirs) == 1
-        checkpoint_path = tf.train.latest_checkpoint(checkpoint_dirs[0])
-        if checkpoint_path is None:
-            checkpoint_path = os.path.join(
-                checkpoint_dirs[0], 'inception_v4.ckpt')
+        return slim.assign_from_checkpoint_fn(
+            inception_checkpoint_path(checkpoint_dirs), variables_to_restore)
 
+    def get_head_init_fn(self, checkpoint_dirs):
+        """Only `Mixed_7d` is restored from the pre-trained model."""
+        variables_to_restore = self.get_variables_to_restore(
+            ['InceptionV4/Mixed_7d'])
         return slim.assign_from_checkpoint_fn(
-            checkpoint_path, variables_to_restore)
+            inception_checkpoint_path(checkpoint_dirs), variables_to_restore)
 
 
 def fine_tune_inception(tfrecord_dir,
@@ -162,14 +257,29 @@ def fine_tune_inception(tfrecord_dir,
         number_of_steps=number_of_steps, **kwargs)
 
 
-class EvaluateClassifyInception(EvaluateClassifyImages):
-    """Evaluate the trained InceptionV4 model."""
+class EvaluateClassifyInception(EvaluateClassifyCached,
+                                EvaluateClassifyImages):
+    """Evaluate the trained InceptionV4 model.
+
+    When `feature_cache_dir` is given, `feature_checkpoint_dirs` should
+    contain the pre-trained model if the evaluated checkpoint was
+    trained from the cache.
+    """
 
     def compute_logits(self, inputs, num_classes):
         logits, _ = inception_v4.inception_v4(
             inputs, num_classes=num_classes, is_training=False)
         return logits
 
+    def compute_representation(self, inputs, **kwargs):
+        return inception_v4_prefix(inputs, False, **kwargs)
+
+    def compute_logits_from_representation(self, net, num_classes):
+        return inception_v4_suffix(net, num_classes, False)
+
+    def get_feature_checkpoint_path(self, checkpoint_dirs):
+        return inception_checkpoint_path(checkpoint_dirs)
+
 
 class TrainClassifyImagesCNN(TrainClassifyCNN, TrainClassifyImages):
     """Train a CNN to classify image.
@@ -189,7 +299,7 @@ class EvaluateClassifyImagesCNN(EvaluateClassifyCNN, EvaluateClassifyImages):
     pass
 
 
-class TrainClassifyImagesCAE(TrainClassifyImages):
+class TrainClassifyImagesCAE(TrainClassifyCached, TrainClassifyImages):
     """Train a perceptron from some high-level features learned by a CAE.
 
     Convolutional auto-encoders (CAE) are supposes to be able to
@@ -204,8 +314,15 @@ class TrainClassifyImagesCAE(TrainClassifyImages):
     just the final perceptron part in a supervised way.
 
     Several CAE architectures can be found in the `CAE_architecture.py` file.
+
+    Since the CAE is frozen by default, its representations can be
+    computed once and stored by giving `feature_cache_dir`
+    (see `classify/cached.py`).
     """
 
+    # Average pooling is done after dropout so it's part of the last layer.
+    head_kwargs = ('dropout_keep_prob', 'do_avg')
+
     def __init__(self, CAE_architecture, endpoint='Middle', **kwargs):
         """Give the used CAE architecture and the representation layer.
 
@@ -242,8 +359,17 @@ class TrainClassifyImagesCAE(TrainClassifyImages):
                 layer. This is used historically for test purpose and it
                 should better be `False`.
         """
-        net = self.CAE_architecture(
+        net = self.compute_representation(inputs)
+        return self.compute_logits_from_representation(
+            net, num_classes, dropout_keep_prob, do_avg)
+
+    def compute_representation(self, inputs):
+        return self.CAE_architecture(
             inputs, dropout_keep_prob=1, final_endpoint=self.endpoint)
+
+    def compute_logits_from_representation(self, net, num_classes,
+                                           dropout_keep_prob=0.8,
+                                           do_avg=False):
         net = slim.dropout(net, dropout_keep_prob, scope='PreLogitsDropout')
         if do_avg:
             net = slim.avg_pool2d(
@@ -266,7 +392,8 @@ class TrainClassifyImagesCAE(TrainClassifyImages):
             checkpoint_path, variables_to_restore)
 
 
-class EvaluateClassifyImagesCAE(EvaluateClassifyImages):
+class EvaluateClassifyImagesCAE(EvaluateClassifyCached,
+                                EvaluateClassifyImages):
     """Evaluate the trained perceptron built on CAE representation.
 
     This is the evaluatio part of `TrainClassifyImagesCAE`.
@@ -294,9 +421,16 @@ class EvaluateClassifyImagesCAE(EvaluateClassifyImages):
             num_classes: The number of classes to be classified.
                 This is also the number of neurons in the output layer.
         """
-        net = self.CAE_architecture(
+        net = self.compute_representation(inputs)
+        self.logits = self.compute_logits_from_representation(
+            net, num_classes)
+        return self.logits
+
+    def compute_representation(self, inputs):
+        return self.CAE_architecture(
             inputs, final_endpoint=self.endpoint)
+
+    def compute_logits_from_representation(self, net, num_classes):
         net = slim.flatten(net, scope='PreLogitsFlatten')
-        self.logits = slim.fully_connected(
+        return slim.fully_connected(
             net, num_classes, activation_fn=None, scope='Logits')
-        return self.logits
@@ -0,0 +1,384 @@
+"""Batched K nearest neighbours used by the AVSR transfer experience.
+
+All the queries of a batch are processed at once: the distances are
+computed in matrix form as |a|^2 - 2ab + |b|^2, then a single `top_k`
+and a single `tf.gather` are used. The size of the graph therefore
+doesn't depend on the batch size.
+
+For large reference sets an exact search in the graph becomes too
+expensive. The neighbours can then be searched in an index built once
+with numpy (`ExactIndex`, `PQIndex` for product quantization or `LSHIndex`
+for random projections) and queried from the graph with `index_knn_mean`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import abc
+
+import numpy as np
+import tensorflow as tf
+
+
+def flatten(inputs):
+    """Reshape a batch of tensors to a matrix [batch_size, dimension]."""
+    return tf.reshape(inputs, [tf.shape(inputs)[0], -1])
+
+
+def squared_distances(queries, references):
+    """Compute all the squared euclidean distances between two sets.
+
+    Args:
+        queries: A `Tensor` of size [num_queries, dimension].
+        references: A `Tensor` of size [num_references, dimension].
+
+    Returns:
+        A `Tensor` of size [num_queries, num_references].
+    """
+    queries_norms = tf.reduce_sum(tf.square(queries), axis=1, keep_dims=True)
+    references_norms = tf.reduce_sum(tf.square(references), axis=1)
+    distances = (
+        queries_norms
+        - 2 * tf.matmul(queries, references, transpose_b=True)
+        + references_norms)
+    # Rounding errors can give small negative values.
+    return tf.maximum(distances, 0.)
+
+
+def nearest_neighbors(queries, references, K):
+    """Find the K nearest neighbours of each query.
+
+    Args:
+        queries: A batch of queries, each of them can be of any shape.
+        references: A batch of references of the same shape as the queries.
+        K: The number of neighbours.
+
+    Returns:
+        distances: A `Tensor` of size [num_queries, K] containing the
+            distances to the neighbours, in increasing order.
+        indices: A `Tensor` of size [num_queries, K] containing the
+            indices of the neighbours in `references`.
+    """
+    distances = squared_distances(flatten(queries), flatten(references))
+    values, indices = tf.nn.top_k(tf.negative(distances), k=K)
+    return tf.sqrt(tf.negative(values)), indices
+
+
+def knn_mean(queries, references, values, K):
+    """Average the values associated to the K nearest neighbours.
+
+    Args:
+        queries, references, K: See `nearest_neighbors`.
+        values: The values associated to the references, the first
+            dimension must be the number of references.
+
+    Returns:
+        A `Tensor` of size [num_queries, ...] (the shape of a value).
+    """
+    _, indices = nearest_neighbors(queries, references, K)
+    return tf.reduce_mean(tf.gather(values, indices), axis=1)
+
+
+def knn_vote(queries, references, labels, K, num_classes=None):
+    """Predict labels by a majority vote of the K nearest neighbours.
+
+    Args:
+        queries, references, K: See `nearest_neighbors`.
+        labels: A `Tensor` of size [num_references] containing the labels
+            of the references.
+        num_classes: The number of classes. If `None` it's deduced
+            from `labels`.
+
+    Returns:
+        A `Tensor` of size [num_queries] containing the predicted labels.
+    """
+    _, indices = nearest_neighbors(queries, references, K)
+    if num_classes is None:
+        num_classes = tf.to_int32(tf.reduce_max(labels)) + 1
+    # The neighbours are sorted by distance. Each one gets a small extra
+    # weight halving with its rank (in total less than 1e-3), so that the
+    # ties go to the class of the nearest neighbour among the tied classes
+    # and not to the lowest class id.
+    weights = 1. + 1e-3 * tf.pow(0.5, tf.to_float(tf.range(1, K + 1)))
+    votes = tf.reduce_sum(
+        tf.one_hot(tf.gather(labels, indices), num_classes) *
+        weights[:, tf.newaxis], axis=1)
+    return tf.argmax(votes, axis=1)
+
+
+def index_knn_mean(index, queries, values, K):
+    """Same as `knn_mean` but the neighbours are searched in an index.
+
+    Args:
+        index: A `NeighborIndex` instance. It only needs to be built
+            before the returned `Tensor` is computed.
+        queries, K: See `nearest_neighbors`.
+        values: The values associated to the references of the index.
+
+    Returns:
+        A `Tensor` of size [num_queries, ...] (the shape of a value).
+    """
+    indices = tf.py_func(
+        lambda queries: index.search(queries, K),
+        [flatten(queries)], tf.int64)
+    indices.set_shape([None, K])
+    return tf.reduce_mean(tf.gather(values, indices), axis=1)
+
+
+def pairwise_squared_distances(queries, references, references_norms=None):
+    """The numpy version of `squared_distances`."""
+    if references_norms is None:
+        references_norms = np.sum(np.square(references), axis=1)
+    distances = (
+        np.sum(np.square(queries), axis=1)[:, np.newaxis]
+        - 2 * np.dot(queries, references.T)
+        + references_norms[np.newaxis, :])
+    return np.maximum(distances, 0)
+
+
+def smallest_k(distances, K):
+    """Returns the indices of the K smallest values of each row, sorted."""
+    K = min(K, distances.shape[1])
+    indices = np.argpartition(distances, K-1, axis=1)[:, :K]
+    rows = np.arange(distances.shape[0])[:, np.newaxis]
+    order = np.argsort(distances[rows, indices], axis=1)
+    return indices[rows, order]
+
+
+def as_matrix(array):
+    """Convert a batch of arrays to a float32 matrix [batch_size, dim]."""
+    array = np.asarray(array, dtype=np.float32)
+    return array.reshape(array.shape[0], -1)
+
+
+class NeighborIndex(object):
+    """The interface of the nearest neighbour indexes.
+
+    An index is built once from the references with `build` and is then
+    queried by batches with `search`. Subclasses must implement `build`
+    and `search_batch`.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, batch_size=256):
+        """
+        Args:
+            batch_size: The maximum number of queries processed at the
+                same time, this bounds the memory usage of the search.
+        """
+        self.batch_size = batch_size
+        self.recall = None
+
+    @abc.abstractmethod
+    def build(self, references):
+        """Build the index.
+
+        Args:
+            references: A numpy array [num_references, ...].
+        """
+        pass
+
+    @abc.abstractmethod
+    def search_batch(self, queries, K):
+        """Search the neighbours of a matrix of queries of moderate size."""
+        pass
+
+    def search(self, queries, K):
+        """Search the K nearest neighbours of each query.
+
+        Args:
+            queries: A numpy array [num_queries, ...] whose elements have
+                the same shape as the references.
+            K: The number of neighbours.
+
+        Returns:
+            A numpy array of int64 [num_queries, K] containing the indices
+            of the neighbours, from the nearest to the farthest.
+        """
+        queries = as_matrix(queries)
+        results = [self.search_batch(queries[i:i+self.batch_size], K)
+                   for i in range(0, queries.shape[0], self.batch_size)]
+        if not results:
+            return np.zeros((0, K), dtype=np.int64)
+        return np.concatenate(results).astype(np.int64)
+
+    def evaluate_recall(self, references, queries, K):
+        """Compute the recall@K of the index compared to an exact search.
+
+        The result is also stored in `self.recall`.
+
+        Args:
+            references: The references used to build the index.
+            queries: Some queries used for the evaluation.
+            K: The number of neighbours.
+
+        Returns:
+            The average proportion of the K true nearest neighbours
+            that are found by the index.
+        """
+        exact_index = ExactIndex(batch_size=self.batch_size)
+        exact_index.build(references)
+        true_neighbors = exact_index.search(queries, K)
+        found_neighbors = self.search(queries, K)
+        self.recall = np.mean([
+            len(np.intersect1d(true, found)) / true.shape[0]
+            for true, found in zip(true_neighbors, found_neighbors)])
+        return self.recall
+
+
+class ExactIndex(NeighborIndex):
+    """Brute-force search, which is also the reference for the recall."""
+
+    def build(self, references):
+        self.references = as_matrix(references)
+        self.references_norms = np.sum(np.square(self.references), axis=1)
+
+    def search_batch(self, queries, K):
+        return smallest_k(pairwise_squared_distances(
+            queries, self.references, self.references_norms), K)
+
+
+def kmeans(data, num_centroids, num_iterations, random_state):
+    """A simple Lloyd's algorithm, returns the centroids."""
+    num_centroids = min(num_centroids, data.shape[0])
+    centroids = data[random_state.choice(
+        data.shape[0], num_centroids, replace=False)].copy()
+    for _ in range(num_iterations):
+        assignments = np.argmin(
+            pairwise_squared_distances(data, centroids), axis=1)
+        for c in range(num_centroids):
+            members = data[assignments == c]
+            # Empty clusters keep their previous centroid.
+            if members.shape[0] > 0:
+                centroids[c] = members.mean(axis=0)
+    return centroids
+
+
+class PQIndex(NeighborIndex):
+    """Product quantization with asymmetric distance computation.
+
+    The dimensions are split into `num_subspaces` groups and each group of
+    every reference is replaced by the nearest of `num_centroids` centroids
+    learned by k-means. Only the centroid ids are kept (one byte per
+    subspace with the default values) so the index is much smaller than
+    the references. The distances from a query are then sums of
+    `num_subspaces` values read from small precomputed tables.
+    """
+
+    def __init__(self, num_subspaces=8, num_centroids=256,
+                 num_iterations=20, max_training_samples=50000,
+                 seed=None, batch_size=256):
+        """
+        Args:
+            num_subspaces: The number of groups of dimensions.
+            num_centroids: The number of centroids of each subspace.
+            num_iterations: The number of k-means iterations.
+            max_training_samples: The maximum number of references
+                used to learn the centroids.
+            seed: The seed of the random generator.
+            batch_size: See `NeighborIndex`.
+        """
+        super(PQIndex, self).__init__(batch_size)
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.num_iterations = num_iterations
+        self.max_training_samples = max_training_samples
+        self.random_state = np.random.RandomState(seed)
+
+    def build(self, references):
+        references = as_matrix(references)
+        num_references, dim = references.shape
+        num_subspaces = min(self.num_subspaces, dim)
+        bounds = np.linspace(0, dim, num_subspaces+1).astype(int)
+        self.subspaces = list(zip(bounds[:-1], bounds[1:]))
+
+        training_data = references[self.random_state.choice(
+            num_references, min(num_references, self.max_training_samples),
+            replace=False)]
+
+        code_type = np.uint8 if self.num_centroids <= 256 else np.int32
+        self.codes = np.empty((num_references, num_subspaces), code_type)
+        self.codebooks = []
+        for m, (start, end) in enumerate(self.subspaces):
+            codebook = kmeans(training_data[:, start:end], self.num_centroids,
+                              self.num_iterations, self.random_state)
+            self.codebooks.append(codebook)
+            for i in range(0, num_references, self.batch_size):
+                self.codes[i:i+self.batch_size, m] = np.argmin(
+                    pairwise_squared_distances(
+                        references[i:i+self.batch_size, start:end],
+                        codebook), axis=1)
+
+    def search_batch(self, queries, K):
+        distances = np.zeros(
+            (queries.shape[0], self.codes.shape[0]), dtype=np.float32)
+        for m, (start, end) in enumerate(self.subspaces):
+            table = pairwise_squared_distances(
+                queries[:, start:end], self.codebooks[m])
+            distances += table[:, self.codes[:, m]]
+        return smallest_k(distances, K)
+
+
+class LSHIndex(NeighborIndex):
+    """Locality-sensitive hashing with random projections.
+
+    Each of the `num_tables` hash tables puts the references in buckets
+    according to the signs of `num_bits` random projections (of the
+    centered data). The candidates of a query are the references sharing
+    a bucket with it in at least one table and only their exact distances
+    are computed. If there are less than K candidates we fall back to an
+    exact search for that query.
+    """
+
+    def __init__(self, num_bits=12, num_tables=8, seed=None, batch_size=256):
+        """
+        Args:
+            num_bits: The number of projections (bits) of each hash.
+                Larger values give smaller buckets.
+            num_tables: The number of hash tables. Larger values give
+                a better recall.
+            seed: The seed of the random generator.
+            batch_size: See `NeighborIndex`.
+        """
+        super(LSHIndex, self).__init__(batch_size)
+        self.num_bits = num_bits
+        self.num_tables = num_tables
+        self.random_state = np.random.RandomState(seed)
+
+    def hash(self, data):
+        """Returns the hashes [num_tables, num_data] of a matrix."""
+        bits = np.einsum('nd,tdb->tnb', data - self.mean, self.projections)
+        return np.dot((bits > 0).astype(np.int64), self.bit_values)
+
+    def build(self, references):
+        self.references = as_matrix(references)
+        self.references_norms = np.sum(np.square(self.references), axis=1)
+        self.mean = self.references.mean(axis=0)
+        self.projections = self.random_state.randn(
+            self.num_tables, self.references.shape[1], self.num_bits)
+        self.bit_values = 2 ** np.arange(self.num_bits, dtype=np.int64)
+
+        # Each table is stored as the sorted hashes and the corresponding
+        # reference ids so that a bucket is found by binary search.
+        self.tables = []
+        for hashes in self.hash(self.references):
+            order = np.argsort(hashes, kind='mergesort')
+            self.tables.append((hashes[order], order))
+
+    def search_batch(self, queries, K):
+        query_hashes = self.hash(queries)
+        results = np.empty((queries.shape[0], K), dtype=np.int64)
+        for i, query in enumerate(queries):
+            candidates = np.unique(np.concatenate([
+                ids[np.searchsorted(hashes, query_hashes[t, i]):
+                    np.searchsorted(hashes, query_hashes[t, i], 'right')]
+                for t, (hashes, ids) in enumerate(self.tables)]))
+            if candidates.shape[0] < K:
+                candidates = np.arange(self.references.shape[0])
+            distances = pairwise_squared_distances(
+                query[np.newaxis], self.references[candidates],
+                self.references_norms[candidates])
+            results[i] = candidates[smallest_k(distances, K)[0]]
+        return results
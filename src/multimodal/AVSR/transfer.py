@@ -11,6 +11,7 @@ import tensorflow as tf
 
 from classify.train import TrainClassify
 from data.mfcc_lips import load_batch_mfcc_lips, get_split_mfcc_lips
+from multimodal.AVSR.knn import knn_mean, index_knn_mean, flatten
 
 from audio.classify_routines import TrainClassifyAudio, EvaluateClassifyAudio
 from audio.CNN_architecture import CNN_mfcc6
@@ -30,10 +31,12 @@ class TrainClassifyAudioAVSR(TrainClassifyAudio):
     def get_data(self, tfrecord_dir, batch_size):
         self.dataset_train = get_split_mfcc_lips('train_all', tfrecord_dir)
         self.mfccs_train, _, self.labels_train = load_batch_mfcc_lips(
-            self.dataset_train, batch_size=batch_size)
+            self.dataset_train, batch_size=batch_size,
+            num_epochs=self.num_epochs)
         self.dataset_test = get_split_mfcc_lips('validation', tfrecord_dir)
         self.mfccs_test, _, self.labels_test = load_batch_mfcc_lips(
-            self.dataset_test, batch_size=batch_size, is_training=False)
+            self.dataset_test, batch_size=batch_size, is_training=False,
+            num_epochs=self.num_epochs)
         return self.dataset_train
 
 
@@ -46,7 +49,7 @@ class EvaluateClassifyAudioAVSR(EvaluateClassifyAudio):
             batch_size = self.dataset.num_samples
         self.mfccs, _, self.labels = load_batch_mfcc_lips(
             self.dataset, batch_size=batch_size,
-            shuffle=shuffle, is_training=False)
+            shuffle=shuffle, is_training=False, num_epochs=self.num_epochs)
         return self.dataset
 
 
@@ -56,10 +59,12 @@ class TrainClassifyVideoAVSR(TrainClassifyVideo):
     def get_data(self, tfrecord_dir, batch_size):
         self.dataset_train = get_split_mfcc_lips('train_all', tfrecord_dir)
         _, self.videos_train, self.labels_train = load_batch_mfcc_lips(
-            self.dataset_train, batch_size=batch_size)
+            self.dataset_train, batch_size=batch_size,
+            num_epochs=self.num_epochs)
         self.dataset_test = get_split_mfcc_lips('validation', tfrecord_dir)
         _, self.videos_test, self.labels_test = load_batch_mfcc_lips(
-            self.dataset_test, batch_size=batch_size, is_training=False)
+            self.dataset_test, batch_size=batch_size, is_training=False,
+            num_epochs=self.num_epochs)
         return self.dataset_train
 
 
@@ -74,10 +79,12 @@ class TrainClassifyVideoAVSRAT(TrainClassifyVideo):
     def get_data(self, tfrecord_dir, batch_size):
         self.dataset_train = get_split_mfcc_lips('trainAT', tfrecord_dir)
         _, self.videos_train, self.labels_train = load_batch_mfcc_lips(
-            self.dataset_train, batch_size=batch_size)
+            self.dataset_train, batch_size=batch_size,
+            num_epochs=self.num_epochs)
         self.dataset_test = get_split_mfcc_lips('validation', tfrecord_dir)
         _, self.videos_test, self.labels_test = load_batch_mfcc_lips(
-            self.dataset_test, batch_size=batch_size, is_training=False)
+            self.dataset_test, batch_size=batch_size, is_training=False,
+            num_epochs=self.num_epochs)
         return self.dataset_train
 
 
@@ -90,12 +97,22 @@ class EvaluateClassifyVideoAVSR(EvaluateClassifyVideo):
             batch_size = self.dataset.num_samples
         _, self.videos, self.labels = load_batch_mfcc_lips(
             self.dataset, batch_size=batch_size,
-            shuffle=shuffle, is_training=False)
+            shuffle=shuffle, is_training=False, num_epochs=self.num_epochs)
         return self.dataset
 
 
 class TrainTransfer(TrainClassify):
-    """Fine tune the video model using audio data."""
+    """Fine tune the video model using audio data.
+
+    By default the nearest neighbours of the audio representations are
+    found by an exact search in the graph. For large reference sets an
+    index of `multimodal.AVSR.knn` can be given instead, for example
+    `TrainTransfer(knn_index=PQIndex())`. It's built once the reference
+    representations are computed (see `extra_initialization`).
+    """
+
+    # The `NeighborIndex` used for the KNN, `None` to do an exact search.
+    knn_index = None
 
     @property
     def default_trainable_scopes(self):
@@ -117,17 +134,20 @@ class TrainTransfer(TrainClassify):
         # Read video data having labels A to T.
         self.dataset_trainAT = get_split_mfcc_lips('trainAT', tfrecord_dir)
         _, self.videos_train, self.labels_trainAT = load_batch_mfcc_lips(
-            self.dataset_trainAT, batch_size=batch_size)
+            self.dataset_trainAT, batch_size=batch_size,
+            num_epochs=self.num_epochs)
 
         # Read audio data having labels U to Z.
         self.dataset_trainUZ = get_split_mfcc_lips('trainUZ', tfrecord_dir)
         self.mfccs_train, _, self.labels_trainUZ = load_batch_mfcc_lips(
-            self.dataset_trainUZ, batch_size=batch_size, is_training=False)
+            self.dataset_trainUZ, batch_size=batch_size, is_training=False,
+            num_epochs=self.num_epochs)
 
         # Read data for test.
         self.dataset_test = get_split_mfcc_lips('validation', tfrecord_dir)
         _, self.videos_test, self.labels_test = load_batch_mfcc_lips(
-            self.dataset_test, batch_size=batch_size, is_training=False)
+            self.dataset_test, batch_size=batch_size, is_training=False,
+            num_epochs=self.num_epochs)
 
         # Read all the data with labels A to T once before the beginning
         # of training in order to do KNN later.
@@ -142,9 +162,12 @@ class TrainTransfer(TrainClassify):
         return self.dataset_trainAT
 
     def decide_used_data(self):
-        self.videos = tf.cond(
-            self.training, lambda: self.videos_train,
-            lambda: self.videos_test)
+        self.videos = self.select_data(self.videos_train, self.videos_test)
+        # Audio data is never used for test, it's replaced by zeros so that
+        # the training audio pipeline isn't run by the tests.
+        test_batch_size = tf.shape(self.labels_test)[0]
+        self.mfccs = self.select_data(self.mfccs_train, tf.zeros(
+            [test_batch_size] + self.mfccs_train.get_shape()[1:].as_list()))
 
     def compute(self,
                 audio_midpoint='Conv2d_b_3x3',
@@ -163,6 +186,38 @@ class TrainTransfer(TrainClassify):
             **kwargs: Other arguments passed to `compute_logits_from_audio`
                 and `compute_logits_from_video`.
         """
+        self.K = K
+
+        # The representations used by the KNN are shared by all the
+        # towers (see `Train.compute_towers`), so they're only computed
+        # the first time `compute` is called in the graph.
+        if (getattr(self, 'all_mfcc_reprs', None) is None or
+                self.all_mfcc_reprs.graph is not tf.get_default_graph()):
+            self.compute_all_reprs(audio_midpoint, video_midpoint)
+
+        num_classes = self.dataset_trainAT.num_classes
+        video_logits = self.compute_logits_from_video(
+            self.videos, num_classes, **kwargs)
+        audio_logits = self.compute_logits_from_audio(
+            self.mfccs,
+            num_classes,
+            audio_midpoint=audio_midpoint,
+            video_midpoint=video_midpoint, K=K, **kwargs)
+
+        # Use audio data with probability `use_audio_prob` during training,
+        # always use video data for test.
+        self.use_audio = self.select_data(
+            tf.random_uniform([]) < use_audio_prob, tf.constant(False))
+        self.logits = tf.cond(
+            self.use_audio, lambda: audio_logits, lambda: video_logits)
+        labels = tf.cond(
+            self.use_audio,
+            lambda: self.labels_trainUZ, lambda: self.labels_trainAT)
+        self.labels = self.select_data(labels, self.labels_test)
+
+    def compute_all_reprs(self, audio_midpoint, video_midpoint):
+        """Define the variables holding the representations of all the
+        data having labels A to T, used for KNN."""
         num_samples = self.dataset_trainAT.num_samples
 
         # Compute all the audio high-level representations for KNN.
@@ -178,31 +233,6 @@ class TrainTransfer(TrainClassify):
                 self.all_videos, final_endpoint=video_midpoint),
                 trainable=False, name='video_reprs')
 
-        num_classes = self.dataset_trainAT.num_classes
-        video_logits = self.compute_logits_from_video(
-            self.videos, num_classes, **kwargs)
-        audio_logits = self.compute_logits_from_audio(
-            self.mfccs_train,
-            num_classes,
-            audio_midpoint=audio_midpoint,
-            video_midpoint=video_midpoint, K=K, **kwargs)
-
-        # Use audio data with probability `use_audio_prob` during training.
-        self.video_or_audio = tf.random_uniform([])
-        self.use_audio_prob = use_audio_prob
-        logits = tf.cond(
-            self.video_or_audio < self.use_audio_prob,
-            lambda: audio_logits, lambda: video_logits)
-        labels = tf.cond(
-            self.video_or_audio < self.use_audio_prob,
-            lambda: self.labels_trainUZ, lambda: self.labels_trainAT)
-
-        # Always use video data for test.
-        self.logits = tf.cond(
-            self.training, lambda: logits, lambda: video_logits)
-        self.labels = tf.cond(
-            self.training, lambda: labels, lambda: self.labels_test)
-
     # Because it's an abstract method and should be implemented ...
     def compute_logits(self, inputs, num_classes):
         pass
@@ -227,22 +257,16 @@ class TrainTransfer(TrainClassify):
         with tf.variable_scope('Audio', [inputs]):
             audio_reprs = self.audio_architecture(
                 inputs, final_endpoint=audio_midpoint)
-        final_video_reprs = []
-
-        # Doing KNN
-        for i in range(audio_reprs.get_shape()[0]):
-            audio_repr = tf.reshape(audio_reprs[i], [1, -1])
-            audio_repr = tf.tile(
-                audio_repr, [self.dataset_trainAT.num_samples, 1])
-            distances = tf.negative(tf.sqrt(tf.reduce_sum(
-                tf.square(audio_repr-self.all_mfcc_reprs), axis=1)))
-            values, indices = tf.nn.top_k(distances, k=K)
-            video_reprs = tf.stack(
-                [self.all_video_reprs[indices[j]] for j in range(K)], 0)
-            video_repr = tf.reduce_mean(video_reprs, axis=0)
-            final_video_reprs.append(video_repr)
-
-        final_video_reprs = tf.stack(final_video_reprs, axis=0)
+
+        # Doing KNN, the video representations of the K nearest audio
+        # representations are averaged (for the whole batch at once).
+        if self.knn_index is None:
+            final_video_reprs = knn_mean(
+                audio_reprs, self.all_mfcc_reprs, self.all_video_reprs, K)
+        else:
+            self.audio_queries = flatten(audio_reprs)
+            final_video_reprs = index_knn_mean(
+                self.knn_index, audio_reprs, self.all_video_reprs, K)
 
         logits = self.compute_logits_from_video(
             final_video_reprs, num_classes,
@@ -251,9 +275,8 @@ class TrainTransfer(TrainClassify):
         return logits
 
     def step_log_info(self, sess):
-        self.loss, _,  video_or_audio = self.train_step(
-            sess, self.train_op, self.sv.global_step, self.video_or_audio)
-        use_audio = video_or_audio < self.use_audio_prob
+        self.loss, _, use_audio = self.train_step(
+            sess, self.train_op, self.sv.global_step, self.use_audio)
         if use_audio:
             tf.logging.info('audios were used to train')
         else:
@@ -261,11 +284,10 @@ class TrainTransfer(TrainClassify):
 
     def summary_log_info(self, sess):
         self.loss, _, _, summaries, streaming_accuracy_rate, \
-            accuracy_rate, video_or_audio = self.train_step(
+            accuracy_rate, use_audio = self.train_step(
                 sess, self.train_op, self.sv.global_step,
                 self.metric_op, self.summary_op, self.streaming_accuracy,
-                self.accuracy, self.video_or_audio)
-        use_audio = video_or_audio < self.use_audio_prob
+                self.accuracy, self.use_audio)
         if use_audio:
             tf.logging.info('audios were used to train')
         else:
@@ -344,10 +366,28 @@ class TrainTransfer(TrainClassify):
         """
         tf.logging.info('Preparing pre-computed representations.')
         sess.run(self.extra_init_op, feed_dict={self.batch_stat: True})
+        if self.knn_index is not None:
+            self.build_knn_index(sess)
         tf.logging.info('Finish restoring and preparing values.')
         self.sv.saver.save(sess, self.sv.save_path,
                            global_step=self.sv.global_step)
 
+    def build_knn_index(self, sess):
+        """Build the index from the pre-computed audio representations.
+
+        The recall@K of the index is evaluated on a batch of training
+        audio data and it's logged and written to the event files.
+        """
+        tf.logging.info('Building the nearest neighbour index.')
+        mfcc_reprs, queries = sess.run(
+            [self.all_mfcc_reprs, self.audio_queries],
+            feed_dict={self.training: True, self.batch_stat: True})
+        self.knn_index.build(mfcc_reprs)
+        recall = self.knn_index.evaluate_recall(mfcc_reprs, queries, self.K)
+        tf.logging.info('Recall@%d of the index: %.4f', self.K, recall)
+        self.sv.summary_computed(sess, tf.Summary(value=[tf.Summary.Value(
+            tag='knn/recall_at_%d' % self.K, simple_value=recall)]))
+
 
 class EvaluateTransfer(EvaluateClassifyVideo):
     """Evaluate the fine-tuned model on different part of dataset."""
@@ -358,14 +398,11 @@ class EvaluateTransfer(EvaluateClassifyVideo):
             batch_size = self.dataset.num_samples
         _, self.videos, self.labels = load_batch_mfcc_lips(
             self.dataset, batch_size=batch_size,
-            shuffle=shuffle, is_training=False)
+            shuffle=shuffle, is_training=False, num_epochs=self.num_epochs)
         return self.dataset
 
-    def init_model(self, sess, checkpoint_dirs):
-        assert len(checkpoint_dirs) == 1
-        checkpoint_path = tf.train.latest_checkpoint(checkpoint_dirs[0])
+    def get_saver(self):
         variables_to_restore = {}
         for var in tf.model_variables():
             variables_to_restore['Main/'+var.op.name] = var
-        saver = tf.train.Saver(variables_to_restore)
-        saver.restore(sess, checkpoint_path)
+        return tf.train.Saver(variables_to_restore)
@@ -7,6 +7,7 @@ from __future__ import print_function
 import tensorflow as tf
 
 from data.mfcc import load_batch_mfcc, get_split_mfcc
+from multimodal.AVSR.knn import knn_vote
 from routines.evaluate import Evaluate
 
 
@@ -44,24 +45,9 @@ class StoringValuesTest(Evaluate):
 class KNNTest(StoringValuesTest):
 
     def compute(self, K=10):
-        predicted_labels = []
-        n_samples = self.dataset.num_samples
-        for i in range(self.mfccs.get_shape()[0]):
-            mfcc = tf.tile(
-                tf.expand_dims(self.mfccs[i], 0),
-                [n_samples, 1, 1, 1])
-            mfcc = tf.reshape(mfcc, [n_samples, -1])
-            all_mfccs = tf.reshape(self.all_mfccs, [n_samples, -1])
-            distances = tf.negative(tf.sqrt(
-                tf.reduce_sum(tf.square(mfcc-all_mfccs), axis=1)))
-            print(distances.get_shape())
-            values, indices = tf.nn.top_k(distances, k=K)
-            print(indices.get_shape())
-            print(self.all_labels.get_shape())
-            nn = tf.stack([self.all_labels[indices[j]] for j in range(K)], 0)
-            y, idx, count = tf.unique_with_counts(nn)
-            predicted_labels.append(y[tf.argmax(count, 0)])
-        self.predicted_labels = tf.stack(predicted_labels, 0)
+        self.predicted_labels = knn_vote(
+            self.mfccs, self.all_mfccs, self.all_labels, K,
+            num_classes=self.dataset.num_classes)
 
     def step_log_info(self, sess):
         predicted_labels, true_labels = \
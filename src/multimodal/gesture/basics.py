@@ -4,8 +4,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import tensorflow as tf
-
 from routines.train import Train
 from routines.evaluate import Evaluate
 from routines.visualize import Visualize
@@ -14,6 +12,11 @@ from data.color_depth import load_batch_color_depth, get_split_color_depth
 
 class TrainColorDepth(Train):
 
+    # The dtype used to keep the decoded images in memory after the
+    # first epoch ('uint8', 'float16' or 'float32'), `None` to decode
+    # them at every epoch (see `load_batch_color_depth`).
+    data_cache = None
+
     def __init__(self, image_size=299,
                  color_channels=3, depth_channels=3, **kwargs):
         super(TrainColorDepth, self).__init__(**kwargs)
@@ -27,40 +30,43 @@ class TrainColorDepth(Train):
             'train',
             tfrecord_dir,
             color_channels=self.color_channels,
-            depth_channels=self.depth_channels)
+            depth_channels=self.depth_channels,
+            image_size=self.image_size)
 
         self.images_color_train, self.images_depth_train, self.labels_train = \
             load_batch_color_depth(
                 self.dataset_train, height=self.image_size,
-                width=self.image_size, batch_size=batch_size)
+                width=self.image_size, batch_size=batch_size,
+                num_epochs=self.num_epochs, cache=self.data_cache)
 
         self.dataset_test = get_split_color_depth(
             'validation',
             tfrecord_dir,
             color_channels=self.color_channels,
-            depth_channels=self.depth_channels)
+            depth_channels=self.depth_channels,
+            image_size=self.image_size)
 
         self.images_color_test, self.images_depth_test, self.labels_test = \
             load_batch_color_depth(
                 self.dataset_test, height=self.image_size,
-                width=self.image_size, batch_size=batch_size)
+                width=self.image_size, batch_size=batch_size,
+                num_epochs=self.num_epochs, cache=self.data_cache)
 
         return self.dataset_train
 
     def decide_used_data(self):
-        self.images_color = tf.cond(
-            self.training, lambda: self.images_color_train,
-            lambda: self.images_color_test)
-        self.images_depth = tf.cond(
-            self.training, lambda: self.images_depth_train,
-            lambda: self.images_depth_test)
-        self.labels = tf.cond(
-            self.training, lambda: self.labels_train,
-            lambda: self.labels_test)
+        self.images_color = self.select_data(
+            self.images_color_train, self.images_color_test)
+        self.images_depth = self.select_data(
+            self.images_depth_train, self.images_depth_test)
+        self.labels = self.select_data(self.labels_train, self.labels_test)
 
 
 class EvaluateColorDepth(Evaluate):
 
+    # See `TrainColorDepth`.
+    data_cache = None
+
     def __init__(self, image_size=299, color_channels=3, depth_channels=3):
         self.image_size = image_size
         self.color_channels = color_channels
@@ -71,13 +77,16 @@ class EvaluateColorDepth(Evaluate):
             split_name,
             tfrecord_dir,
             color_channels=self.color_channels,
-            depth_channels=self.depth_channels)
+            depth_channels=self.depth_channels,
+            image_size=self.image_size)
         if batch_size is None:
             batch_size = self.dataset.num_samples
         self.images_color, self.images_depth, self.labels = \
             load_batch_color_depth(
                 self.dataset, height=self.image_size,
-                width=self.image_size, batch_size=batch_size, shuffle=shuffle)
+                width=self.image_size, batch_size=batch_size,
+                shuffle=shuffle, num_epochs=self.num_epochs,
+                cache=self.data_cache)
         return self.dataset
 
 
@@ -95,7 +104,8 @@ class VisualizeColorDepth(Visualize):
             split_name,
             tfrecord_dir,
             color_channels=self.color_channels,
-            depth_channels=self.depth_channels)
+            depth_channels=self.depth_channels,
+            image_size=self.image_size)
         self.images_color, self.images_depth, self.labels = \
             load_batch_color_depth(
                 self.dataset, height=self.image_size,
@@ -12,20 +12,37 @@ import tensorflow as tf
 from multimodal.gesture.basics import TrainColorDepth, EvaluateColorDepth
 from classify.train import TrainClassify
 from classify.evaluate import EvaluateClassify
+from classify.cached import TrainClassifyCached, EvaluateClassifyCached
 from images.classify_routines import TrainClassifyImages
 from images.classify_routines import EvaluateClassifyImages
 
 slim = tf.contrib.slim
 
 
-class TrainClassifyCommonRepr(TrainClassifyImages):
+def compute_common_repr(architecture, inputs, modality):
+    """Feed images of one modality to the bimodal CAE, with zeros in
+    the other modality, and return the shared representation."""
+    assert modality in ['color', 'depth']
+    if modality == 'color':
+        return architecture(
+            inputs, tf.zeros_like(inputs),
+            final_endpoint='Middle',
+            color_keep_prob=tf.constant(1, tf.float32))
+    return architecture(
+        tf.zeros_like(inputs), inputs,
+        final_endpoint='Middle',
+        color_keep_prob=tf.constant(0, tf.float32))
+
+
+class TrainClassifyCommonRepr(TrainClassifyCached, TrainClassifyImages):
     """Train a classifier of single-modality images using the shared
     representation.
 
     In input we take only images of one modality, but we feed it to
     the bimodal CAE with zeros in another modality and build a
     perceptron on the shared representation (the middle layer)
-    that we get. We train only this perceptron.
+    that we get. We train only this perceptron, so the shared
+    representations can be stored by giving `feature_cache_dir`.
     """
 
     @property
@@ -39,17 +56,15 @@ class TrainClassifyCommonRepr(TrainClassifyImages):
 
     def compute_logits(self, inputs, num_classes,
                        modality='color', dropout_keep_prob=0.8):
-        assert modality in ['color', 'depth']
-        if modality == 'color':
-            net = self.architecture(
-                inputs, tf.zeros_like(inputs),
-                final_endpoint='Middle',
-                color_keep_prob=tf.constant(1, tf.float32))
-        elif modality == 'depth':
-            net = self.architecture(
-                tf.zeros_like(inputs), inputs,
-                final_endpoint='Middle',
-                color_keep_prob=tf.constant(0, tf.float32))
+        net = self.compute_representation(inputs, modality)
+        return self.compute_logits_from_representation(
+            net, num_classes, dropout_keep_prob)
+
+    def compute_representation(self, inputs, modality='color'):
+        return compute_common_repr(self.architecture, inputs, modality)
+
+    def compute_logits_from_representation(self, net, num_classes,
+                                           dropout_keep_prob=0.8):
         net = slim.dropout(net, dropout_keep_prob, scope='PreLogitsDropout')
         net = slim.flatten(net, scope='PreLogitsFlatten')
         logits = slim.fully_connected(
@@ -65,24 +80,21 @@ class TrainClassifyCommonRepr(TrainClassifyImages):
             checkpoint_path, variables_to_restore)
 
 
-class EvaluateClassifyCommonRepr(EvaluateClassifyImages):
+class EvaluateClassifyCommonRepr(EvaluateClassifyCached,
+                                 EvaluateClassifyImages):
 
     def __init__(self, architecture, **kwargs):
         super(EvaluateClassifyCommonRepr, self).__init__(**kwargs)
         self.architecture = architecture
 
     def compute_logits(self, inputs, num_classes, modality='color'):
-        assert modality in ['color', 'depth']
-        if modality == 'color':
-            net = self.architecture(
-                inputs, tf.zeros_like(inputs),
-                final_endpoint='Middle',
-                color_keep_prob=tf.constant(1, tf.float32))
-        elif modality == 'depth':
-            net = self.architecture(
-                tf.zeros_like(inputs), inputs,
-                final_endpoint='Middle',
-                color_keep_prob=tf.constant(0, tf.float32))
+        net = self.compute_representation(inputs, modality)
+        return self.compute_logits_from_representation(net, num_classes)
+
+    def compute_representation(self, inputs, modality='color'):
+        return compute_common_repr(self.architecture, inputs, modality)
+
+    def compute_logits_from_representation(self, net, num_classes):
         net = slim.flatten(net, scope='PreLogitsFlatten')
         logits = slim.fully_connected(
             net, num_classes, activation_fn=None, scope='Logits')
@@ -176,9 +188,26 @@ class EvaluateClassifyFusion(EvaluateColorDepth, EvaluateClassify):
         return logits
 
 
-class TrainClassifyEmbedding(TrainClassifyImages):
+def compute_embedding(architecture, inputs, endpoint, modality,
+                      feature_length, unit_normalization):
+    """Compute the embedding of images of one modality."""
+    assert modality in ['color', 'depth']
+    scope_name = 'Color' if modality == 'color' else 'Depth'
+
+    with tf.variable_scope(scope_name):
+        net = architecture(inputs, final_endpoint=endpoint)
+        net = slim.flatten(net)
+    with tf.variable_scope('Embedding'):
+        net = slim.fully_connected(net, feature_length, scope=scope_name)
+    if unit_normalization:
+        net = slim.unit_norm(net, 1)
+    return net
+
+
+class TrainClassifyEmbedding(TrainClassifyCached, TrainClassifyImages):
     """Train a perceptron on a learned common embedding
-    (see `embedding.py`)"""
+    (see `embedding.py`), the embeddings can be stored by giving
+    `feature_cache_dir`."""
 
     @property
     def default_trainable_scopes(self):
@@ -191,17 +220,20 @@ class TrainClassifyEmbedding(TrainClassifyImages):
     def compute_logits(self, inputs, num_classes, endpoint='Middle',
                        modality='color', feature_length=512,
                        dropout_keep_prob=0.8, unit_normalization=True):
-        assert modality in ['color', 'depth']
-        scope_name = 'Color' if modality == 'color' else 'Depth'
-
-        with tf.variable_scope(scope_name):
-            net = self.architecture(
-                inputs, final_endpoint=endpoint)
-            net = slim.flatten(net)
-        with tf.variable_scope('Embedding'):
-            net = slim.fully_connected(net, feature_length, scope=scope_name)
-        if unit_normalization:
-            net = slim.unit_norm(net, 1)
+        net = self.compute_representation(
+            inputs, endpoint, modality, feature_length, unit_normalization)
+        return self.compute_logits_from_representation(
+            net, num_classes, dropout_keep_prob)
+
+    def compute_representation(self, inputs, endpoint='Middle',
+                               modality='color', feature_length=512,
+                               unit_normalization=True):
+        return compute_embedding(
+            self.architecture, inputs, endpoint, modality,
+            feature_length, unit_normalization)
+
+    def compute_logits_from_representation(self, net, num_classes,
+                                           dropout_keep_prob=0.8):
         net = slim.dropout(net, dropout_keep_prob, scope='PreLogitsDropout')
         logits = slim.fully_connected(
             net, num_classes, activation_fn=None, scope='Logits')
@@ -217,7 +249,8 @@ class TrainClassifyEmbedding(TrainClassifyImages):
             checkpoint_path, variables_to_restore)
 
 
-class EvaluateClassifyEmbedding(EvaluateClassifyImages):
+class EvaluateClassifyEmbedding(EvaluateClassifyCached,
+                                EvaluateClassifyImages):
 
     def __init__(self, architecture, **kwargs):
         super(EvaluateClassifyEmbedding, self).__init__(**kwargs)
@@ -227,17 +260,18 @@ class EvaluateClassifyEmbedding(EvaluateClassifyImages):
                        endpoint='Middle', modality='color',
                        feature_length=512,
                        unit_normalization=True):
-        assert modality in ['color', 'depth']
-        scope_name = 'Color' if modality == 'color' else 'Depth'
-
-        with tf.variable_scope(scope_name):
-            net = self.architecture(
-                inputs, final_endpoint=endpoint)
-            net = slim.flatten(net)
-        with tf.variable_scope('Embedding'):
-            net = slim.fully_connected(net, feature_length, scope=scope_name)
-        if unit_normalization:
-            net = slim.unit_norm(net, 1)
+        net = self.compute_representation(
+            inputs, endpoint, modality, feature_length, unit_normalization)
+        return self.compute_logits_from_representation(net, num_classes)
+
+    def compute_representation(self, inputs, endpoint='Middle',
+                               modality='color', feature_length=512,
+                               unit_normalization=True):
+        return compute_embedding(
+            self.architecture, inputs, endpoint, modality,
+            feature_length, unit_normalization)
+
+    def compute_logits_from_representation(self, net, num_classes):
         logits = slim.fully_connected(
             net, num_classes, activation_fn=None, scope='Logits')
         return logits
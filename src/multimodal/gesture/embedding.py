@@ -161,8 +161,7 @@ class TrainEmbedding(TrainColorDepth):
     def test_log_info(self, sess, test_use_batch):
         ls, summaries_test = sess.run(
             [self.total_loss, self.test_summary_op],
-            feed_dict={self.training: False,
-                       self.batch_stat: test_use_batch})
+            feed_dict=self.test_feed_dict(sess, test_use_batch))
         tf.logging.info('Current Test Loss: %s', ls)
         self.sv.summary_computed(sess, summaries_test)
 
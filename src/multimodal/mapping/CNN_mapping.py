@@ -3,6 +3,11 @@
 This was written near the beginning of my internship and since I didn't
 do further test on it, it isn't integrated in the whole training framework
 and is separated apart from the other codes. Just ignore it.
+
+The two InceptionV4 networks are frozen, so when `feature_cache_dir` is
+given to `train_mapping` their pooled features are computed once and
+stored (see `data/feature_cache.py`), and only the mapping is computed
+at each step.
 """
 
 from __future__ import absolute_import
@@ -18,11 +23,18 @@ import tensorflow as tf
 from nets_base import inception_v4
 
 from data.color_depth import get_split_color_depth, load_batch_color_depth
+from data.feature_cache import FeatureCache, checkpoint_signature
 from nets_base.arg_scope import nets_arg_scope
 
 slim = tf.contrib.slim
 
 
+def get_checkpoint_path(checkpoints_dir):
+    if tf.train.checkpoint_exists(checkpoints_dir):
+        return tf.train.latest_checkpoint(checkpoints_dir)
+    return os.path.join(checkpoints_dir, 'inception_v4.ckpt')
+
+
 def get_init_fn(checkpoints_dir_color, checkpoints_dir_depth):
 
     variables_color = {}
@@ -37,19 +49,8 @@ def get_init_fn(checkpoints_dir_color, checkpoints_dir_depth):
     saver_color = tf.train.Saver(variables_color)
     saver_depth = tf.train.Saver(variables_depth)
 
-    if tf.train.checkpoint_exists(checkpoints_dir_color):
-        checkpoint_path_color = tf.train.latest_checkpoint(
-            checkpoints_dir_color)
-    else:
-        checkpoint_path_color = os.path.join(
-            checkpoints_dir_color, 'inception_v4.ckpt')
-
-    if tf.train.checkpoint_exists(checkpoints_dir_depth):
-        checkpoint_path_depth = tf.train.latest_checkpoint(
-            checkpoints_dir_depth)
-    else:
-        checkpoint_path_depth = os.path.join(
-            checkpoints_dir_depth, 'inception_v4.ckpt')
+    checkpoint_path_color = get_checkpoint_path(checkpoints_dir_color)
+    checkpoint_path_depth = get_checkpoint_path(checkpoints_dir_depth)
 
     def restore(sess):
         saver_color.restore(sess, checkpoint_path_color)
@@ -68,6 +69,71 @@ def inception_feature(net):
         return net
 
 
+def inception_features(images_color, images_depth, is_training):
+    """Compute the pooled features of the color and depth networks."""
+    with slim.arg_scope(nets_arg_scope(is_training=is_training)):
+        with tf.variable_scope('Color', values=[images_color]):
+            net_color, _ = inception_v4.inception_v4_base(images_color)
+            net_color = inception_feature(net_color)
+
+        with tf.variable_scope('Depth', values=[images_depth]):
+            net_depth, _ = inception_v4.inception_v4_base(images_depth)
+            net_depth = inception_feature(net_depth)
+    return net_color, net_depth
+
+
+def cache_inception_features(tfrecord_dir,
+                             checkpoints_dir_color,
+                             checkpoints_dir_depth,
+                             feature_cache_dir,
+                             batch_size=24,
+                             image_size=299):
+    """Store the pooled features of the train and validation splits.
+
+    For each image pair the color and depth features are concatenated.
+    They're computed with the moving mean/variance of batch normalization
+    and only when the stored ones are missing or out of date.
+
+    Returns:
+        The `FeatureCache` instance.
+    """
+    signature = '%s-%s' % (
+        checkpoint_signature(get_checkpoint_path(checkpoints_dir_color)),
+        checkpoint_signature(get_checkpoint_path(checkpoints_dir_depth)))
+    config = {'tfrecord_dir': os.path.abspath(tfrecord_dir),
+              'image_size': image_size,
+              'features': 'inception_v4_pooled_color_depth'}
+    cache = FeatureCache(feature_cache_dir)
+
+    for split_name in ['train', 'validation']:
+        if cache.is_valid(split_name, signature, config):
+            continue
+        tf.logging.info('Computing the features of %s', split_name)
+        with tf.Graph().as_default():
+            dataset = get_split_color_depth(
+                split_name, tfrecord_dir, image_size=image_size)
+            images_color, images_depth, labels = load_batch_color_depth(
+                dataset, height=image_size, width=image_size,
+                batch_size=batch_size, shuffle=False, num_epochs=1)
+            net_color, net_depth = inception_features(
+                images_color, images_depth, False)
+            features = tf.concat([net_color, net_depth], 1)
+            restore = get_init_fn(checkpoints_dir_color, checkpoints_dir_depth)
+
+            with tf.Session() as sess:
+                restore(sess)
+
+                def batches():
+                    while True:
+                        try:
+                            yield sess.run([features, labels])
+                        except tf.errors.OutOfRangeError:
+                            return
+
+                cache.write(split_name, batches(), dataset, signature, config)
+    return cache
+
+
 def train_step(sess, train_op, global_step, *args):
 
     tensors_to_run = [train_op, global_step]
@@ -99,47 +165,62 @@ def train_mapping(tfrecord_dir,
                   dropout_keep_prob=0.8,
                   initial_learning_rate=0.005,
                   lr_decay_steps=100,
-                  lr_decay_rate=0.8):
+                  lr_decay_rate=0.8,
+                  feature_cache_dir=None):
+    """Train a linear mapping from color features to depth features.
+
+    If `feature_cache_dir` is given, the features of the two frozen
+    networks are read from there (see `cache_inception_features`).
+    """
 
     if not tf.gfile.Exists(log_dir):
         tf.gfile.MakeDirs(log_dir)
 
     image_size = 299
 
+    if feature_cache_dir is not None:
+        cache = cache_inception_features(
+            tfrecord_dir, checkpoints_dir_color, checkpoints_dir_depth,
+            feature_cache_dir, batch_size, image_size)
+
     with tf.Graph().as_default():
         tf.logging.set_verbosity(tf.logging.INFO)
 
         with tf.name_scope('Data_provider'):
-            dataset = get_split_color_depth('train', tfrecord_dir)
-            images_color_train, images_depth_train, _ = \
-                load_batch_color_depth(
+            if feature_cache_dir is None:
+                dataset = get_split_color_depth(
+                    'train', tfrecord_dir, image_size=image_size)
+                inputs_train = load_batch_color_depth(
                     dataset, height=image_size, width=image_size,
-                    batch_size=batch_size)
+                    batch_size=batch_size)[:2]
 
-            dataset_test = get_split_color_depth('validation', tfrecord_dir)
-            images_color_test, images_depth_test, _ = \
-                load_batch_color_depth(
+                dataset_test = get_split_color_depth(
+                    'validation', tfrecord_dir, image_size=image_size)
+                inputs_test = load_batch_color_depth(
                     dataset_test, height=image_size, width=image_size,
-                    batch_size=batch_size)
-
+                    batch_size=batch_size)[:2]
+            else:
+                dataset = cache.get_split('train')
+                inputs_train = cache.load_batch('train', batch_size)[:1]
+                inputs_test = cache.load_batch('validation', batch_size)[:1]
+
+        # Validation batches are computed alone and fed in place of the
+        # training ones, so they're not read at every training step.
         training = tf.placeholder(tf.bool, shape=(), name='training')
-        images_color = tf.cond(training, lambda: images_color_train,
-                               lambda: images_color_test)
-        images_depth = tf.cond(training, lambda: images_depth_train,
-                               lambda: images_depth_test)
+        inputs = [tf.placeholder_with_default(tensor, tensor.get_shape())
+                  for tensor in inputs_train]
 
         if number_of_steps is None:
             number_of_steps = int(np.ceil(
                 dataset.num_samples * number_of_epochs / batch_size))
 
         with slim.arg_scope(nets_arg_scope(is_training=training)):
-            with tf.variable_scope('Color', values=[images_color]):
-                net_color, _ = inception_v4.inception_v4_base(images_color)
-                net_color = inception_feature(net_color)
-
-            with tf.variable_scope('Depth', values=[images_depth]):
-                net_depth, _ = inception_v4.inception_v4_base(images_depth)
-                net_depth = inception_feature(net_depth)
+            if feature_cache_dir is None:
+                images_color, images_depth = inputs
+                net_color, net_depth = inception_features(
+                    images_color, images_depth, training)
+            else:
+                net_color, net_depth = tf.split(inputs[0], 2, axis=1)
 
             mapping = slim.fully_connected(
                 net_color, net_depth.get_shape()[1].value, activation_fn=None,
@@ -182,21 +263,24 @@ def train_mapping(tfrecord_dir,
 
         tf.summary.scalar('learning_rate', learning_rate)
         tf.summary.scalar('losses/train/total_loss', total_loss)
-        tf.summary.image('train/color', images_color)
-        tf.summary.image('train/depth', images_depth)
+        if feature_cache_dir is None:
+            tf.summary.image('train/color', images_color)
+            tf.summary.image('train/depth', images_depth)
         summary_op = tf.summary.merge_all()
 
-        ls_test_summary = tf.summary.scalar(
-            'losses/test/total_loss', total_loss)
-        imgs_test_color_summary = tf.summary.image('test/color', images_color)
-        imgs_test_depth_summary = tf.summary.image('test/depth', images_depth)
-        test_summary_op = tf.summary.merge(
-            [ls_test_summary, imgs_test_color_summary,
-             imgs_test_depth_summary])
-
+        test_summaries = [tf.summary.scalar(
+            'losses/test/total_loss', total_loss)]
+        if feature_cache_dir is None:
+            test_summaries.append(tf.summary.image('test/color', images_color))
+            test_summaries.append(tf.summary.image('test/depth', images_depth))
+        test_summary_op = tf.summary.merge(test_summaries)
+
+        if feature_cache_dir is None:
+            init_fn = get_init_fn(checkpoints_dir_color, checkpoints_dir_depth)
+        else:
+            init_fn = None
         sv = tf.train.Supervisor(
-            logdir=log_dir, summary_op=None,
-            init_fn=get_init_fn(checkpoints_dir_color, checkpoints_dir_depth))
+            logdir=log_dir, summary_op=None, init_fn=init_fn)
 
         with sv.managed_session() as sess:
             for step in xrange(number_of_steps):
@@ -205,9 +289,11 @@ def train_mapping(tfrecord_dir,
                         sess, train_op, sv.global_step, summary_op)
                     sv.summary_computed(sess, summaries)
                     if do_test:
+                        feed_dict = dict(zip(inputs, sess.run(inputs_test)))
+                        feed_dict[training] = False
                         ls, summaries_test = sess.run(
                             [total_loss, test_summary_op],
-                            feed_dict={training: False})
+                            feed_dict=feed_dict)
                         tf.logging.info('Current Test Loss: %s', ls)
                         sv.summary_computed(sess, summaries_test)
                 else:
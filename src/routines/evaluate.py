@@ -14,7 +14,11 @@ from __future__ import division
 from __future__ import print_function
 
 from six.moves import xrange
+import os
 import abc
+import shutil
+import tempfile
+import multiprocessing
 
 import numpy as np
 import tensorflow as tf
@@ -99,10 +103,41 @@ class EvaluateAbstract(object):
         """Things to be done at the very last step (show some extra info)."""
         pass
 
+    def prepare(self, tfrecord_dir, checkpoint_dirs, split_name,
+                batch_size, use_batch_norm=True, batch_stat=False, **kwargs):
+        """Things to be done before the data is read (ex: compute the
+        representations stored by `classify.cached`).
+
+        It's called by `evaluate`, `evaluate_sweep` and
+        `evaluate_continuously` with their arguments, `kwargs` also
+        contains the arguments of `compute`.
+        """
+        pass
+
     def compute_log_data(self):
         """Compute some values that are used for evaluation."""
         pass
 
+    def get_pass_metric_op(self):
+        """Define the metrics accumulated during a single-pass evaluation.
+
+        The metrics should be stored in local variables, which are
+        initialized before the pass.
+        """
+        pass
+
+    def pass_step_log_info(self, sess):
+        """Things to be done at every step of a single-pass evaluation."""
+        pass
+
+    def pass_log_info(self, sess):
+        """Things to be done once the single pass is finished.
+
+        Returns:
+            The results of the evaluation.
+        """
+        pass
+
 
 class Evaluate(EvaluateAbstract):
     """Implementation of the interface `EvaluateAbstract`.
@@ -117,6 +152,11 @@ class Evaluate(EvaluateAbstract):
     all these methods and can be used directly.
     """
 
+    # The number of passes through the data, `get_data` should give it to
+    # the `load_batch_*` functions. It's set to 1 by `self.evaluate` for a
+    # single-pass evaluation and `None` (repeat the data) otherwise.
+    num_epochs = None
+
     def evaluate(self,
                  tfrecord_dir,
                  checkpoint_dirs,
@@ -127,9 +167,16 @@ class Evaluate(EvaluateAbstract):
                  shuffle=False,
                  use_batch_norm=True,
                  batch_stat=False,
+                 single_pass=False,
                  **kwargs):
         """Evaluate the model.
 
+        By default `number_of_steps` batches are read from the repeated
+        data, so the last batch may contain samples that were already seen.
+        With `single_pass` each sample is used exactly once (the last batch
+        may be smaller) and the metrics defined by `self.get_pass_metric_op`
+        are accumulated over the whole pass.
+
         Args:
             tfrecord_dir: The directory that contains the dataset tfreocrds
                 (which can be generated by `convert_TFrecord` scripts).
@@ -147,14 +194,30 @@ class Evaluate(EvaluateAbstract):
                 whether to use batch normalization.
             batch_stat: Whether to use batch statistics or moving
                 mean/variance for batch normalization.
+            single_pass: Whether to go exactly once through the data.
+                `number_of_steps` can still be given to stop earlier
+                but `batch_size` can't be `None`.
             **kwargs: Arguments pass to the `self.compute`.
+
+        Returns:
+            The value returned by `self.pass_log_info` for a single-pass
+            evaluation, `None` otherwise.
         """
+        if single_pass and batch_size is None:
+            raise ValueError(
+                'batch_size must be given for a single-pass evaluation')
+
         if log_dir is not None and not tf.gfile.Exists(log_dir):
             tf.gfile.MakeDirs(log_dir)
 
+        self.num_epochs = 1 if single_pass else None
+
         if not isinstance(checkpoint_dirs, (tuple, list)):
             checkpoint_dirs = [checkpoint_dirs]
 
+        self.prepare(tfrecord_dir, checkpoint_dirs, split_name, batch_size,
+                     use_batch_norm, batch_stat, **kwargs)
+
         with tf.Graph().as_default():
             tf.logging.set_verbosity(tf.logging.INFO)
 
@@ -178,6 +241,9 @@ class Evaluate(EvaluateAbstract):
                 self.compute(**kwargs)
 
             self.compute_log_data()
+            if single_pass:
+                self.get_pass_metric_op()
+                self.local_init_op = tf.local_variables_initializer()
 
             # Define global step to be show in tensorboard
             global_step = tf.train.get_or_create_global_step()
@@ -188,14 +254,31 @@ class Evaluate(EvaluateAbstract):
                 self.fw = tf.summary.FileWriter(log_dir)
 
             with tf.Session() as sess:
-                with slim.queues.QueueRunners(sess):
-                    sess.run(tf.variables_initializer([global_step]))
-                    self.init_model(sess, checkpoint_dirs)
+                sess.run(tf.variables_initializer([global_step]))
+                self.init_model(sess, checkpoint_dirs)
+
+                if single_pass:
+                    return self.run_single_pass(sess, number_of_steps)
+
+                for step in xrange(number_of_steps-1):
+                    self.step_log_info(sess)
+                self.last_step_log_info(sess, batch_size)
+                tf.logging.info('Finished evaluation')
 
-                    for step in xrange(number_of_steps-1):
-                        self.step_log_info(sess)
-                    self.last_step_log_info(sess, batch_size)
-                    tf.logging.info('Finished evaluation')
+    def run_single_pass(self, sess, number_of_steps):
+        """Go through the data once and return the final results.
+
+        The metrics are reset by `self.local_init_op`, which is built once
+        with the graph so that it can be run before each pass.
+        """
+        sess.run(self.local_init_op)
+        try:
+            for step in xrange(number_of_steps):
+                self.pass_step_log_info(sess)
+        except tf.errors.OutOfRangeError:
+            pass
+        tf.logging.info('Finished evaluation')
+        return self.pass_log_info(sess)
 
     def used_arg_scope(self, batch_stat, use_batch_norm):
         """The slim argument scope that is used for main computations.
@@ -218,12 +301,455 @@ class Evaluate(EvaluateAbstract):
         """Generally just act as natural step."""
         return self.step_log_info(sess)
 
+    def pass_step_log_info(self, sess):
+        """Also act as natural step by default."""
+        return self.step_log_info(sess)
+
+    def get_saver(self):
+        """The saver used to restore the evaluated model.
+
+        It's used both by `self.init_model` and to restore each checkpoint
+        of a sweep, so variables whose names differ in the checkpoints
+        should be mapped here rather than in `self.init_model`.
+        """
+        return tf.train.Saver(tf.model_variables())
+
     def init_model(self, sess, checkpoint_dirs):
         """Simply restore the whole model from the checkpoint."""
         assert len(checkpoint_dirs) == 1
         checkpoint_path = tf.train.latest_checkpoint(checkpoint_dirs[0])
-        saver = tf.train.Saver(tf.model_variables())
-        saver.restore(sess, checkpoint_path)
+        self.get_saver().restore(sess, checkpoint_path)
+
+    def check_checkpoint_restore(self):
+        """Make sure the model can be restored from a single checkpoint.
+
+        `self.evaluate_checkpoints` (and so the sweeps and the continuous
+        evaluation) restores each checkpoint with `self.get_saver`, which
+        is not possible if `self.init_model` is overridden.
+
+        Raises:
+            ValueError: If `self.init_model` is overridden.
+        """
+        for cls in type(self).__mro__:
+            if 'init_model' in cls.__dict__:
+                break
+        if cls is not Evaluate:
+            raise ValueError(
+                '%s overrides init_model, its checkpoints can\'t be '
+                'restored one by one; override get_saver instead'
+                % type(self).__name__)
+
+    def decode_split(self, tfrecord_dir, split_name, batch_size,
+                     session_config=None):
+        """Read a split once and keep the inputs of the model in memory.
+
+        The inputs are the `Tensors` that `self.get_data` stores as
+        attributes (images, labels...). `session_config` is the
+        `tf.ConfigProto` of the session, if any.
+
+        Returns:
+            A dictionary from attribute names to numpy arrays containing
+            the whole split.
+        """
+        num_epochs = self.num_epochs
+        self.num_epochs = 1
+        try:
+            with tf.Graph().as_default():
+                self.get_data(split_name, tfrecord_dir, batch_size, False)
+                names = sorted(
+                    name for name, value in self.__dict__.items()
+                    if isinstance(value, tf.Tensor) and
+                    value.graph is tf.get_default_graph())
+                tensors = [getattr(self, name) for name in names]
+
+                batches = []
+                with tf.Session(config=session_config) as sess:
+                    while True:
+                        try:
+                            batches.append(sess.run(tensors))
+                        except tf.errors.OutOfRangeError:
+                            break
+        finally:
+            self.num_epochs = num_epochs
+        tf.logging.info('Decoded %s: %d batches', split_name, len(batches))
+        return {name: np.concatenate([batch[i] for batch in batches])
+                for i, name in enumerate(names)}
+
+    def evaluate_checkpoints(self,
+                             tfrecord_dir,
+                             checkpoint_paths,
+                             inputs,
+                             batch_size=24,
+                             split_name='validation',
+                             use_batch_norm=True,
+                             batch_stat=False,
+                             session_config=None,
+                             result_fn=None,
+                             **kwargs):
+        """Evaluate several checkpoints with the same graph.
+
+        The model is fed with the arrays given by `self.decode_split`
+        and each checkpoint is evaluated by a single pass through them.
+
+        Args:
+            tfrecord_dir, split_name: Only used to get the `dataset` instance.
+            checkpoint_paths: The paths of the checkpoints to evaluate,
+                it can be any iterable (ex: a generator of new checkpoints).
+            inputs: The arrays returned by `self.decode_split`.
+            batch_size, use_batch_norm, batch_stat, **kwargs:
+                See `self.evaluate`.
+            session_config: The `tf.ConfigProto` of the session, if any.
+            result_fn: If given, it's called with the checkpoint path and
+                the results as soon as a checkpoint is evaluated.
+
+        Returns:
+            The list of the results of `self.pass_log_info`.
+        """
+        self.check_checkpoint_restore()
+        num_epochs = self.num_epochs
+        self.num_epochs = 1
+        names = sorted(inputs)
+        number_of_steps = int(np.ceil(
+            len(inputs[names[0]]) / batch_size))
+
+        try:
+            with tf.Graph().as_default():
+                tf.logging.set_verbosity(tf.logging.INFO)
+
+                # The data pipeline is only built to get `self.dataset`,
+                # the inputs are then replaced by the arrays in memory.
+                with tf.name_scope('Data_provider'):
+                    self.get_data(split_name, tfrecord_dir, batch_size, False)
+                    placeholders = [
+                        tf.placeholder(tf.as_dtype(inputs[name].dtype),
+                                       (None,) + inputs[name].shape[1:])
+                        for name in names]
+                    iterator = tf.data.Dataset.from_tensor_slices(
+                        tuple(placeholders)).batch(batch_size)\
+                        .make_initializable_iterator()
+                    for name, tensor in zip(names, iterator.get_next()):
+                        setattr(self, name, tensor)
+                feed_dict = {placeholder: inputs[name]
+                             for placeholder, name in zip(placeholders, names)}
+
+                with slim.arg_scope(self.used_arg_scope(
+                        batch_stat, use_batch_norm)):
+                    self.compute(**kwargs)
+
+                self.compute_log_data()
+                self.get_pass_metric_op()
+                self.local_init_op = tf.local_variables_initializer()
+
+                global_step = tf.train.get_or_create_global_step()
+                self.global_step_op = tf.assign(global_step, global_step+1)
+                saver = self.get_saver()
+
+                results = []
+                with tf.Session(config=session_config) as sess:
+                    for checkpoint_path in checkpoint_paths:
+                        tf.logging.info('Evaluating %s', checkpoint_path)
+                        sess.run(tf.variables_initializer([global_step]))
+                        sess.run(iterator.initializer, feed_dict=feed_dict)
+                        saver.restore(sess, checkpoint_path)
+                        results.append(
+                            self.run_single_pass(sess, number_of_steps))
+                        if result_fn is not None:
+                            result_fn(checkpoint_path, results[-1])
+        finally:
+            self.num_epochs = num_epochs
+        return results
+
+    def evaluate_sweep(self,
+                       tfrecord_dir,
+                       checkpoint_dir,
+                       log_dir=None,
+                       batch_size=24,
+                       split_name='validation',
+                       checkpoint_paths=None,
+                       num_processes=1,
+                       **kwargs):
+        """Evaluate all the checkpoints of a training directory.
+
+        The split is decoded only once, then the graph is built once and
+        each checkpoint is restored in turn (see `self.evaluate_checkpoints`).
+        With `num_processes` > 1 the checkpoints are distributed over
+        several processes which all build the graph once, the decoded
+        split being shared through memory-mapped files. The instance must
+        then be picklable.
+
+        A table with one line per checkpoint and one column per scalar
+        metric is logged and written to `sweep_<split_name>.tsv` in
+        `log_dir`, and the metrics are written as summaries with the
+        training steps of the checkpoints.
+
+        Args:
+            tfrecord_dir: The directory that contains the dataset tfrecords.
+            checkpoint_dir: The training directory containing the
+                checkpoints to evaluate.
+            log_dir: The directory where the table and the summaries
+                are written, if `None` they're only logged.
+            checkpoint_paths: The checkpoints to evaluate, by default all
+                the checkpoints kept in `checkpoint_dir`.
+            num_processes: The number of processes used for the evaluation.
+            **kwargs: Passed to `self.evaluate_checkpoints`.
+
+        Returns:
+            A list of pairs (checkpoint path, results).
+        """
+        if checkpoint_paths is None:
+            state = tf.train.get_checkpoint_state(checkpoint_dir)
+            if state is None:
+                raise ValueError(
+                    'No checkpoint found in %s' % checkpoint_dir)
+            checkpoint_paths = list(state.all_model_checkpoint_paths)
+        self.check_checkpoint_restore()
+        # `self.pass_log_info` shouldn't write summaries for every pass.
+        self.__dict__.pop('fw', None)
+        self.prepare(tfrecord_dir, [checkpoint_dir], split_name, batch_size,
+                     **kwargs)
+
+        if num_processes == 1:
+            inputs = self.decode_split(tfrecord_dir, split_name, batch_size)
+            results = self.evaluate_checkpoints(
+                tfrecord_dir, checkpoint_paths, inputs,
+                batch_size=batch_size, split_name=split_name, **kwargs)
+        else:
+            results = evaluate_sweep_parallel(
+                self, tfrecord_dir, checkpoint_paths, batch_size,
+                split_name, num_processes, kwargs)
+
+        results = list(zip(checkpoint_paths, results))
+        write_sweep_table(results, log_dir, split_name)
+        return results
+
+    def evaluate_continuously(self,
+                              tfrecord_dir,
+                              checkpoint_dir,
+                              log_dir=None,
+                              batch_size=24,
+                              split_name='validation',
+                              min_interval_secs=60,
+                              timeout=None,
+                              timeout_fn=None,
+                              num_threads=None,
+                              cpus=None,
+                              **kwargs):
+        """Evaluate the new checkpoints of a training directory as soon
+        as they're written.
+
+        The split is decoded once and the graph built once, then every new
+        checkpoint is evaluated by a single pass through the whole split
+        (see `self.evaluate_checkpoints`). The scalar metrics are written
+        as summaries '<split_name>/<metric>' with the training step of the
+        checkpoint, so with `log_dir` = `checkpoint_dir` (the default) they
+        are shown in the same TensorBoard run as the training.
+
+        Args:
+            tfrecord_dir: The directory that contains the dataset tfrecords.
+            checkpoint_dir: The training directory that is watched.
+            log_dir: The directory where the summaries are written.
+            batch_size, split_name: See `self.evaluate`.
+            min_interval_secs, timeout, timeout_fn: Passed to
+                `tf.contrib.training.checkpoints_iterator`. By default we
+                wait for new checkpoints indefinitely.
+            num_threads: The number of threads used by TensorFlow in this
+                process, `None` to use TensorFlow's default.
+            cpus: The cores on which this process runs, `None` to not
+                restrict it (only supported on Linux).
+            **kwargs: Passed to `self.evaluate_checkpoints`.
+        """
+        self.check_checkpoint_restore()
+        if cpus is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        session_config = None
+        if num_threads is not None:
+            session_config = tf.ConfigProto(
+                intra_op_parallelism_threads=num_threads,
+                inter_op_parallelism_threads=num_threads)
+        if log_dir is None:
+            log_dir = checkpoint_dir
+        # `self.pass_log_info` shouldn't write summaries for every pass.
+        self.__dict__.pop('fw', None)
+        self.prepare(tfrecord_dir, [checkpoint_dir], split_name, batch_size,
+                     **kwargs)
+
+        inputs = self.decode_split(
+            tfrecord_dir, split_name, batch_size, session_config)
+        fw = tf.summary.FileWriter(log_dir)
+
+        def write_result(checkpoint_path, result):
+            step = checkpoint_step(checkpoint_path)
+            if isinstance(result, dict) and step is not None:
+                fw.add_summary(
+                    result_summary(result, split_name), global_step=step)
+                fw.flush()
+
+        checkpoints = tf.contrib.training.checkpoints_iterator(
+            checkpoint_dir, min_interval_secs=min_interval_secs,
+            timeout=timeout, timeout_fn=timeout_fn)
+        try:
+            self.evaluate_checkpoints(
+                tfrecord_dir, checkpoints, inputs, batch_size=batch_size,
+                split_name=split_name, session_config=session_config,
+                result_fn=write_result, **kwargs)
+        finally:
+            fw.close()
+
+
+def decode_split_to_files(evaluate_instance, tfrecord_dir,
+                          split_name, batch_size, tmp_dir):
+    """Decode a split and save the arrays in `tmp_dir` (in a worker)."""
+    inputs = evaluate_instance.decode_split(
+        tfrecord_dir, split_name, batch_size)
+    for name, array in inputs.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    return sorted(inputs)
+
+
+def evaluate_checkpoints_from_files(evaluate_instance, tfrecord_dir,
+                                    checkpoint_paths, names, tmp_dir,
+                                    kwargs):
+    """Evaluate checkpoints on the arrays saved in `tmp_dir` (in a worker).
+    """
+    inputs = {name: np.load(os.path.join(tmp_dir, name + '.npy'),
+                            mmap_mode='r')
+              for name in names}
+    return evaluate_instance.evaluate_checkpoints(
+        tfrecord_dir, checkpoint_paths, inputs, **kwargs)
+
+
+def evaluate_sweep_parallel(evaluate_instance, tfrecord_dir,
+                            checkpoint_paths, batch_size, split_name,
+                            num_processes, kwargs):
+    """Run `Evaluate.evaluate_checkpoints` in several processes.
+
+    TensorFlow is only used in the worker processes: the split is decoded
+    by one of them and saved to a temporary directory, then the
+    checkpoints are distributed over all of them.
+
+    Returns:
+        The results of the checkpoints, in the same order.
+    """
+    num_processes = min(num_processes, len(checkpoint_paths))
+    kwargs = dict(kwargs, batch_size=batch_size, split_name=split_name)
+    tmp_dir = tempfile.mkdtemp(
+        dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        names = pool.apply(decode_split_to_files, (
+            evaluate_instance, tfrecord_dir, split_name, batch_size, tmp_dir))
+        chunks = [checkpoint_paths[i::num_processes]
+                  for i in range(num_processes)]
+        chunk_results = pool.map(
+            evaluate_checkpoints_worker,
+            [(evaluate_instance, tfrecord_dir, chunk, names, tmp_dir, kwargs)
+             for chunk in chunks])
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = [None] * len(checkpoint_paths)
+    for i, chunk_result in enumerate(chunk_results):
+        results[i::num_processes] = chunk_result
+    return results
+
+
+def evaluate_checkpoints_worker(args):
+    return evaluate_checkpoints_from_files(*args)
+
+
+def result_summary(result, prefix):
+    """A `tf.Summary` of the scalar values of a results dictionary."""
+    return tf.Summary(value=[
+        tf.Summary.Value(tag='%s/%s' % (prefix, key),
+                         simple_value=value)
+        for key, value in sorted(result.items()) if np.isscalar(value)])
+
+
+def checkpoint_step(checkpoint_path):
+    """The training step in the name of a checkpoint ('model.ckpt-250')."""
+    try:
+        return int(checkpoint_path.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def write_sweep_table(results, log_dir, split_name):
+    """Log the results of a sweep and write them in `log_dir`.
+
+    Only the scalar values of the results (if they're dictionaries)
+    are put in the table.
+    """
+    keys = sorted(set(
+        key for _, result in results if isinstance(result, dict)
+        for key, value in result.items() if np.isscalar(value)))
+    lines = ['\t'.join(['checkpoint', 'step'] + keys)]
+    for checkpoint_path, result in results:
+        result = result if isinstance(result, dict) else {}
+        lines.append('\t'.join(
+            [os.path.basename(checkpoint_path),
+             str(checkpoint_step(checkpoint_path))] +
+            [str(result.get(key, '')) for key in keys]))
+    for line in lines:
+        tf.logging.info(line)
+
+    if log_dir is None:
+        return
+    if not tf.gfile.Exists(log_dir):
+        tf.gfile.MakeDirs(log_dir)
+    with tf.gfile.Open(
+            os.path.join(log_dir, 'sweep_%s.tsv' % split_name), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    fw = tf.summary.FileWriter(log_dir)
+    for checkpoint_path, result in results:
+        step = checkpoint_step(checkpoint_path)
+        if isinstance(result, dict) and step is not None:
+            fw.add_summary(result_summary(result, 'sweep'), global_step=step)
+    fw.close()
+
+
+def run_background_evaluation(evaluate_instance, tfrecord_dir,
+                              checkpoint_dir, stop_event, kwargs):
+    """Evaluate new checkpoints until `stop_event` is set (in a process).
+    """
+    kwargs.setdefault('timeout', kwargs.get('min_interval_secs', 60))
+    evaluate_instance.evaluate_continuously(
+        tfrecord_dir, checkpoint_dir, timeout_fn=stop_event.is_set, **kwargs)
+
+
+class BackgroundEvaluation(object):
+    """Run `Evaluate.evaluate_continuously` in a separate process.
+
+    The process is started when the instance is created. Once `stop` is
+    called it evaluates the last checkpoint if it's not done yet and
+    exits. The evaluation instance must be picklable.
+    """
+
+    def __init__(self, evaluate_instance, tfrecord_dir,
+                 checkpoint_dir, **kwargs):
+        """
+        Args:
+            evaluate_instance: An instance of a subclass of `Evaluate`.
+            tfrecord_dir: The directory that contains the dataset tfrecords.
+            checkpoint_dir: The training directory that is watched.
+            **kwargs: Passed to `Evaluate.evaluate_continuously`.
+        """
+        evaluate_instance.check_checkpoint_restore()
+        self.stop_event = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=run_background_evaluation,
+            args=(evaluate_instance, tfrecord_dir, checkpoint_dir,
+                  self.stop_event, kwargs))
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        """Wait for the evaluation of the last checkpoint."""
+        self.stop_event.set()
+        self.process.join()
 
 
 def evaluate(evaluate_class,
@@ -238,6 +764,23 @@ def evaluate(evaluate_class,
         if hasattr(evaluate_instance, key):
             setattr(evaluate_instance, key, kwargs[key])
             del kwargs[key]
-    evaluate_instance.evaluate(
+    return evaluate_instance.evaluate(
         tfrecord_dir, checkpoint_dirs, log_dir,
         number_of_steps=number_of_steps, **kwargs)
+
+
+def evaluate_sweep(evaluate_class,
+                   used_architecture,
+                   tfrecord_dir,
+                   checkpoint_dir,
+                   log_dir,
+                   **kwargs):
+    """Like `evaluate` but for all the checkpoints of `checkpoint_dir`
+    (see `Evaluate.evaluate_sweep`)."""
+    evaluate_instance = evaluate_class(used_architecture)
+    for key in kwargs.copy():
+        if hasattr(evaluate_instance, key):
+            setattr(evaluate_instance, key, kwargs[key])
+            del kwargs[key]
+    return evaluate_instance.evaluate_sweep(
+        tfrecord_dir, checkpoint_dir, log_dir, **kwargs)
@@ -0,0 +1,333 @@
+"""Measure the cost of the network architectures layer by layer.
+
+`profile_architecture` builds an architecture on synthetic inputs of a
+given shape and reports for each of its named layers (the endpoints
+`Conv2d_a_3x3`, `Middle`, `Conv3d_b_3x3x2`...):
+
+* the number of trainable parameters,
+* the number of multiply-adds per sample (only convolutions, transposed
+  convolutions and fully connected layers are counted),
+* the size in bytes of the activations it outputs per sample,
+* the forward and backward times of a batch, measured with the step
+  statistics of TensorFlow.
+
+The architectures don't need to be modified: the layers are found from
+the scopes of their variables and pooling operations, and every operation
+(and its gradient) is attributed to the layer whose scope contains it.
+
+It can also be used from the command line to compare architectures, ex:
+
+    python -m routines.profiling images.CNN_architecture.CNN_9layers \
+        images.CAE_architecture.CAE_6layers --input_shapes 299x299x3
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from six.moves import xrange
+import time
+import argparse
+import importlib
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+from nets_base.arg_scope import nets_arg_scope
+
+slim = tf.contrib.slim
+
+POOLING_OPS = ['MaxPool', 'AvgPool', 'MaxPool3D', 'AvgPool3D']
+
+CONVOLUTION_OPS = ['Conv2D', 'Conv3D', 'DepthwiseConv2dNative']
+
+TRANSPOSED_CONVOLUTION_OPS = ['Conv2DBackpropInput', 'Conv3DBackpropInputV2']
+
+GRADIENTS_SCOPE = 'gradients/'
+
+
+def num_elements(tensor):
+    """The number of elements of a `Tensor` with a fully defined shape."""
+    return int(np.prod(tensor.get_shape().as_list()))
+
+
+def multiply_adds(op):
+    """Count the multiply-adds done by an operation (0 if not supported)."""
+    if op.type in CONVOLUTION_OPS:
+        # The filter is [(depth,) height, width, in_channels, out_channels]
+        filter_shape = op.inputs[1].get_shape().as_list()
+        return num_elements(op.outputs[0]) * int(np.prod(filter_shape[:-1]))
+    if op.type in TRANSPOSED_CONVOLUTION_OPS:
+        # The filter is [(depth,) height, width, out_channels, in_channels]
+        # and the input of the layer is the third input of the operation.
+        filter_shape = op.inputs[1].get_shape().as_list()
+        return num_elements(op.inputs[2]) * int(np.prod(filter_shape[:-1]))
+    if op.type == 'MatMul':
+        a_shape = op.inputs[0].get_shape().as_list()
+        b_shape = op.inputs[1].get_shape().as_list()
+        return a_shape[0] * a_shape[1] * b_shape[1]
+    return 0
+
+
+def find_layer_scopes(ops, variables):
+    """Find the scopes of the layers of an architecture.
+
+    A layer scope is either the scope of some weights/biases or the
+    scope of a pooling operation.
+
+    Returns:
+        The layer scopes, in the order in which they were created.
+    """
+    scopes = set()
+    for var in variables:
+        name = var.op.name
+        if name.endswith('/weights') or name.endswith('/biases'):
+            scopes.add(name.rsplit('/', 1)[0])
+    for op in ops:
+        if op.type in POOLING_OPS and '/' in op.name:
+            scopes.add(op.name.rsplit('/', 1)[0])
+
+    ordered_scopes = []
+    for op in ops:
+        scope = layer_of(op.name, scopes)
+        if scope is not None and scope not in ordered_scopes:
+            ordered_scopes.append(scope)
+    return ordered_scopes
+
+
+def layer_of(name, scopes):
+    """The longest scope in `scopes` containing the operation `name`."""
+    if name.startswith(GRADIENTS_SCOPE):
+        name = name[len(GRADIENTS_SCOPE):]
+    parts = name.split('/')
+    for i in xrange(len(parts)-1, 0, -1):
+        scope = '/'.join(parts[:i])
+        if scope in scopes:
+            return scope
+    return None
+
+
+def common_root(scopes):
+    """The first scope component shared by all the layers, if any."""
+    roots = set(scope.split('/', 1)[0] for scope in scopes)
+    if len(roots) == 1 and all('/' in scope for scope in scopes):
+        return roots.pop() + '/'
+    return ''
+
+
+def step_times(run_metadata, scopes):
+    """Sum the computation times of the operations of each layer.
+
+    Returns:
+        Two dictionaries from layer scopes to forward and backward
+        times in seconds.
+    """
+    forward = collections.defaultdict(float)
+    backward = collections.defaultdict(float)
+    for device_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in device_stats.node_stats:
+            scope = layer_of(node_stats.node_name, scopes)
+            if scope is None:
+                continue
+            elapsed = (node_stats.all_end_rel_micros -
+                       node_stats.op_start_rel_micros) / 1e6
+            if node_stats.node_name.startswith(GRADIENTS_SCOPE):
+                backward[scope] += elapsed
+            else:
+                forward[scope] += elapsed
+    return forward, backward
+
+
+def profile_architecture(architecture,
+                         input_shapes,
+                         batch_size=1,
+                         num_runs=10,
+                         is_training=False,
+                         num_threads=None,
+                         **kwargs):
+    """Measure the cost of each layer of an architecture.
+
+    Args:
+        architecture: The architecture function.
+        input_shapes: The shape of one sample of the input (without
+            batch dimension), or a list of such shapes for architectures
+            that take several inputs (ex: color and depth images).
+        batch_size: The batch size of the synthetic inputs.
+        num_runs: The number of measured runs (after one warm-up run),
+            the times are averaged over these runs.
+        is_training: Passed to `nets_arg_scope` (batch normalization
+            and dropout).
+        num_threads: The number of threads used by TensorFlow, `None`
+            to use TensorFlow's default.
+        **kwargs: Other arguments passed to the architecture.
+
+    Returns:
+        A list of dictionaries, one for each layer in the order of the
+        network, with keys 'endpoint', 'params', 'multiply_adds',
+        'activation_bytes', 'forward_time' and 'backward_time'. The last
+        dictionary (endpoint 'Total') gives the totals, where the times are
+        the wall times of whole untraced runs (the backward time being
+        the time of a forward and backward run minus the forward time),
+        so they also count the operations outside the layers and the
+        overhead of the runs.
+    """
+    if isinstance(input_shapes[0], int):
+        input_shapes = [input_shapes]
+
+    with tf.Graph().as_default() as graph:
+        inputs = [tf.Variable(tf.random_normal([batch_size] + list(shape)),
+                              trainable=False, name='Input_%d' % i)
+                  for i, shape in enumerate(input_shapes)]
+        num_ops_before = len(graph.get_operations())
+        with slim.arg_scope(nets_arg_scope(is_training=is_training)):
+            net = architecture(*inputs, **kwargs)
+        ops = graph.get_operations()[num_ops_before:]
+
+        variables = tf.trainable_variables()
+        gradients = tf.gradients(tf.reduce_sum(net), variables)
+        scopes = find_layer_scopes(ops, variables)
+        root = common_root(scopes)
+
+        layers = collections.OrderedDict(
+            (scope, {'endpoint': scope[len(root):], 'params': 0,
+                     'multiply_adds': 0, 'activation_bytes': 0})
+            for scope in scopes)
+        for var in variables:
+            scope = layer_of(var.op.name, scopes)
+            if scope is not None:
+                layers[scope]['params'] += num_elements(var)
+
+        op_layers = dict((op.name, layer_of(op.name, scopes)) for op in ops)
+        for op in ops:
+            scope = op_layers[op.name]
+            if scope is None:
+                continue
+            layers[scope]['multiply_adds'] += multiply_adds(op)
+            # Count the outputs used outside the layer (its activations).
+            for output in op.outputs:
+                consumers = [consumer for consumer in output.consumers()
+                             if op_layers.get(consumer.name) != scope and
+                             not consumer.name.startswith(GRADIENTS_SCOPE)]
+                if consumers or output is net:
+                    layers[scope]['activation_bytes'] += \
+                        num_elements(output) * output.dtype.size
+
+        config = None
+        if num_threads is not None:
+            config = tf.ConfigProto(
+                intra_op_parallelism_threads=num_threads,
+                inter_op_parallelism_threads=num_threads)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run([net, gradients])
+            for layer in layers.values():
+                layer['forward_time'] = layer['backward_time'] = 0
+            for _ in xrange(num_runs):
+                for fetches in [net, gradients]:
+                    run_metadata = tf.RunMetadata()
+                    sess.run(fetches, options=options,
+                             run_metadata=run_metadata)
+                    forward, backward = step_times(run_metadata, scopes)
+                    for scope, layer in layers.items():
+                        if fetches is net:
+                            layer['forward_time'] += \
+                                forward[scope] / num_runs
+                        else:
+                            layer['backward_time'] += \
+                                backward[scope] / num_runs
+
+            # The traces slow the runs down, the totals are measured
+            # without them.
+            run_times = []
+            for fetches in [net, gradients]:
+                start_time = time.time()
+                for _ in xrange(num_runs):
+                    sess.run(fetches)
+                run_times.append((time.time() - start_time) / num_runs)
+            forward_total = run_times[0]
+            backward_total = max(run_times[1] - run_times[0], 0)
+
+    results = list(layers.values())
+    for layer in results:
+        layer['multiply_adds'] //= batch_size
+        layer['activation_bytes'] //= batch_size
+    results.append({
+        'endpoint': 'Total',
+        'params': sum(layer['params'] for layer in results),
+        'multiply_adds': sum(layer['multiply_adds'] for layer in results),
+        'activation_bytes': sum(
+            layer['activation_bytes'] for layer in results),
+        'forward_time': forward_total,
+        'backward_time': backward_total})
+    return results
+
+
+def format_results(results):
+    """Format the results of `profile_architecture` as a table."""
+    lines = ['%-28s %12s %14s %14s %10s %10s' % (
+        'endpoint', 'params', 'multiply-adds', 'activations',
+        'fwd (ms)', 'bwd (ms)')]
+    for layer in results:
+        lines.append('%-28s %12d %14d %14d %10.2f %10.2f' % (
+            layer['endpoint'], layer['params'], layer['multiply_adds'],
+            layer['activation_bytes'], layer['forward_time']*1000,
+            layer['backward_time']*1000))
+    return '\n'.join(lines)
+
+
+def get_architecture(name):
+    """Get an architecture from its full name ('module.function')."""
+    module_name, function_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def parse_shape(shape):
+    """Parse a shape given as '299x299x3'."""
+    return [int(size) for size in shape.split('x')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the cost of each layer of some architectures.')
+    parser.add_argument(
+        'architectures', nargs='+',
+        help='full names of architectures, ex: '
+             'images.CNN_architecture.CNN_9layers')
+    parser.add_argument(
+        '--input_shapes', nargs='+', required=True,
+        help='shape of each input of a sample, ex: 299x299x3')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_runs', type=int, default=10)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument(
+        '--final_endpoint', default=None,
+        help='passed to the architectures if given')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.final_endpoint is not None:
+        kwargs['final_endpoint'] = args.final_endpoint
+    input_shapes = [parse_shape(shape) for shape in args.input_shapes]
+
+    totals = []
+    for name in args.architectures:
+        results = profile_architecture(
+            get_architecture(name), input_shapes,
+            batch_size=args.batch_size, num_runs=args.num_runs,
+            num_threads=args.num_threads, **kwargs)
+        print(name)
+        print(format_results(results))
+        print()
+        total = dict(results[-1], endpoint=name.rsplit('.', 1)[1])
+        totals.append(total)
+
+    if len(totals) > 1:
+        print('Comparison')
+        print(format_results(totals))
+
+
+if __name__ == '__main__':
+    main()
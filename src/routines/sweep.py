@@ -0,0 +1,242 @@
+"""Train several configurations of a model at the same time.
+
+`run_sweep` trains one model for every combination of the values of a
+grid of arguments (ex: `initial_learning_rate`, `dropout_keep_prob`,
+`endpoint`, `trainable_scopes`) in a pool of processes. Each process runs
+on its own cores with a limited number of threads. With `share_data`, the
+data is decoded only once (see `Train.decode_data`) in /dev/shm and all the
+processes read it from there (see `Train.use_shared_data`), so the
+arguments of the grid must not change the inputs of the model. This also
+freezes the random preprocessing (crops, flips...), which is why it's only
+done on demand, for pipelines without random augmentation.
+
+A table comparing the configurations (last training loss, results of the
+evaluation if any, wall time) is logged and written to `sweep.tsv`.
+
+Ex:
+    run_sweep(TrainClassifyImagesCNN, CNN_9layers, tfrecord_dir, None,
+              'test/log/sweep', {'initial_learning_rate': [0.01, 0.001],
+                                 'dropout_keep_prob': [0.5, 0.8]},
+              number_of_epochs=5, evaluate_class=EvaluateClassifyImagesCNN)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+
+from routines.train import train
+from routines.evaluate import evaluate
+
+
+def grid_configurations(grid):
+    """All the combinations of values of a grid.
+
+    Args:
+        grid: A dictionary from argument names to lists of values.
+
+    Returns:
+        A list of dictionaries from argument names to values.
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[name] for name in names])]
+
+
+def configuration_name(configuration):
+    """The name of a configuration ('dropout_keep_prob=0.5,...'), it's
+    also the name of its log directory."""
+    parts = []
+    for name, value in sorted(configuration.items()):
+        if isinstance(value, (list, tuple)):
+            value = '+'.join(str(element) for element in value)
+        parts.append('%s=%s' % (name, value))
+    return ','.join(parts).replace(os.sep, '_') or 'default'
+
+
+def cpu_slices(num_processes, num_threads, num_cpus):
+    """Give `num_threads` cores to each process, different cores to
+    different processes as far as possible."""
+    return [[(i*num_threads + j) % num_cpus for j in range(num_threads)]
+            for i in range(num_processes)]
+
+
+def init_worker(cpu_queue):
+    """Pin a worker process to the cores taken from `cpu_queue`."""
+    cpus = cpu_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def decode_data_to_files(train_class, used_architecture, tfrecord_dir,
+                         batch_size, kwargs, tmp_dir):
+    """Decode the data and save the arrays in `tmp_dir` (in a worker)."""
+    train_instance = train_class(used_architecture)
+    for key, value in kwargs.items():
+        if hasattr(train_instance, key):
+            setattr(train_instance, key, value)
+    arrays = train_instance.decode_data(tfrecord_dir, batch_size)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+
+
+def run_configuration(train_class, used_architecture, tfrecord_dir,
+                      checkpoint_dirs, log_dir, kwargs,
+                      evaluate_class, evaluate_kwargs):
+    """Train (and evaluate) one configuration (in a worker).
+
+    Returns:
+        A dictionary containing the last training loss, the scalar
+        results of the evaluation and the wall time.
+    """
+    start_time = time.time()
+    train_instance = train(
+        train_class, used_architecture, tfrecord_dir,
+        checkpoint_dirs, log_dir, **kwargs)
+    result = {'loss': float(train_instance.loss)}
+    result['train_time'] = time.time() - start_time
+
+    if evaluate_class is not None:
+        evaluation = evaluate(
+            evaluate_class, used_architecture, tfrecord_dir,
+            log_dir, None, single_pass=True, **evaluate_kwargs)
+        if isinstance(evaluation, dict):
+            result.update(('validation/%s' % key, value)
+                          for key, value in evaluation.items()
+                          if np.isscalar(value))
+    result['wall_time'] = time.time() - start_time
+    return result
+
+
+def run_configuration_worker(args):
+    return run_configuration(*args)
+
+
+def run_sweep(train_class,
+              used_architecture,
+              tfrecord_dir,
+              checkpoint_dirs,
+              log_dir,
+              grid,
+              num_processes=None,
+              num_threads=None,
+              share_data=False,
+              batch_size=24,
+              evaluate_class=None,
+              evaluate_kwargs=None,
+              evaluate_keys=(),
+              **kwargs):
+    """Train a model with every configuration of a grid in parallel.
+
+    Args:
+        train_class, used_architecture, tfrecord_dir, checkpoint_dirs:
+            See `routines.train.train`.
+        log_dir: Each configuration is trained in a subdirectory
+            named after it (see `configuration_name`).
+        grid: A dictionary from argument names to lists of values, the
+            arguments are either attributes of `train_class` or
+            arguments of its `train` method (see `routines.train.train`).
+        num_processes: The number of configurations trained at the same
+            time, by default one per core (and at most one per
+            configuration).
+        num_threads: The number of threads (and cores) of each process,
+            by default the cores are divided between the processes.
+        share_data: Whether to decode the data once and share it between
+            the processes. The random preprocessing of the training data
+            is then done only once and every epoch sees the same crops
+            and flips, so only use it when the training pipeline has no
+            random augmentation.
+        batch_size: The batch size used for training.
+        evaluate_class: If given, each trained model is evaluated by
+            a single pass through the validation split with an instance
+            of this class (see `routines.evaluate.evaluate`).
+        evaluate_kwargs: Arguments passed to `routines.evaluate.evaluate`.
+        evaluate_keys: The names of the arguments of the grid that are
+            also passed to the evaluation (ex: 'endpoint').
+        **kwargs: Arguments shared by all the configurations.
+
+    Returns:
+        A list of pairs (configuration, results).
+    """
+    configurations = grid_configurations(grid)
+    num_cpus = multiprocessing.cpu_count()
+    if num_processes is None:
+        num_processes = min(len(configurations), num_cpus)
+    if num_threads is None:
+        num_threads = max(1, num_cpus // num_processes)
+    kwargs = dict(kwargs, batch_size=batch_size, num_threads=num_threads)
+
+    cpu_queue = multiprocessing.Queue()
+    for cpus in cpu_slices(num_processes, num_threads, num_cpus):
+        cpu_queue.put(cpus)
+    pool = multiprocessing.Pool(num_processes, init_worker, (cpu_queue,))
+
+    tmp_dir = None
+    start_time = time.time()
+    try:
+        if share_data:
+            tmp_dir = tempfile.mkdtemp(
+                dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            pool.apply(decode_data_to_files, (
+                train_class, used_architecture, tfrecord_dir,
+                batch_size, kwargs, tmp_dir))
+            kwargs['shared_data_dir'] = tmp_dir
+
+        tasks = []
+        for configuration in configurations:
+            configuration_kwargs = dict(kwargs, **configuration)
+            configuration_evaluate_kwargs = dict(
+                evaluate_kwargs or {},
+                **{key: configuration[key] for key in evaluate_keys})
+            tasks.append((
+                train_class, used_architecture, tfrecord_dir,
+                checkpoint_dirs,
+                os.path.join(log_dir, configuration_name(configuration)),
+                configuration_kwargs, evaluate_class,
+                configuration_evaluate_kwargs))
+        results = pool.map(run_configuration_worker, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = list(zip(configurations, results))
+    write_comparison_table(results, log_dir, time.time() - start_time)
+    return results
+
+
+def write_comparison_table(results, log_dir, wall_time):
+    """Log the results of a sweep and write them to `sweep.tsv`.
+
+    The sum of the wall times of the configurations is compared to the
+    wall time of the whole sweep to show the gain of running them
+    at the same time.
+    """
+    keys = sorted(set(key for _, result in results for key in result))
+    lines = ['\t'.join(['configuration'] + keys)]
+    for configuration, result in results:
+        lines.append('\t'.join(
+            [configuration_name(configuration)] +
+            [str(result.get(key, '')) for key in keys]))
+    sequential_time = sum(result['wall_time'] for _, result in results)
+    lines.append('# sweep wall time: %.1f sec, sum of the wall times: '
+                 '%.1f sec (x%.2f)' % (wall_time, sequential_time,
+                                       sequential_time / wall_time))
+    for line in lines:
+        tf.logging.info(line)
+
+    if not tf.gfile.Exists(log_dir):
+        tf.gfile.MakeDirs(log_dir)
+    with tf.gfile.Open(os.path.join(log_dir, 'sweep.tsv'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
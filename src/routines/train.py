@@ -17,14 +17,19 @@ from __future__ import division
 from __future__ import print_function
 
 from six.moves import xrange
+import os
 import time
+import collections
 
 import abc
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.client import timeline
 
 from nets_base.arg_scope import nets_arg_scope
+from data.pipeline import load_batch_arrays
+from routines.evaluate import BackgroundEvaluation
 
 slim = tf.contrib.slim
 
@@ -87,10 +92,11 @@ class TrainAbstract(object):
         different files and are represented by different tensors in the graph.
 
         Therefore to be consistent when doing the computations we should
-        decide which data to use by using for example `tf.cond` with
-        `self.is_training` as the first argument. `self.is_training` is a
-        boolean `Tensor` that indicates whether we're in training or
-        testing phrase.
+        decide which data to use. This should be done with
+        `self.select_data` and not with `tf.cond`: both branches of a
+        `tf.cond` are created outside the conditional context and would
+        then be dequeued at every step, so the validation pipeline would
+        be run even when we don't test at all.
         """
         pass
 
@@ -242,6 +248,57 @@ class TrainAbstract(object):
         pass
 
 
+class StepTimes(object):
+    """Accumulate the time spent in the different parts of the training.
+
+    The parts are identified by names and are shown in the order in
+    which they are first added.
+    """
+
+    def __init__(self):
+        self.totals = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def total(self, name):
+        return self.totals.get(name, 0)
+
+    def table(self, wall_time):
+        """Format the times as a table.
+
+        Args:
+            wall_time: The whole duration of the training loop in seconds,
+                used to give the proportion of each part.
+        """
+        lines = ['%-24s %8s %12s %12s %8s' % (
+            'part', 'count', 'total (s)', 'mean (ms)', '% time')]
+        for name, total in self.totals.items():
+            count = self.counts[name]
+            lines.append('%-24s %8d %12.2f %12.2f %8.1f' % (
+                name, count, total, total / count * 1000,
+                100 * total / max(wall_time, 1e-9)))
+        lines.append('%-24s %8s %12.2f' % ('wall time', '', wall_time))
+        return '\n'.join(lines)
+
+
+def input_wait_time(run_metadata):
+    """The time spent waiting for the `tf.data` iterators in a traced run.
+
+    The `IteratorGetNext` operations block until a batch is ready, so
+    their duration is the time the model spent waiting for the data.
+    """
+    wait_time = 0
+    for device_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in device_stats.node_stats:
+            if 'IteratorGetNext' in node_stats.node_name:
+                wait_time += (node_stats.all_end_rel_micros -
+                              node_stats.op_start_rel_micros) / 1e6
+    return wait_time
+
+
 class Train(TrainAbstract):
     """Implementation of the interface `TrainAbstract`.
 
@@ -265,6 +322,17 @@ class Train(TrainAbstract):
     lr_decay_steps = 100
     lr_decay_rate = 0.8
 
+    # The number of passes through the data of the input pipelines,
+    # `None` to repeat them indefinitely (see `self.decode_data`).
+    num_epochs = None
+
+    # A directory containing the arrays written by `self.decode_data`,
+    # the inputs are then read from them and not from the tfrecords.
+    shared_data_dir = None
+
+    # The number of threads used by TensorFlow, `None` for the default.
+    num_threads = None
+
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
@@ -284,6 +352,10 @@ class Train(TrainAbstract):
               renorm=False,
               weight_decay=0.0004,
               test_use_batch=False,
+              evaluator=None,
+              evaluator_kwargs=None,
+              trace_steps=None,
+              num_towers=1,
               **kwargs):
         """Train the model.
 
@@ -318,12 +390,42 @@ class Train(TrainAbstract):
             weight_decay: The weight regularization coefficeint.
             test_use_batch: Decide whether to use batch statistics or
                 moving ones for batch normalization during tests.
+            evaluator: An instance of a subclass of `Evaluate`. If given,
+                the checkpoints written in `log_dir` are evaluated on the
+                whole validation set by this instance in a separate
+                process (see `BackgroundEvaluation`), and the tests done
+                every `save_summaries_steps` are disabled.
+            evaluator_kwargs: Arguments passed to
+                `evaluator.evaluate_continuously` (ex: `batch_size`,
+                `cpus`, `num_threads` and the arguments of its `compute`).
+            trace_steps: If given, the first run of every `trace_steps`
+                steps is traced: a Chrome trace `timeline_<step>.json`
+                (to open in chrome://tracing) is written in `log_dir`
+                and the run metadata is added to the event files.
+                The time spent waiting for the input pipeline is
+                measured on these steps.
+            num_towers: The number of replicas of the model (see
+                `self.compute_towers`), each batch is split between them
+                and their gradients are averaged. `batch_size` must be a
+                multiple of it.
             **kwargs: Arguments pass to the `self.compute`.
+
+        The time spent in the different parts of the training (runs of
+        the training operation, writing of summaries, tests, checkpoints,
+        waiting for the input pipeline...) is recorded in
+        `self.step_times` and shown at the end of the training.
         """
         # Create the log directory if it doesn't exist
         if not tf.gfile.Exists(log_dir):
             tf.gfile.MakeDirs(log_dir)
 
+        # Start the evaluator before any session is created in this process
+        background_evaluation = None
+        if evaluator is not None:
+            background_evaluation = BackgroundEvaluation(
+                evaluator, tfrecord_dir, log_dir, **(evaluator_kwargs or {}))
+            do_test = False
+
         if (checkpoint_dirs is not None and
                 not isinstance(checkpoint_dirs, (list, tuple))):
             checkpoint_dirs = [checkpoint_dirs]
@@ -334,6 +436,8 @@ class Train(TrainAbstract):
             # Read the data
             with tf.name_scope('Data_provider'):
                 dataset = self.get_data(tfrecord_dir, batch_size)
+                if self.shared_data_dir is not None:
+                    self.use_shared_data(batch_size)
 
             # Use `number_of_epochs` when `number_of_steps` is not given
             if number_of_steps is None:
@@ -342,6 +446,7 @@ class Train(TrainAbstract):
 
             # Decide if we're training or not to use the right data
             self.training = tf.placeholder(tf.bool, shape=(), name='training')
+            self.test_feeds = []
             self.decide_used_data()
 
             # Decide if we use batch statstics or moving mean/variance for
@@ -351,14 +456,20 @@ class Train(TrainAbstract):
 
             # Create the model, use the default arg scope to configure the
             # batch norm parameters
+            self.num_towers = num_towers
             with slim.arg_scope(self.used_arg_scope(
                     use_batch_norm, renorm, weight_decay)):
-                self.compute(**kwargs)
+                if num_towers == 1:
+                    self.compute(**kwargs)
+                else:
+                    tower_losses = self.compute_towers(
+                        num_towers, batch_size, **kwargs)
 
             # Specify the loss function
             # Create the global step for monitoring training
             # Specify the learning rate and optimizer
-            total_loss = self.get_total_loss()
+            if num_towers == 1:
+                total_loss = self.get_total_loss()
             self.global_step = tf.train.get_or_create_global_step()
             self.get_learning_rate()
             optimizer = self.get_optimizer()
@@ -377,9 +488,13 @@ class Train(TrainAbstract):
             print(variables_to_train)
 
             # Create the training operation
-            self.train_op = slim.learning.create_train_op(
-                total_loss, optimizer,
-                variables_to_train=variables_to_train)
+            if num_towers == 1:
+                self.train_op = slim.learning.create_train_op(
+                    total_loss, optimizer,
+                    variables_to_train=variables_to_train)
+            else:
+                self.train_op = self.create_tower_train_op(
+                    tower_losses, optimizer, variables_to_train)
 
             # The metrics to predict (may be omitted)
             self.get_metric_op()
@@ -397,32 +512,64 @@ class Train(TrainAbstract):
             # Define the supervisor
             self.sv = self.get_supervisor(log_dir, init_fn)
 
-            with self.sv.managed_session() as sess:
+            # The queues of queue runners if the model still uses some
+            self.queue_sizes = [
+                queue_runner.queue.size() for queue_runner
+                in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)]
+            self.step_times = StepTimes()
+            self.trace_dir = log_dir
+            self.trace_run = False
+
+            with self.sv.managed_session(
+                    config=self.get_session_config()) as sess:
 
                 # Finalize the initialization if necessary
                 self.extra_initialization(sess)
 
                 # Run the training process
+                loop_start_time = time.time()
                 for step in xrange(number_of_steps):
+                    self.trace_run = (trace_steps is not None and
+                                      (step+1) % trace_steps == 0)
+                    run_time = self.step_times.total('run')
+                    start_time = time.time()
 
                     # Save summries from time to time
                     if (step+1) % save_summaries_steps == 0:
                         self.summary_log_info(sess)
+                        self.step_times.add(
+                            'summaries', time.time() - start_time -
+                            (self.step_times.total('run') - run_time))
                         if do_test:
+                            start_time = time.time()
                             self.test_log_info(sess, test_use_batch)
+                            self.step_times.add(
+                                'test', time.time() - start_time)
                     else:
                         self.step_log_info(sess)
+                        self.step_times.add(
+                            'logging', time.time() - start_time -
+                            (self.step_times.total('run') - run_time))
 
                     # Save the model from time to time
                     if (step+1) % save_model_steps == 0:
+                        start_time = time.time()
                         self.sv.saver.save(
                             sess, self.sv.save_path,
                             global_step=self.sv.global_step)
+                        self.step_times.add(
+                            'checkpoint', time.time() - start_time)
 
                 # Finish training and save model to checkpoint
                 self.final_log_info(sess)
                 self.sv.saver.save(
                     sess, self.sv.save_path, global_step=self.sv.global_step)
+                tf.logging.info('Time spent in training:\n%s',
+                                self.step_times.table(
+                                    time.time() - loop_start_time))
+
+        if background_evaluation is not None:
+            background_evaluation.stop()
 
     def train_step(self, sess, train_op, global_step, *args):
         """Run `Tensors` and print logging information.
@@ -442,21 +589,313 @@ class Train(TrainAbstract):
         """
         tensors_to_run = [train_op, global_step]
         tensors_to_run.extend(args)
+        queue_sizes = getattr(self, 'queue_sizes', [])
+        tensors_to_run.extend(queue_sizes)
+
+        # Only the first run of a traced step is traced
+        trace_run = getattr(self, 'trace_run', False)
+        self.trace_run = False
+        options = run_metadata = None
+        if trace_run:
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
 
         start_time = time.time()
         tensor_values = sess.run(
             tensors_to_run,
-            feed_dict={self.training: True, self.batch_stat: True})
+            feed_dict={self.training: True, self.batch_stat: True},
+            options=options, run_metadata=run_metadata)
         time_elapsed = time.time() - start_time
 
+        if queue_sizes:
+            tf.logging.info('queue sizes: %s',
+                            tensor_values[-len(queue_sizes):])
+            tensor_values = tensor_values[:-len(queue_sizes)]
+
         self.loss = tensor_values[0]
         global_step_count = tensor_values[1]
 
+        if hasattr(self, 'step_times'):
+            self.step_times.add('run', time_elapsed)
+        if trace_run:
+            self.write_trace(run_metadata, global_step_count)
+
         tf.logging.info(
             'global step %s: loss: %.4f (%.2f sec/step)',
             global_step_count, self.loss, time_elapsed)
         return tensor_values
 
+    def compute_towers(self, num_towers, batch_size, **kwargs):
+        """Build several replicas of the model sharing their variables.
+
+        The inputs given by `self.decide_used_data` (the attributes
+        returned by `self.select_data`) and the batches of the input
+        pipelines (see `self.input_groups`) are split in `num_towers`
+        parts along the batch dimension, and `self.compute` and
+        `self.get_total_loss` are called once for each part, on the CPU
+        device of the tower (see `self.get_session_config`). Subclasses
+        can thus also read the batches of the pipelines in `self.compute`.
+        Tensors holding a whole split (their static batch dimension is
+        neither `None` nor `batch_size`) are not split.
+
+        Once done, the attributes are the ones of the first tower, so the
+        metrics and summaries that are defined afterwards only use the
+        part of the batch given to this tower. The batches of the input
+        pipelines are set back to the whole batches.
+
+        Args:
+            num_towers: The number of replicas.
+            batch_size: The batch size, it must be a multiple of
+                `num_towers`.
+            **kwargs: Arguments passed to `self.compute`.
+
+        Returns:
+            The list of the total losses of the towers.
+        """
+        if batch_size % num_towers != 0:
+            raise ValueError('The batch size %d is not a multiple of the '
+                             'number of towers %d' % (batch_size, num_towers))
+        used_tensors = [used_tensor for used_tensor, _ in self.test_feeds]
+        split_inputs = {}
+        for name, value in list(self.__dict__.items()):
+            if any(value is used_tensor for used_tensor in used_tensors):
+                split_inputs[name] = tf.split(value, num_towers)
+        pipeline_inputs = {}
+        for names in self.input_groups():
+            for name in names:
+                value = getattr(self, name)
+                if (value.get_shape().ndims and
+                        value.get_shape()[0].value in (None, batch_size)):
+                    pipeline_inputs[name] = value
+                    split_inputs[name] = tf.split(value, num_towers)
+
+        # `tf.losses.get_total_loss` must only see the losses of the
+        # tower that is being built
+        losses = tf.get_collection_ref(tf.GraphKeys.LOSSES)
+        previous_losses = list(losses)
+
+        tower_losses = []
+        with tf.variable_scope(tf.get_variable_scope()):
+            for i in xrange(num_towers):
+                for name, inputs in split_inputs.items():
+                    setattr(self, name, inputs[i])
+                del losses[:]
+                with tf.device('/cpu:%d' % i), \
+                        tf.name_scope('tower_%d' % i):
+                    self.compute(**kwargs)
+                    tower_losses.append(self.get_total_loss())
+                previous_losses.extend(losses)
+                if i == 0:
+                    first_tower = dict(self.__dict__)
+                tf.get_variable_scope().reuse_variables()
+        losses[:] = previous_losses
+        self.__dict__.update(first_tower)
+        self.__dict__.update(pipeline_inputs)
+        return tower_losses
+
+    def create_tower_train_op(self, tower_losses, optimizer,
+                              variables_to_train):
+        """Create the training operation from the losses of the towers.
+
+        The gradients of every tower are averaged and only the update
+        operations (moving mean/variance of batch normalization) of the
+        first tower are run.
+
+        Args:
+            tower_losses: The total losses of the towers.
+            optimizer: The optimizer used to minimize the loss.
+            variables_to_train: The variables to be trained.
+
+        Returns:
+            A `Tensor` that runs a training step and returns the average
+            loss of the towers.
+        """
+        tower_gradients = []
+        for i, tower_loss in enumerate(tower_losses):
+            with tf.device('/cpu:%d' % i), tf.name_scope('tower_%d' % i):
+                tower_gradients.append(optimizer.compute_gradients(
+                    tower_loss, variables_to_train))
+
+        gradients = []
+        for grads_and_vars in zip(*tower_gradients):
+            # `IndexedSlices` (ex: gradients of embeddings) can't be
+            # summed by `tf.add_n`.
+            grads = [tf.convert_to_tensor(grad)
+                     for grad, _ in grads_and_vars if grad is not None]
+            if grads:
+                gradients.append(
+                    (tf.add_n(grads) / len(grads), grads_and_vars[0][1]))
+
+        total_loss = tf.add_n(tower_losses) / len(tower_losses)
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, 'tower_0/')
+        with tf.control_dependencies(update_ops):
+            grad_updates = optimizer.apply_gradients(
+                gradients, global_step=self.global_step)
+        with tf.control_dependencies([grad_updates]):
+            return tf.identity(total_loss, name='train_op')
+
+    def get_session_config(self):
+        """The configuration of the training session.
+
+        With several towers, as many CPU devices as towers are created
+        so that they're run in parallel. The number of threads is limited
+        to `self.num_threads` if it's given.
+        """
+        num_towers = getattr(self, 'num_towers', 1)
+        if num_towers == 1 and self.num_threads is None:
+            return None
+        config = tf.ConfigProto(allow_soft_placement=True)
+        if num_towers > 1:
+            config.device_count['CPU'] = num_towers
+        if self.num_threads is not None:
+            config.intra_op_parallelism_threads = self.num_threads
+            config.inter_op_parallelism_threads = self.num_threads
+        return config
+
+    def input_groups(self):
+        """Group the input `Tensor` attributes by the pipeline giving them.
+
+        Returns:
+            A list of sorted lists of attribute names, the attributes
+            of a list being given by the same `tf.data` iterator.
+        """
+        groups = {}
+        for name, value in self.__dict__.items():
+            if (isinstance(value, tf.Tensor) and
+                    value.graph is tf.get_default_graph() and
+                    value.op.type == 'IteratorGetNext'):
+                groups.setdefault(value.op.name, []).append(name)
+        return [sorted(names) for _, names in sorted(groups.items())]
+
+    def decode_data(self, tfrecord_dir, batch_size, session_config=None):
+        """Read the data once and keep the inputs of the model in memory.
+
+        `self.get_data` is called with `self.num_epochs` = 1 and each of
+        its pipelines is read until the end. The pipelines that don't use
+        `self.num_epochs` (their batch dimension is then known) are left
+        aside. Notice that the random preprocessing of the training data
+        (crops, flips...) is then only done once.
+
+        Returns:
+            A dictionary from attribute names to numpy arrays.
+        """
+        self.num_epochs = 1
+        arrays = {}
+        try:
+            with tf.Graph().as_default():
+                self.get_data(tfrecord_dir, batch_size)
+                groups = [
+                    names for names in self.input_groups()
+                    if getattr(self, names[0]).get_shape().ndims and
+                    getattr(self, names[0]).get_shape()[0].value is None]
+
+                with tf.Session(config=session_config) as sess:
+                    for names in groups:
+                        tensors = [getattr(self, name) for name in names]
+                        batches = []
+                        while True:
+                            try:
+                                batches.append(sess.run(tensors))
+                            except tf.errors.OutOfRangeError:
+                                break
+                        for i, name in enumerate(names):
+                            arrays[name] = np.concatenate(
+                                [batch[i] for batch in batches])
+                        tf.logging.info('Decoded %s: %d samples',
+                                        ', '.join(names), len(arrays[name]))
+        finally:
+            self.num_epochs = None
+        return arrays
+
+    def use_shared_data(self, batch_size):
+        """Read the inputs from the arrays in `self.shared_data_dir`.
+
+        Each pipeline built by `self.get_data` whose attributes were all
+        stored (as '<name>.npy') is replaced by a pipeline reading the
+        memory-mapped arrays, shuffled and repeated indefinitely.
+        """
+        for names in self.input_groups():
+            paths = [os.path.join(self.shared_data_dir, name + '.npy')
+                     for name in names]
+            if not all(os.path.exists(path) for path in paths):
+                continue
+            arrays = [np.load(path, mmap_mode='r') for path in paths]
+            for name, array in zip(names, arrays):
+                shape = getattr(self, name).get_shape()[1:]
+                if not shape.is_compatible_with(array.shape[1:]):
+                    raise ValueError(
+                        'The stored %s of shape %s cannot replace a '
+                        'Tensor of shape %s' % (name, array.shape[1:], shape))
+            tensors = load_batch_arrays(arrays, batch_size)
+            for name, tensor in zip(names, tensors):
+                setattr(self, name, tensor)
+
+    def write_trace(self, run_metadata, global_step_count):
+        """Save the trace of a run and record the input wait time.
+
+        Args:
+            run_metadata: The `RunMetadata` of a traced run.
+            global_step_count: The global step of the run.
+        """
+        wait_time = input_wait_time(run_metadata)
+        self.step_times.add('input wait (traced)', wait_time)
+        tf.logging.info('global step %s: waited %.3f sec for the input',
+                        global_step_count, wait_time)
+
+        trace = timeline.Timeline(run_metadata.step_stats)
+        trace_path = os.path.join(
+            self.trace_dir, 'timeline_%d.json' % global_step_count)
+        with tf.gfile.Open(trace_path, 'w') as f:
+            f.write(trace.generate_chrome_trace_format())
+        self.sv.summary_writer.add_run_metadata(
+            run_metadata, 'step%d' % global_step_count)
+
+    def select_data(self, train_tensor, test_tensor):
+        """Decide which of the training or testing data to use.
+
+        The returned `Tensor` is computed from `train_tensor` by default.
+        When we test the model, the values of `test_tensor` are first
+        computed alone and then fed in its place (see `self.test_feed_dict`).
+        In this way only the input pipeline that is really needed is run
+        at each step and validation data are never consumed by the
+        training steps.
+
+        Args:
+            train_tensor: A `Tensor` given by the training input pipeline.
+            test_tensor: The corresponding `Tensor` given by the
+                validation input pipeline. It must have the same shape.
+
+        Returns:
+            The `Tensor` to be used by the model.
+        """
+        used_tensor = tf.placeholder_with_default(
+            train_tensor, train_tensor.get_shape())
+        self.test_feeds.append((used_tensor, test_tensor))
+        return used_tensor
+
+    def test_feed_dict(self, sess, test_use_batch):
+        """Get the feed dictionary to use for test computations.
+
+        A batch of validation data is computed here so this method
+        should be called once for every test.
+
+        Args:
+            sess: The session used to compute the validation batch.
+            test_use_batch: Whether to use batch statistics or moving
+                ones for batch normalization during test.
+
+        Returns:
+            A feed dictionary that replaces the inputs of the model
+            by validation data.
+        """
+        used_tensors = [used_tensor for used_tensor, _ in self.test_feeds]
+        test_values = sess.run(
+            [test_tensor for _, test_tensor in self.test_feeds])
+        feed_dict = dict(zip(used_tensors, test_values))
+        feed_dict[self.training] = False
+        feed_dict[self.batch_stat] = test_use_batch
+        return feed_dict
+
     def used_arg_scope(self, use_batch_norm, renorm, weight_decay):
         """The slim argument scope that is used for main computations.
 
@@ -629,3 +1068,4 @@ def train(train_class,
     train_instance.train(
         tfrecord_dir, checkpoint_dirs, log_dir,
         number_of_steps=number_of_steps, **kwargs)
+    return train_instance
@@ -73,9 +73,8 @@ class Visualize(object):
                 self.compute(**kwargs)
 
             with tf.Session() as sess:
-                with slim.queues.QueueRunners(sess):
-                    self.init_model(sess, checkpoint_dirs)
-                    self.config_embedding(sess, log_dir)
+                self.init_model(sess, checkpoint_dirs)
+                self.config_embedding(sess, log_dir)
 
     @abc.abstractmethod
     def get_data(self, split_name, tfrecord_dir, batch_size, shuffle):
@@ -22,17 +22,17 @@ class TrainVideo(Train):
     def get_data(self, tfrecord_dir, batch_size):
         self.dataset_train = get_split_lips('train', tfrecord_dir)
         self.videos_train, self.labels_train = load_batch_lips(
-            self.dataset_train, batch_size=batch_size)
+            self.dataset_train, batch_size=batch_size,
+            num_epochs=self.num_epochs)
         self.dataset_test = get_split_lips('validation', tfrecord_dir)
         self.videos_test, self.labels_test = load_batch_lips(
-            self.dataset_test, batch_size=batch_size, is_training=False)
+            self.dataset_test, batch_size=batch_size, is_training=False,
+            num_epochs=self.num_epochs)
         return self.dataset_train
 
     def decide_used_data(self):
-        self.videos = tf.cond(
-            self.training, lambda: self.videos_train, lambda: self.videos_test)
-        self.labels = tf.cond(
-            self.training, lambda: self.labels_train, lambda: self.labels_test)
+        self.videos = self.select_data(self.videos_train, self.videos_test)
+        self.labels = self.select_data(self.labels_train, self.labels_test)
 
 
 class EvaluateVideo(Evaluate):
@@ -43,7 +43,7 @@ class EvaluateVideo(Evaluate):
             batch_size = self.dataset.num_samples
         self.videos, self.labels = load_batch_lips(
             self.dataset, batch_size=batch_size,
-            shuffle=shuffle, is_training=False)
+            shuffle=shuffle, is_training=False, num_epochs=self.num_epochs)
         return self.dataset
 
 